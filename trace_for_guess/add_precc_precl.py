@@ -2,19 +2,23 @@
 #
 # SPDX-License-Identifier: MIT
 
-import glob
 import os
 import shutil
-import subprocess
 
 import yaml
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.netcdf_edit import (edit_dataset, rename_variables,
+                                         set_variable_attributes)
 from trace_for_guess.skip import skip
 
+# Number of time steps that are added at once.
+TIME_BLOCK = 1200
+
 
 def add_precc_and_precl_to_prect(precc_file, precl_file, prect_file):
-    """Build sum of the TraCE variables PRECC and PRECL using NCO commands.
+    """Build sum of the TraCE variables PRECC and PRECL.
 
     PRECC is convective precipitation, PRECL is the local precipitation, and
     PRECT is the sum of both: the total precipitation.
@@ -30,8 +34,9 @@ def add_precc_and_precl_to_prect(precc_file, precl_file, prect_file):
     Raises:
         FileNotFoundError: Either the PRECC or the PRECL file couldn’t be
             found.
-        RuntimeError: The `ncrename` command has failed or produced not output.
+        KeyError: The variable PRECC or PRECL is missing.
     """
+    import netCDF4
     if not os.path.isfile(precc_file):
         raise FileNotFoundError("Could not find PRECC file: '%s'" % precc_file)
     if not os.path.isfile(precl_file):
@@ -40,40 +45,25 @@ def add_precc_and_precl_to_prect(precc_file, precl_file, prect_file):
         return prect_file
     cprint('Adding PRECC and PRECL to PRECT:', 'yellow')
     cprint(f"'{precc_file}' + '{precl_file}' -> '{prect_file}'", 'yellow')
-    # First copy PRECC file into output location so that we can rename its
-    # variable to match the variable of the other operand. If the names of the
-    # variables don’t match, NCO will not be able to add them.
-    try:
-        shutil.copy(precc_file, prect_file)
-        assert(os.path.isfile(prect_file))
-        os.chmod(prect_file, 0o666)  # Read/write for everybody
-        subprocess.run(['ncrename', '--overwrite', '--variable=PRECC,PRECL',
-                        prect_file], check=True)
-        # Now we can add the values of the variable "PRECL".
-        subprocess.run(['ncbo', '--overwrite', '--op_typ=add', precl_file,
-                        prect_file, prect_file], check=True)
-        # Finally we need to name the sum appropriately "PRECT".
-        subprocess.run(['ncrename', '--variable', 'PRECL,PRECT', prect_file],
-                       check=True)
-        opts = yaml.load(open('options.yaml'))
-        long_name = opts['nc_attributes']['PRECT']['long_name']
-        subprocess.run(['ncatted', '--overwrite',
-                        '--attribute', f'long_name,PRECT,m,c,"{long_name}"',
-                        prect_file], check=True)
-        # Convert precipitation flux from m/s to kg/m²/s (compare README).
-        subprocess.run(['ncap2', '--overwrite', '--script=PRECT*=1000.0',
-                        prect_file, prect_file], check=True)
-        units = opts['nc_attributes']['PRECT']['units']
-        subprocess.run(['ncatted', '--overwrite',
-                        '--attribute', f'units,PRECT,m,c,"{units}"',
-                        prect_file], check=True)
-    except Exception:
-        if os.path.isfile(prect_file):
-            cprint(f"Removing file '{prect_file}'.", 'red')
-            os.remove(prect_file)
-        for f in glob.glob(f'{prect_file}.pid*.tmp'):
-            cprint(f"Removing file '{f}'.", 'red')
-            os.remove(f)
-        raise
+    # The PRECC file is copied, its variable is renamed, and the sum is
+    # written into it in blocks of time steps. So the data are written only
+    # once. All edits work on a temporary file, which is removed on error.
+    opts = yaml.load(open('options.yaml'))
+    with atomic_output(prect_file) as tmp_file:
+        shutil.copyfile(precc_file, tmp_file)
+        os.chmod(tmp_file, 0o666)  # Read/write for everybody
+        with edit_dataset(tmp_file) as ds, \
+                netCDF4.Dataset(precl_file, 'r') as precl:
+            rename_variables(ds, {'PRECC': 'PRECT'})
+            prect = ds.variables['PRECT']
+            for start in range(0, prect.shape[0], TIME_BLOCK):
+                block = slice(start, start + TIME_BLOCK)
+                # Convert precipitation flux from m/s to kg/m²/s (compare
+                # README).
+                prect[block] = (prect[block] +
+                                precl.variables['PRECL'][block]) * 1000.0
+            set_variable_attributes(ds, {'PRECT': {
+                key: opts['nc_attributes']['PRECT'][key]
+                for key in ['long_name', 'units']}})
     cprint(f"Successfully created '{prect_file}'.", 'green')
     return prect_file
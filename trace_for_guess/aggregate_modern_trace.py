@@ -4,44 +4,77 @@
 
 import os
 
-import xarray as xr
 from termcolor import cprint
 
+from trace_for_guess.combine_files import TIME_CHUNK, is_field
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.months import get_month_index
 from trace_for_guess.skip import skip
 
 
-def drop_superfluous_trace_vars(data):
-    """Drop all unneeded data variables from a TraCE-21ka xarray dataset."""
-    return data.drop(["P0", "co2vmr", "gw", "hyai", "date", "date_written",
-                      "datesec", "hyai", "hyam", "hybi", "hybm", "mdt",
-                      "nbdate", "nbsec", "ndbase", "ndcur", "nlon", "nsbase",
-                      "nscur", "nsteph", "ntrk", "ntrm", "ntrn",
-                      "time_written", "wnummax"])
-
-
-def get_monthly_means(trace_file):
+def get_monthly_means(trace_file, out_file):
     """
     Aggregate TraCE-21ka file over time to have only 12 data points per cell.
 
+    The time axis is read in blocks of `TIME_CHUNK` time steps. For each
+    month, a running sum and a count of valid (not missing) values per grid
+    cell are kept in float64 arrays. So the memory usage does not depend on
+    the length of the record. The file is assumed to begin with January.
+
+    The output file contains the mean of each map variable, the (new) time
+    axis with the month numbers 0 (January) to 11 (December), and all
+    variables without time dimension (coordinates). All other variables
+    (e.g. 'co2vmr', 'date') are dropped.
+
     Args:
         trace_file: File path of the TraCE-21ka NetCDF file.
-
-    Returns:
-        A xarray.Dataset object of the file.
+        out_file: Path to the output NetCDF file (will be overwritten).
     """
-    data = xr.open_dataset(trace_file, decode_times=False)
-    # Create list with numbers from 0 (January) to 12 (December).
-    month_numbers = [i for i in range(12)]
-    data = drop_superfluous_trace_vars(data)  # TODO: Do we need this?
-    # Repeat the months (assuming the dataset begins with January).
-    year_count = len(data["time"]) // 12
-    month_dim = month_numbers * year_count
-    # Overwrite the time dimension with months.
-    data["time"].values = month_dim
-    # Create mean monthly temperatures over the whole time span for each grid
-    # cell.
-    data = data.groupby('time').mean('time')
-    return data
+    import netCDF4
+    import numpy as np
+    with atomic_output(out_file) as tmp_file, \
+            netCDF4.Dataset(trace_file, 'r') as src, \
+            netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as out:
+        out.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            if name == 'time':
+                out.createDimension(name, 12)
+            else:
+                out.createDimension(name, len(dim))
+        time_steps = len(src.dimensions['time'])
+        for name, var in src.variables.items():
+            if name == 'time':
+                new = out.createVariable(name, var.datatype, ('time',))
+                new.setncatts({a: var.getncattr(a) for a in var.ncattrs()
+                               if a != 'bounds'})
+                new[:] = np.arange(12)
+            elif 'time' not in var.dimensions:
+                new = out.createVariable(name, var.datatype,
+                                         var.dimensions)
+                new.setncatts({a: var.getncattr(a) for a in var.ncattrs()})
+                new[:] = var[:]
+            elif is_field(var) and var.dimensions[0] == 'time':
+                new = out.createVariable(
+                    name, var.datatype, var.dimensions,
+                    fill_value=getattr(var, '_FillValue', None))
+                new.setncatts({a: var.getncattr(a) for a in var.ncattrs()
+                               if a != '_FillValue'})
+                shape = (12,) + var.shape[1:]
+                sums = np.zeros(shape, dtype='float64')
+                counts = np.zeros(shape, dtype='int64')
+                for start in range(0, time_steps, TIME_CHUNK):
+                    end = min(start + TIME_CHUNK, time_steps)
+                    block = np.ma.masked_invalid(var[start:end])
+                    months = get_month_index(end - start, start % 12)
+                    valid = ~np.ma.getmaskarray(block)
+                    values = block.filled(0).astype('float64')
+                    for month in range(12):
+                        in_month = months == month
+                        sums[month] += values[in_month].sum(axis=0)
+                        counts[month] += valid[in_month].sum(axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    new[:] = np.ma.masked_where(counts == 0,
+                                                sums / counts)
 
 
 def aggregate_modern_trace(trace_file, out_file):
@@ -63,11 +96,62 @@ def aggregate_modern_trace(trace_file, out_file):
     if skip(trace_file, out_file):
         return out_file
     cprint(f"Aggregating monthly averages from file '{trace_file}'.", 'yellow')
-    dataset = get_monthly_means(trace_file)
-    dataset.to_netcdf(out_file, mode='w', engine='netcdf4')
-    dataset.close()
+    get_monthly_means(trace_file, out_file)
     if os.path.isfile(out_file):
         cprint(f"Successfully created output file '{out_file}'.", 'green')
     else:
         raise RuntimeError(f"Output file '{out_file}' was not created.")
     return out_file
+
+
+def extract_modern_years(trace_file, out_file, years):
+    """Copy the monthly values of the last years from a TraCE file.
+
+    The modern TraCE record ends with December 1990 CE. Variables without
+    time dimension are copied unchanged.
+
+    Args:
+        trace_file: Path to original TraCE-21ka NetCDF file.
+        out_file: Path to output file (will *not* be overwritten).
+        years: Number of years at the end of the record.
+
+    Returns:
+        The created output file (equals `out_file`).
+
+    Raises:
+        FileNotFoundError: The file `trace_file` wasn’t found.
+        ValueError: The record is shorter than `years`.
+    """
+    import netCDF4
+    if not os.path.isfile(trace_file):
+        raise FileNotFoundError("Input file doesn’t exist: '%s'" % trace_file)
+    if skip(trace_file, out_file):
+        return out_file
+    cprint(f"Extracting the last {years} years from file '{trace_file}'.",
+           'yellow')
+    with atomic_output(out_file) as tmp_file, \
+            netCDF4.Dataset(trace_file, 'r') as src, \
+            netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as out:
+        time_steps = len(src.dimensions['time'])
+        if time_steps < years * 12:
+            raise ValueError(f"File '{trace_file}' has less than {years} "
+                             'years.')
+        first = time_steps - years * 12
+        out.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            if name == 'time':
+                out.createDimension(name, years * 12)
+            else:
+                out.createDimension(name, len(dim))
+        for name, var in src.variables.items():
+            new = out.createVariable(
+                name, var.datatype, var.dimensions,
+                fill_value=getattr(var, '_FillValue', None))
+            new.setncatts({a: var.getncattr(a) for a in var.ncattrs()
+                           if a != '_FillValue'})
+            if var.dimensions[:1] == ('time',):
+                new[:] = var[first:]
+            else:
+                new[:] = var[:]
+    cprint(f"Successfully created output file '{out_file}'.", 'green')
+    return out_file
@@ -8,6 +8,7 @@ import subprocess
 
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
 from trace_for_guess.skip import skip
 
 
@@ -38,13 +39,8 @@ def aggregate_monthly_means(in_file, out_file):
         return out_file
     cprint(f"Aggregating monthly means from '{in_file}', writing to "
            f"'{out_file}'...", 'yellow')
-    try:
-        subprocess.run(['cdo', 'ymonmean', in_file, out_file], check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+    with atomic_output(out_file) as tmp_file:
+        subprocess.run(['cdo', 'ymonmean', in_file, tmp_file], check=True)
     if not os.path.isfile(out_file):
         raise RuntimeError('Aggregating with `cdo ymonmean` failed: No output '
                            'file created.')
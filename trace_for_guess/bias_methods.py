@@ -0,0 +1,279 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Registry of the bias-correction methods.
+#
+# Each method consists of two functions working on plain numpy arrays:
+# - `fit(model, reference)`: Calculate the bias from the modern TraCE
+#   climatology (`model`) and the CRU climatology (`reference`). Both arrays
+#   have the 12 months on the first axis and are in the same units. The
+#   returned array has the 12 months on the first axis, too. Methods that need
+#   more than one value per month and grid cell (e.g. quantile mapping) put
+#   them on additional axes after the month axis.
+# - `apply(values, bias)`: Correct the TraCE values of one month in place.
+#   `values` holds all time steps of that month (time, lat, lon) and `bias` is
+#   the fitted bias of that month.
+#
+# `apply_bias()` calls the `apply` kernel with strided views of each month, so
+# that neither the bias nor the month index is broadcast to the full size of
+# the data. To add a method, write the two functions and add them to
+# `METHODS`. Which method is used for which variable is configured under
+# `bias_methods` in the options. The method is stored as attribute in the bias
+# file.
+#
+# The quantile-mapping methods are fitted to the monthly values of all modern
+# years (`samples`) from TraCE and CRU-JRA instead of the climatology: the
+# arrays have the shape (12, years, lat, lon). The bias is then a table
+# (12, 2, quantiles, lat, lon) with the quantiles of TraCE and the reference
+# in the units of TraCE.
+
+import collections
+
+# A bias-correction method (see above). `samples` is True if `fit` takes the
+# monthly values of all years instead of the 12-months climatology.
+BiasMethod = collections.namedtuple('BiasMethod', ['fit', 'apply', 'samples'])
+
+# The method for each TraCE variable if the options don’t specify one.
+DEFAULT_METHODS = {'CLDTOT': 'power', 'PRECT': 'ratio', 'TREFHT': 'delta'}
+
+# NetCDF attribute of the bias variable naming the method.
+METHOD_ATTRIBUTE = 'bias_method'
+
+# Substitute for a zero reference value in the ratio method to prevent
+# division by zero. CRU precipitation is in mm/month.
+ALMOST_ZERO = 1
+
+# Number of quantiles (including minimum and maximum) in the tables of the
+# quantile-mapping methods.
+QUANTILES = 21
+
+
+def fit_delta(model, reference):
+    """Calculate the bias as difference."""
+    return model - reference
+
+
+def apply_delta(values, bias):
+    """Subtract the bias in place."""
+    values -= bias
+
+
+def fit_ratio(model, reference):
+    """Calculate the bias as quotient."""
+    import numpy as np
+    return model / np.where(reference == 0, ALMOST_ZERO, reference)
+
+
+def apply_ratio(values, bias):
+    """Divide by the bias in place."""
+    values /= bias
+
+
+def fit_power(model, reference):
+    """Calculate the bias as exponent for fractions between 0 and 1."""
+    import numpy as np
+    return np.log(model) / np.log(reference)
+
+
+def apply_power(values, bias):
+    """Raise to the power of the bias in place."""
+    values **= bias
+
+
+def fit_quantiles(model, reference):
+    """Calculate the quantile tables of TraCE and the reference.
+
+    >>> import numpy as np
+    >>> samples = np.arange(12 * 5.0).reshape((12, 5, 1, 1))
+    >>> fit_quantiles(samples, samples + 1)[0, :, [0, -1], 0, 0].tolist()
+    [[0.0, 1.0], [4.0, 5.0]]
+    """
+    import numpy as np
+    probabilities = np.linspace(0, 1, QUANTILES)
+    tables = [np.moveaxis(np.quantile(x, probabilities, axis=1), 0, 1)
+              for x in (model, reference)]
+    return np.stack(tables, axis=1).astype('float32')
+
+
+def map_quantiles(values, tables, multiplicative):
+    """Replace TraCE values by the reference values of the same quantile.
+
+    Between the quantiles, the values are interpolated linearly per grid cell
+    (like `np.interp()`, but vectorized over all grid cells). Values outside of
+    the modern TraCE range are shifted by the correction of the minimum or
+    maximum, respectively.
+
+    Args:
+        values: Numpy array (time, lat, lon), changed in place.
+        tables: Numpy array (2, quantiles, lat, lon) with the quantiles of
+            TraCE and of the reference.
+        multiplicative: Whether to scale values outside of the range by the
+            ratio instead of adding the difference.
+
+    >>> import numpy as np
+    >>> values = np.array([-1.0, 0.0, 0.5, 1.5, 2.0, 3.0]).reshape((6, 1, 1))
+    >>> tables = np.array([[0.0, 1, 2], [10, 20, 40]]).reshape((2, 3, 1, 1))
+    >>> map_quantiles(values, tables, multiplicative=False)
+    >>> values[:, 0, 0].tolist()
+    [9.0, 10.0, 15.0, 30.0, 40.0, 41.0]
+    """
+    import numpy as np
+    cells = tables[0, 0].size
+    # Tables with the quantiles one after another: (quantiles * cells)
+    (model, reference) = (tables[0].reshape(-1), tables[1].reshape(-1))
+    flat = values.reshape((len(values), -1))
+    # Find the interval between two quantiles for each value by counting the
+    # inner quantiles below it. Small integers are faster to count.
+    index = np.zeros(flat.shape, dtype='uint8')
+    for quantile in model[cells:-cells].reshape((-1, cells)):
+        index += flat >= quantile
+    # Position of the lower quantile of the interval in the flat tables.
+    lower = index.astype('intp')
+    lower *= cells
+    lower += np.arange(cells)
+    low = model.take(lower)
+    low_ref = reference.take(lower)
+    upper = lower
+    upper += cells
+    # Where quantiles are equal (e.g. many months without precipitation), the
+    # lower reference quantile is taken.
+    width = model.take(upper) - low
+    width[width <= 0] = np.inf
+    result = flat - low
+    result /= width
+    np.clip(result, 0, 1, out=result)
+    result *= reference.take(upper) - low_ref
+    result += low_ref
+    # Values below the minimum and above the maximum
+    for (end, ref_end, beyond) in [
+            (model[:cells], reference[:cells], np.less),
+            (model[-cells:], reference[-cells:], np.greater)]:
+        outside = beyond(flat, end)
+        if not outside.any():
+            continue
+        if multiplicative:
+            shifted = flat * np.where(
+                end > 0, ref_end / np.where(end > 0, end, 1), 1)
+        else:
+            shifted = flat + (ref_end - end)
+        result[outside] = shifted[outside]
+    values[...] = result.reshape(values.shape)
+
+
+def apply_quantile_delta(values, bias):
+    """Map quantiles and shift values outside of the range additively."""
+    map_quantiles(values, bias, multiplicative=False)
+
+
+def apply_quantile_ratio(values, bias):
+    """Map quantiles and scale values outside of the range by the ratio."""
+    map_quantiles(values, bias, multiplicative=True)
+
+
+# All available bias-correction methods by name.
+METHODS = {
+    'delta': BiasMethod(fit_delta, apply_delta, samples=False),
+    'power': BiasMethod(fit_power, apply_power, samples=False),
+    'quantile_delta': BiasMethod(fit_quantiles, apply_quantile_delta,
+                                 samples=True),
+    'quantile_ratio': BiasMethod(fit_quantiles, apply_quantile_ratio,
+                                 samples=True),
+    'ratio': BiasMethod(fit_ratio, apply_ratio, samples=False),
+}
+
+
+def get_method(name):
+    """Look up a bias-correction method by its name.
+
+    Raises:
+        NotImplementedError: There is no method with that name.
+    """
+    if name not in METHODS:
+        raise NotImplementedError(
+            f"Unknown bias-correction method '{name}'. Available methods: "
+            + ', '.join(sorted(METHODS)))
+    return METHODS[name]
+
+
+def get_method_name(var, bias_methods=None):
+    """Get the bias-correction method for a TraCE variable.
+
+    Args:
+        var: The TraCE variable.
+        bias_methods: Dictionary from the options with the TraCE variable as
+            key and the method name as value.
+
+    Raises:
+        NotImplementedError: No method is defined for `var`.
+
+    >>> get_method_name('PRECT')
+    'ratio'
+    >>> get_method_name('PRECT', {'PRECT': 'delta'})
+    'delta'
+    """
+    name = (bias_methods or dict()).get(var, DEFAULT_METHODS.get(var))
+    if name is None:
+        raise NotImplementedError("No bias correction defined for "
+                                  "variable '%s'." % var)
+    get_method(name)
+    return name
+
+
+def fit_bias(model, reference, method):
+    """Calculate the monthly bias with the given method.
+
+    Args:
+        model: Numpy array with the modern TraCE climatology (12 months on the
+            first axis).
+        reference: Numpy array with the CRU climatology in the same units.
+        method: Name of the method.
+
+    Returns:
+        Numpy array with the bias (12 months on the first axis).
+    """
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return get_method(method).fit(model, reference)
+
+
+def apply_bias(values, bias, method, first_month=0):
+    """Apply the monthly bias to a monthly time series in place.
+
+    Missing values in the bias (NaN) are masked in the result if `values` is
+    a masked array. Otherwise they yield NaN.
+
+    Args:
+        values: Numpy array or masked array (time, lat, lon).
+        bias: Numpy array with the bias (12 months on the first axis).
+        method: Name of the method.
+        first_month: Month number (0 for January) of the first time step.
+
+    >>> import numpy as np
+    >>> values = np.ones((14, 1, 1))
+    >>> apply_bias(values, np.arange(12.0).reshape((12, 1, 1)), 'delta')
+    >>> values[:, 0, 0].tolist()[10:]
+    [-9.0, -10.0, 1.0, 0.0]
+    """
+    import numpy as np
+    apply = get_method(method).apply
+    # Masked values are corrected too, but remain masked.
+    data = np.ma.getdata(values)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for month in range(12):
+            # Every 12th time step is the same month. A strided view doesn’t
+            # copy any data.
+            apply(data[(month - first_month) % 12::12], bias[month])
+    if isinstance(values, np.ma.MaskedArray):
+        invalid = ~np.isfinite(data)
+        if invalid.any():
+            values[invalid] = np.ma.masked
+
+
+def get_bias_method(bias):
+    """Get the method name of a bias xarray DataArray from its attributes.
+
+    Bias files from older versions have no attribute and were created with the
+    default method of the variable.
+    """
+    return bias.attrs.get(METHOD_ATTRIBUTE) or get_method_name(bias.name)
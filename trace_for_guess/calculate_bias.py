@@ -4,30 +4,65 @@
 
 import os
 
-import numpy as np
-import xarray as xr
 from termcolor import cprint
 
+from trace_for_guess.bias_methods import (METHOD_ATTRIBUTE, fit_bias,
+                                          get_method, get_method_name)
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.months import flux_to_mm_per_month
+from trace_for_guess.resources import reserve
 from trace_for_guess.skip import skip
 
 
-def precip_flux_to_mm_per_month(data_array):
-    """Convert precipitation from kg/m²/s to mm/month.
-
-    See the README.md for a detailed explanation of the formula.
-    """
-    # TODO Take month lengths into account!
-    days_per_month = 30
-    seconds_per_month = days_per_month * 24 * 60 * 60
-    return data_array * seconds_per_month
-
-
 def celsius_to_kelvin(x):
     """Convert from degrees Celsius to Kelvin."""
     return x + 273.15
 
 
-def calculate_bias(trace_file, trace_var, cru_file, cru_var, bias_file):
+def percent_to_fraction(x):
+    """Convert from percent to a fraction between 0 and 1."""
+    return x / 100.0
+
+
+# Functions to convert the modern TraCE and the CRU data (xarray DataArrays)
+# into the same units before the bias is calculated. The TraCE precipitation
+# is converted to high numbers in order to prevent any floating point
+# precision errors.
+UNIT_CONVERSIONS = {
+    'CLDTOT': (None, percent_to_fraction),
+    'PRECT': (flux_to_mm_per_month, None),
+    'TREFHT': (None, celsius_to_kelvin),
+}
+
+
+# Length of one time step in the CRU-JRA files in seconds.
+CRUJRA_SECONDS_PER_STEP = 6 * 60 * 60
+
+
+def crujra_to_flux(x):
+    """Convert CRU-JRA precipitation from mm per 6 hours to kg/m²/s."""
+    return x / CRUJRA_SECONDS_PER_STEP
+
+
+# Functions to convert the monthly means of CRU-JRA (xarray DataArrays) into
+# the units of TraCE for quantile mapping.
+CRUJRA_CONVERSIONS = {'PRECT': crujra_to_flux}
+
+
+def get_bias_file(heap, trace_var, method):
+    """Get the path of the bias file for a variable in the heap.
+
+    The method is part of the name so that the bias is calculated anew if
+    the method in the options is changed.
+
+    >>> get_bias_file('heap', 'PRECT', 'ratio')
+    'heap/bias_PRECT_ratio.nc'
+    """
+    return os.path.join(heap, f'bias_{trace_var}_{method}.nc')
+
+
+def calculate_bias(trace_file, trace_var, cru_file, cru_var, bias_file,
+                   method=None):
     """Create a file with the monthly bias of TraCE compared to the CRUNCEP data.
 
     Each of the input files should contain only 12 values per grid cell
@@ -39,15 +74,21 @@ def calculate_bias(trace_file, trace_var, cru_file, cru_var, bias_file):
         cru_file: The CRU NetCDF file with modern monthly averages.
         cru_var: NetCDF variable in the CRU file.
         bias_file: Path to output file (will not be overwritten).
+        method: Name of the bias-correction method (see
+            `trace_for_guess/bias_methods.py`). By default, the method for
+            `trace_var` in `DEFAULT_METHODS` is used.
 
     Returns:
         Path to output file (equals `bias_file`).
 
     Raises:
         FileNotFoundError: The file `trace_file` or `cru_file` wasn’t found.
-        NotImplementedError: The variable in the TraCE file is not
-            implemented.
+        NotImplementedError: The variable in the TraCE file or the method is
+            not implemented.
     """
+    import xarray as xr
+    method = method or get_method_name(trace_var)
+    get_method(method)
     if not os.path.isfile(trace_file):
         raise FileNotFoundError(
             "TraCE-21ka mean file doesn’t exist: '%s'" % trace_file)
@@ -57,49 +98,118 @@ def calculate_bias(trace_file, trace_var, cru_file, cru_var, bias_file):
         return bias_file
     cprint('Calculating bias:', 'yellow')
     cprint(f"'{trace_file}' x '{cru_file}' -> '{bias_file}'", 'yellow')
-    # Open and load the files completely. They need to be in the RAM for
-    # calculation.
-    trace = xr.open_dataset(trace_file, decode_times=False).load()
-    cru = xr.open_dataset(cru_file, decode_times=False).load()
-    try:
-        # The values of the 'time' dimensions of the CRU and the TraCE dataset
-        # must match in order to perform calculation. So we just overwrite the
-        # values with 0 to 11 as the month numbers, assuming that the CRU
-        # record also starts with January.
-        cru["time"].values = [i for i in range(12)]
-        # Rename the variable in the CRU file to the TraCE variable name.
-        cru = cru.rename({cru_var: trace_var})
-        if trace_var == "TREFHT":
-            bias = trace[trace_var] - celsius_to_kelvin(cru[trace_var])
-        elif trace_var == "PRECT":
-            # The CRU precipitation is in mm/month.
-            # The TraCE precipitation is in kg/m²/s (already converted!).
-            # We convert to high numbers to do the division in order to prevent
-            # any floating point precision errors.
-            trace[trace_var] = precip_flux_to_mm_per_month(trace[trace_var])
-            # Catch potential division by zero.
-            almost_zero = 1  # [mm/month]
-            c = cru[trace_var]
-            c = np.where(c == 0, almost_zero, c)
-            bias = trace[trace_var] / c
-        elif trace_var == "CLDTOT":
-            # The CRU data needs to be divided by 100 because it comes in
-            # percent, not fraction.
-            bias = np.log(trace[trace_var]) / np.log(cru[trace_var] / 100.0)
-        else:
-            raise NotImplementedError("Arithmetic operation not defined for"
-                                      "variable '%s'." % trace_var)
-        bias.to_netcdf(bias_file, mode='w', engine='netcdf4')
-        bias.close()
-    except Exception:
-        if os.path.isfile(bias_file):
-            cprint(f"Removing file '{bias_file}'.", 'red')
+    with reserve('bias', [trace_file, cru_file]):
+        # Open and load the files completely. They need to be in the RAM for
+        # calculation.
+        trace = xr.open_dataset(trace_file, decode_times=False).load()
+        cru = xr.open_dataset(cru_file, decode_times=False).load()
+        try:
+            model = trace[trace_var]
+            reference = cru[cru_var]
+            (convert_model, convert_reference) = UNIT_CONVERSIONS.get(
+                trace_var, (None, None))
+            if convert_model is not None:
+                model = convert_model(model)
+            if convert_reference is not None:
+                reference = convert_reference(reference)
+            # The grids of CRU and TraCE are the same. The CRU record is
+            # assumed to start with January, too, so the arrays can be
+            # combined directly without aligning the coordinates.
+            bias = xr.DataArray(
+                fit_bias(model.values, reference.values, method),
+                coords=trace[trace_var].coords, dims=trace[trace_var].dims,
+                name=trace_var, attrs={METHOD_ATTRIBUTE: method})
+            with atomic_output(bias_file) as tmp_file:
+                bias.to_netcdf(tmp_file, mode='w', engine='netcdf4')
             bias.close()
-            os.remove(bias_file)
-        raise
-    finally:
-        trace.close()
-        cru.close()
+        finally:
+            trace.close()
+            cru.close()
+    assert os.path.isfile(bias_file)
+    cprint(f"Successfully created '{bias_file}'.", 'green')
+    return bias_file
+
+
+def get_monthly_samples(values):
+    """Arrange a monthly time series by month: (12, years, ...).
+
+    The series is assumed to start with January. An incomplete last year is
+    dropped.
+
+    >>> import numpy as np
+    >>> get_monthly_samples(np.arange(26))[1].tolist()
+    [1, 13]
+    """
+    years = len(values) // 12
+    return values[:years * 12].reshape(
+        (years, 12) + values.shape[1:]).swapaxes(0, 1)
+
+
+def calculate_quantile_bias(trace_file, trace_var, crujra_file, crujra_var,
+                            bias_file, method):
+    """Create a file with the quantile tables of modern TraCE and CRU-JRA.
+
+    For each month and grid cell, the quantiles of the monthly values over
+    all modern years are stored as float32 array (see
+    `trace_for_guess/bias_methods.py`).
+
+    Args:
+        trace_file: The regridded TraCE-21ka NetCDF file with the monthly
+            values of the modern years.
+        trace_var: NetCDF variable in the TraCE file.
+        crujra_file: The CRU-JRA NetCDF file with monthly means of the same
+            years on the same grid.
+        crujra_var: NetCDF variable in the CRU-JRA file.
+        bias_file: Path to output file (will not be overwritten).
+        method: Name of a quantile-mapping method.
+
+    Returns:
+        Path to output file (equals `bias_file`).
+
+    Raises:
+        FileNotFoundError: The file `trace_file` or `crujra_file` wasn’t
+            found.
+        NotImplementedError: The method is unknown.
+        ValueError: The method is not fitted to monthly samples.
+    """
+    import numpy as np
+    import xarray as xr
+    if not get_method(method).samples:
+        raise ValueError(f"Method '{method}' is not a quantile-mapping "
+                         'method.')
+    if not os.path.isfile(trace_file):
+        raise FileNotFoundError(
+            "Modern TraCE-21ka file doesn’t exist: '%s'" % trace_file)
+    if not os.path.isfile(crujra_file):
+        raise FileNotFoundError("CRU-JRA file doesn’t exist: '%s'" %
+                                crujra_file)
+    if skip([trace_file, crujra_file], bias_file):
+        return bias_file
+    cprint('Calculating quantile tables:', 'yellow')
+    cprint(f"'{trace_file}' x '{crujra_file}' -> '{bias_file}'", 'yellow')
+    with reserve('bias', [trace_file, crujra_file]), \
+            xr.open_dataset(trace_file, decode_times=False) as trace, \
+            xr.open_dataset(crujra_file, decode_times=False) as crujra:
+        model = trace[trace_var].load()
+        reference = crujra[crujra_var].load()
+        if trace_var in CRUJRA_CONVERSIONS:
+            reference = CRUJRA_CONVERSIONS[trace_var](reference)
+        # Like the CRU grid, the CRU-JRA grid is the same as the regridded
+        # TraCE grid.
+        tables = fit_bias(get_monthly_samples(model.values),
+                          get_monthly_samples(reference.values), method)
+        spatial_dims = model.dims[1:]
+        bias = xr.DataArray(
+            tables, dims=('time', 'table', 'quantile') + spatial_dims,
+            coords=dict({'time': np.arange(12),
+                         'quantile': np.linspace(0, 1, tables.shape[2])},
+                        **{d: model[d] for d in spatial_dims}),
+            name=trace_var,
+            attrs={METHOD_ATTRIBUTE: method,
+                   'table': '0: TraCE-21ka, 1: CRU-JRA',
+                   'units': model.attrs.get('units', '')})
+        with atomic_output(bias_file) as tmp_file:
+            bias.to_netcdf(tmp_file, mode='w', engine='netcdf4')
     assert os.path.isfile(bias_file)
     cprint(f"Successfully created '{bias_file}'.", 'green')
     return bias_file
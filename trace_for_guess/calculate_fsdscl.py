@@ -2,17 +2,23 @@
 #
 # SPDX-License-Identifier: MIT
 
-import glob
 import os
-import shutil
-import subprocess
 
-import xarray as xr
 from termcolor import cprint
 
+from trace_for_guess.combine_files import combine_files
 from trace_for_guess.skip import skip
 
 
+def get_fsdscl(FSDS, FSDSC, CLDTOT):
+    """Calculate FSDSCL from arrays of FSDS, FSDSC, and CLDTOT.
+
+    Where the sky is completely clear (CLDTOT is zero), FSDSCL is undefined
+    and masked.
+    """
+    return (FSDS - FSDSC * (1 - CLDTOT)) / CLDTOT
+
+
 def calculate_fsdscl(cldtot_file, fsds_file, fsdsc_file, out_file):
     """Re-construct the CCSM3 FSDSCL variable from CLDTOT, FSDS, and FSDSC.
 
@@ -42,28 +48,20 @@ def calculate_fsdscl(cldtot_file, fsds_file, fsdsc_file, out_file):
         raise FileNotFoundError("Could not find FSDS file: '%s'" % fsds_file)
     if not os.path.isfile(fsdsc_file):
         raise FileNotFoundError("Could not find FSDSC file: '%s'" % fsdsc_file)
-    # TODO: check for commands
     if skip([cldtot_file, fsds_file, fsdsc_file], out_file):
         return out_file
     cprint(f"Generating FSDSCL file: '{out_file}'", 'yellow')
-    try:
-        # Merge all variables (FSDS, FSDSC, CLDTOT) into one file, and then
-        # perform the operation in it.
-        subprocess.run(['ncks', '--append', fsds_file, out_file], check=True)
-        subprocess.run(['ncks', '--append', fsdsc_file, out_file], check=True)
-        subprocess.run(['ncks', '--append', cldtot_file, out_file], check=True)
-        script = 'FSDSCL = (FSDS - FSDSC * (1 - CLDTOT)) / CLDTOT'
-        subprocess.run(['ncap2', '--append', '--script', script, out_file],
-                       check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        # Remove temporary file created by ncks.
-        for g in glob(f'{out_file}.pid*.ncks.tmp'):
-            cprint(f"Removing file '{g}'.", 'red')
-            os.remove(g)
-        raise
+    # Only FSDSCL is written into the output file. The other variables of the
+    # FSDS file (e.g. 'co2vmr') are copied.
+    combine_files(
+        in_files={'FSDS': fsds_file, 'FSDSC': fsdsc_file,
+                  'CLDTOT': cldtot_file},
+        out_file=out_file,
+        out_var='FSDSCL',
+        func=get_fsdscl,
+        attributes={'long_name': 'Downwelling solar flux at surface under '
+                    'completely overcast sky'}
+    )
     assert (os.path.isfile(out_file))
     cprint(f"Successfully created '{out_file}'.", 'green')
     return out_file
@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import subprocess
+
+from termcolor import cprint
+
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.resources import reserve
+from trace_for_guess.skip import skip
+
+
+def chain_cdo_operators(operators):
+    """Compose CDO operators into the arguments for one chained CDO command.
+
+    The operators are given in processing order: the first operator is applied
+    first to the input files. CDO expects them the other way round, and all
+    but the outermost operator need to be prefixed with a dash.
+
+    Args:
+        operators: List of CDO operator strings, with or without leading dash.
+
+    Returns:
+        List of command line arguments for `cdo` (without input and output
+        files).
+
+    Raises:
+        ValueError: `operators` is empty.
+
+    >>> chain_cdo_operators(['mergetime', 'sellonlatbox,0,10,-5,5',
+    ...                      'ymonmean'])
+    ['ymonmean', '-sellonlatbox,0,10,-5,5', '-mergetime']
+    >>> chain_cdo_operators(['-ymonmean'])
+    ['ymonmean']
+    """
+    if not operators:
+        raise ValueError('The list of CDO operators is empty.')
+    ops = [op.lstrip('-') for op in reversed(operators)]
+    return [ops[0]] + ['-' + op for op in ops[1:]]
+
+
+def run_cdo_chain(in_files, out_file, operators, options=None):
+    """Run a list of CDO operators as one chained CDO command.
+
+    No intermediate files are written between the operators. Instead CDO pipes
+    the data internally from one operator to the next.
+
+    Args:
+        in_files: List of input file paths (or a single path).
+        out_file: Output file path (will *not* be overwritten).
+        operators: List of CDO operators in processing order. The first
+            operator receives `in_files`.
+        options: Optional list of global CDO flags, e.g. ['-r'].
+
+    Returns:
+        The output file (equals `out_file`).
+
+    Raises:
+        FileNotFoundError: An input file does not exist.
+        RuntimeError: The `cdo` command is not in the PATH.
+        RuntimeError: The `cdo` command produced no output file.
+    """
+    if not isinstance(in_files, list):
+        in_files = [in_files]
+    for f in in_files:
+        if not os.path.isfile(f):
+            raise FileNotFoundError("Input file not found: '%s'" % f)
+    if skip(in_files, out_file):
+        return out_file
+    if shutil.which('cdo') is None:
+        raise RuntimeError('Executable `cdo` not found.')
+    out_dir = os.path.dirname(out_file)
+    if out_dir and not os.path.isdir(out_dir):
+        cprint(f"Directory '{out_dir}' does not exist yet. I will create it.",
+               'yellow')
+        os.makedirs(out_dir)
+    if options is None:
+        options = list()
+    args = ['cdo'] + options + chain_cdo_operators(operators)
+    cprint(f"Running chained CDO command `{' '.join(args)}` on "
+           f"{len(in_files)} file(s)...", 'yellow')
+    with reserve('cdo', in_files), atomic_output(out_file) as tmp_file:
+        subprocess.run(args + in_files + [tmp_file], check=True)
+    if not os.path.isfile(out_file):
+        raise RuntimeError('Chained CDO command failed: No output file '
+                           'created.')
+    cprint(f"Successfully created '{out_file}'.", 'green')
+    return out_file
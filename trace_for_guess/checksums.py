@@ -0,0 +1,370 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Checksums of the data in the output file of each processing stage.
+#
+# When a stage has finished a file (see `trace_for_guess.journal.
+# atomic_output()`), a checksum of each variable is appended to a manifest file
+# in the heap. The checksums are taken over the decoded arrays, not over the
+# file bytes: NCO and CDO write history attributes with time stamps, and the
+# compression settings change the bytes, but not the data.
+#
+# Two runs (e.g. sequential and with parallel processes or tiles, or a cached
+# heap and a fresh heap) can be compared with
+# `./prepare_trace_for_guess --verify HEAP_A HEAP_B`. The first processing
+# stage where the data differ is reported. With only one heap, the files on
+# disk are compared against the manifest.
+#
+# Each line of the manifest is a JSON object with these keys:
+# - 'key': Path relative to the heap or output directory, prefixed with
+#   'heap/' or 'output/'. This is the same in every heap.
+# - 'file': Absolute path of the file.
+# - 'stage': Name of the processing stage (see `get_stage()`).
+# - 'checksums': Dictionary with the variable name as key and the SHA-256 hex
+#   digest as value.
+# If a file is created again, the later line counts.
+
+import hashlib
+import json
+import os
+import re
+import threading
+from glob import glob
+
+from termcolor import cprint
+
+# Name of the manifest file in the heap directory.
+CHECKSUMS_NAME = 'checksums.jsonl'
+
+# Approximate number of values that are read at once from one variable.
+BLOCK_SIZE = 2**24  # = 64 MB in float32
+
+# Checksum name for files that are not NetCDF (e.g. text files). They are
+# hashed byte by byte.
+BYTES_KEY = '(bytes)'
+
+# Stage of the files in the root of the heap directory (bias files,
+# climatologies, weights, ...).
+SHARED_STAGE = 'shared'
+
+# Stage of the files in the output directory.
+OUTPUT_STAGE = 'output'
+
+# The manifest that is used by `record_checksums()`. It is set with
+# `open_manifest()`.
+_active_manifest = None
+
+
+def hash_array(digest, array):
+    """Update a hashlib object with the values of a (masked) numpy array.
+
+    Masked values and NaN are replaced by fixed values so that the hash only
+    depends on the data and not on the fill value or the bits of NaN.
+    """
+    import numpy as np
+    array = np.ma.asarray(array)
+    mask = np.ma.getmaskarray(array)
+    data = np.array(np.ma.getdata(array), order='C')
+    if data.dtype.kind == 'f':
+        data[np.isnan(data)] = np.nan
+    if data.dtype.kind in 'fiub':
+        data[mask] = 0
+    elif data.dtype.kind in 'OU':
+        data = np.frombuffer('\0'.join(str(x) for x in data.flat).encode(),
+                             dtype='uint8')
+    digest.update(data.tobytes())
+    digest.update(np.packbits(mask.reshape(-1)).tobytes())
+
+
+def get_variable_checksum(variable):
+    """Calculate the checksum of a NetCDF variable over its decoded values.
+
+    The variable is read in blocks of whole rows along the second axis (e.g.
+    all time steps of a few latitudes). This fits the chunking of the output
+    files (see `trace_for_guess.validate.get_block_rows()`). The checksum does
+    not depend on the block size because each row is hashed separately.
+
+    Args:
+        variable: A `netCDF4.Variable` object.
+
+    Returns:
+        The SHA-256 hex digest.
+    """
+    import numpy as np
+    digest = hashlib.sha256()
+    digest.update(f'{variable.dtype}{variable.shape}'.encode())
+    if variable.ndim < 2:
+        hash_array(digest, variable[...])
+        return digest.hexdigest()
+    row_size = max(np.prod(variable.shape) // variable.shape[1], 1)
+    rows = max(BLOCK_SIZE // row_size, 1)
+    for start in range(0, variable.shape[1], rows):
+        block = variable[:, start:start + rows]
+        for row in range(block.shape[1]):
+            hash_array(digest, block[:, row])
+    return digest.hexdigest()
+
+
+def get_file_checksums(filename):
+    """Calculate the checksums of all variables in a file.
+
+    Attributes are ignored. Files that are not NetCDF files are hashed
+    as a whole under the key `BYTES_KEY`.
+
+    Returns:
+        Dictionary with the variable name as key and the SHA-256 hex digest as
+        value.
+    """
+    if not filename.endswith('.nc'):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        return {BYTES_KEY: digest.hexdigest()}
+    import netCDF4
+    with netCDF4.Dataset(filename, 'r') as ds:
+        return {name: get_variable_checksum(ds.variables[name])
+                for name in sorted(ds.variables)}
+
+
+def get_stage(key):
+    """Get the name of the processing stage from the manifest key of a file.
+
+    The stage is the numbered heap subdirectory (e.g. '1_cropped'), also
+    within tile directories. Other files in the heap belong to the shared
+    input files of all stages, files in the output directory to the output
+    stage.
+
+    >>> get_stage('heap/3_split/trace.01.22000-20101BP.PRECT_000001.nc')
+    '3_split'
+    >>> get_stage('heap/tiles/tile_000/5_debiased/x.nc')
+    '5_debiased'
+    >>> get_stage('heap/bias_PRECT_ratio.nc')
+    'shared'
+    >>> get_stage('output/daily/trace_21601-21700_PRECT.nc')
+    'output'
+    """
+    parts = key.split('/')
+    if parts[0] == 'output':
+        return OUTPUT_STAGE
+    for part in reversed(parts[:-1]):
+        if re.match(r'\d+_', part):
+            return part
+    if 'output' in parts[:-1]:
+        return OUTPUT_STAGE
+    return SHARED_STAGE
+
+
+def get_stage_order(stage):
+    """Get a sort key so that stages are in the order of the processing chain.
+
+    >>> sorted(['output', '2_time', 'shared'], key=get_stage_order)
+    ['shared', '2_time', 'output']
+    """
+    if stage == SHARED_STAGE:
+        return (0, 0)
+    if stage == OUTPUT_STAGE:
+        return (2, 0)
+    return (1, int(stage.split('_')[0]))
+
+
+class Manifest:
+    """Append checksums of finished files to a manifest file in the heap.
+
+    Several processes share the manifest file if they are forked from the
+    same process (e.g. tiles or the weather generator). Each line is written
+    at once in append mode, so lines of different processes don’t mix.
+
+    Args:
+        manifest_file: Path to the manifest file.
+        roots: Dictionary with the prefix of the manifest key as key and the
+            directory as value, e.g. {'heap': 'heap', 'output': 'output'}.
+    """
+
+    def __init__(self, manifest_file, roots):
+        self.manifest_file = manifest_file
+        self.roots = {k: os.path.abspath(v) for (k, v) in roots.items()}
+        self.lock = threading.Lock()
+        self.file = open(manifest_file, 'a')
+
+    def get_key(self, path):
+        """Get the key of a file path relative to one of the roots."""
+        path = os.path.abspath(path)
+        # The deepest root first because the output directory may lie
+        # within the heap.
+        for (prefix, root) in sorted(self.roots.items(),
+                                     key=lambda x: -len(x[1])):
+            if path.startswith(root + os.sep):
+                return prefix + '/' + os.path.relpath(path, root)
+        return path
+
+    def record(self, path):
+        """Calculate the checksums of a file and append them."""
+        key = self.get_key(path)
+        line = json.dumps({'key': key,
+                           'file': os.path.abspath(path),
+                           'stage': get_stage(key),
+                           'checksums': get_file_checksums(path)})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        """Close the manifest file."""
+        self.file.close()
+
+
+def open_manifest(heap_dir, out_dir, name=CHECKSUMS_NAME):
+    """Open the manifest in the heap and make it known to `record_checksums()`.
+
+    Args:
+        heap_dir: Path to the heap directory.
+        out_dir: Path to the output directory.
+        name: File name of the manifest in the heap directory.
+
+    Returns:
+        A `Manifest` object.
+    """
+    global _active_manifest
+    if _active_manifest is not None:
+        _active_manifest.close()
+    _active_manifest = Manifest(os.path.join(heap_dir, name),
+                                {'heap': heap_dir, 'output': out_dir})
+    return _active_manifest
+
+
+def record_checksums(path):
+    """Record the checksums of a finished file in the active manifest.
+
+    Without an open manifest (see `open_manifest()`), nothing is done.
+    """
+    if _active_manifest is not None:
+        _active_manifest.record(path)
+
+
+def read_manifests(path):
+    """Read the checksums from a manifest file or from a heap directory.
+
+    In a heap directory, all manifest files (also of cluster shards and in
+    tile directories) are read. The keys from the manifests of tiles are
+    prefixed with the tile directory relative to `path`, so that they are the
+    same as if the tile directory were part of the heap.
+
+    Args:
+        path: Path to a manifest file or a heap directory.
+
+    Returns:
+        Dictionary with the manifest key as key and the record (see above) as
+        value, in the order in which the files were finished.
+
+    Raises:
+        FileNotFoundError: No manifest was found.
+    """
+    if os.path.isdir(path):
+        pattern = os.path.splitext(CHECKSUMS_NAME)
+        manifest_files = sorted(glob(os.path.join(
+            path, '**', pattern[0] + '*' + pattern[1]), recursive=True))
+    elif os.path.isfile(path):
+        manifest_files = [path]
+    else:
+        manifest_files = list()
+    if not manifest_files:
+        raise FileNotFoundError(f"No checksum manifest found in '{path}'.")
+    records = dict()
+    for manifest_file in manifest_files:
+        prefix = os.path.relpath(os.path.dirname(manifest_file), path)
+        with open(manifest_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if os.path.isdir(path) and prefix != '.':
+                    (root, _, rest) = record['key'].partition('/')
+                    if root != 'heap':
+                        rest = record['key']
+                    record['key'] = f'heap/{prefix}/{rest}'
+                # A file that was created again replaces the old record.
+                records.pop(record['key'], None)
+                records[record['key']] = record
+    return records
+
+
+def compare_records(reference, other):
+    """Find the files whose checksums differ between two sets of records.
+
+    Files that are only in one of the two sets are ignored because a run
+    doesn’t record the files that it skipped.
+
+    Args:
+        reference: Dictionary from `read_manifests()`.
+        other: Dictionary from `read_manifests()`.
+
+    Returns:
+        List of (stage, key, names of differing variables) tuples, sorted by
+        the order of the processing chain (see `get_stage_order()`) and then
+        by the order in `reference`.
+    """
+    differences = list()
+    for (i, (key, record)) in enumerate(reference.items()):
+        if key not in other:
+            continue
+        (a, b) = (record['checksums'], other[key]['checksums'])
+        names = sorted(n for n in set(a) | set(b) if a.get(n) != b.get(n))
+        if names:
+            differences.append((get_stage_order(record['stage']), i,
+                                (record['stage'], key, names)))
+    return [d[2] for d in sorted(differences)]
+
+
+def get_current_records(records):
+    """Calculate the checksums of the recorded files as they are on disk now.
+
+    Files that don’t exist anymore or are empty placeholders of evicted files
+    (see `trace_for_guess.heap`) are left out.
+    """
+    current = dict()
+    for (key, record) in records.items():
+        f = record['file']
+        if not os.path.isfile(f) or os.path.getsize(f) == 0:
+            continue
+        current[key] = dict(record, checksums=get_file_checksums(f))
+    return current
+
+
+def verify(path_a, path_b=None):
+    """Compare the checksums of two runs and report the first difference.
+
+    Args:
+        path_a: Manifest file or heap directory of the reference run.
+        path_b: Manifest file or heap directory of the other run. If `None`,
+            the files of the reference run on disk are checked against its
+            manifest.
+
+    Returns:
+        True if all checksums that both runs recorded are equal.
+
+    Raises:
+        FileNotFoundError: A manifest was not found.
+    """
+    reference = read_manifests(path_a)
+    if path_b is None:
+        cprint(f"Checking {len(reference)} files against the checksums in "
+               f"'{path_a}'...", 'yellow')
+        other = get_current_records(reference)
+    else:
+        other = read_manifests(path_b)
+    common = len(set(reference) & set(other))
+    differences = compare_records(reference, other)
+    if not differences:
+        cprint(f'All {common} common files have the same checksums.',
+               'green')
+        return True
+    (first_stage, _, _) = differences[0]
+    cprint(f'{len(differences)} of {common} common files differ. The first '
+           f"stage with differences is '{first_stage}':", 'red')
+    for (stage, key, names) in differences:
+        if stage != first_stage:
+            break
+        cprint(f"  '{key}': " + ', '.join(names), 'red')
+    return False
@@ -0,0 +1,237 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Execution on a computing cluster: The pipeline is divided into independent
+# shards, which run as separate processes (e.g. SLURM array jobs) on a shared
+# heap directory. The shards are grouped in phases:
+#
+# 1. 'prepare': Regrid template, precipitation standard deviation, and bias
+#    files (one shard).
+# 2. 'split': Crop and split one original TraCE file of one variable into
+#    100-years slices (one shard per file).
+# 3. 'slice': Create the output files of one 100-years slice of one variable
+#    (one shard per variable and slice).
+# 4. 'gather': Zarr stores or concatenation, CO₂ files, and gridlist (one
+#    shard).
+#
+# The 'prepare' and 'split' shards can run at the same time. No two shards
+# write the same file, so they don’t need to know about each other.
+# Each shard is identified by its phase and its index in `get_shards()`.
+
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from termcolor import cprint
+
+from trace_for_guess.filenames import (get_trace_filenames,
+                                       predict_slice_years, read_slice_years)
+
+# The processing phases in the order in which they are run. The phases in one
+# group can run at the same time.
+PHASE_GROUPS = [['prepare', 'split'], ['slice'], ['gather']]
+
+# The output variables that are processed in one 'slice' shard. WET is
+# derived from the debiased PRECT files, so it is created in the same shard
+# as PRECT.
+SHARD_VARS = {'FSDS': ['FSDS'], 'PRECT': ['PRECT', 'WET'],
+              'TREFHT': ['TREFHT']}
+
+# The main script that runs one shard with the option `--shard`.
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'prepare_trace_for_guess')
+
+
+def get_shards(opts):
+    """List all shards of the pipeline.
+
+    The list is derived only from the file names, so it is the same for every
+    process.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+
+    Returns:
+        A dictionary with the phase as key and a list of shard descriptions as
+        value. A shard description is a tuple with the arguments for the
+        phase (see `run_shard()`).
+    """
+    # Import here to avoid a circular import.
+    from trace_for_guess.pipeline import get_directories, get_trace_vars
+    time_range = opts['time_range']
+    # Slice years that were corrected in the split phase (see
+    # `trace_for_guess.pipeline.Pipeline.correct_slice_years()`):
+    corrections = read_slice_years(get_directories(opts)['heap'])
+    shards = {'prepare': [()], 'split': [], 'slice': [], 'gather': [()]}
+    for var in get_trace_vars(opts):
+        for name in get_trace_filenames(var, time_range):
+            shards['split'].append((var, name))
+    for var in SHARD_VARS:
+        for name in get_trace_filenames(var, time_range):
+            for (first_year, _) in predict_slice_years(name, corrections):
+                shards['slice'].append((var, first_year))
+    return shards
+
+
+def get_shard_name(phase, index):
+    """Compose a name for a shard that can be used in file names."""
+    return f'{phase}_{index:05}'
+
+
+def run_shard(opts, phase, index):
+    """Run one shard of the pipeline in this process.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+        phase: One of the phases in `PHASE_GROUPS`.
+        index: Index of the shard in the list of the phase in `get_shards()`.
+
+    Raises:
+        ValueError: There is no such shard.
+    """
+    from trace_for_guess.pipeline import Pipeline
+    shards = get_shards(opts)
+    if phase not in shards:
+        raise ValueError(f"Unknown phase: '{phase}'")
+    if not 0 <= index < len(shards[phase]):
+        raise ValueError(f"Phase '{phase}' has {len(shards[phase])} shards, "
+                         f'but shard index {index} was requested.')
+    args = shards[phase][index]
+    name = get_shard_name(phase, index)
+    cprint(f'Running shard {name}: {args}', 'magenta')
+    pipeline = Pipeline(opts, journal_name=f'journal_{name}.txt',
+                        checksums_name=f'checksums_{name}.jsonl')
+    if phase == 'prepare':
+        pipeline.get_regrid_template()
+        pipeline.get_prec_std_file()
+        pipeline.get_bias_files()
+    elif phase == 'split':
+        (var, trace_filename) = args
+        pipeline.get_split_files(var, trace_filename)
+    elif phase == 'slice':
+        (var, first_year) = args
+        for v in SHARD_VARS[var]:
+            pipeline.get_slice(v, first_year)
+    elif phase == 'gather':
+        output_files = dict()  # key=output variable; value=list of paths
+        for shard_var in SHARD_VARS:
+            for var in SHARD_VARS[shard_var]:
+                output_files[var] = [
+                    pipeline.get_slice(var, first_year)
+                    for (v, first_year) in shards['slice'] if v == shard_var]
+        pipeline.gather(output_files)
+
+
+def get_shard_command(phase, index):
+    """Get the command line arguments to run one shard."""
+    return [sys.executable, SCRIPT, '--shard', phase, str(index)]
+
+
+def write_slurm_scripts(opts, job_dir):
+    """Write SLURM batch scripts for all phases and a script to submit them.
+
+    There is one script per phase. Phases with several shards are submitted
+    as job arrays. Each phase waits for the previous phases to finish
+    successfully. The scripts are run in the current working directory,
+    which needs to contain 'options.yaml'.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'. Additional
+            `#SBATCH` options are taken from `opts['cluster']['slurm']`.
+        job_dir: Directory for the scripts and the log files.
+
+    Returns:
+        Path to the submit script.
+    """
+    shards = get_shards(opts)
+    os.makedirs(job_dir, exist_ok=True)
+    job_dir = os.path.abspath(job_dir)
+    sbatch_options = opts.get('cluster', dict()).get('slurm', list())
+    for group in PHASE_GROUPS:
+        for phase in group:
+            command = get_shard_command(phase, 0)
+            command[-1] = '${SLURM_ARRAY_TASK_ID:-0}'
+            lines = ['#!/bin/bash',
+                     f'#SBATCH --job-name=trace_for_guess_{phase}',
+                     f'#SBATCH --output={job_dir}/{phase}_%a.log']
+            lines += [f'#SBATCH {o}' for o in sbatch_options]
+            lines += [f'cd "{os.getcwd()}"', ' '.join(command)]
+            with open(os.path.join(job_dir, f'{phase}.sh'), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+    lines = ['#!/bin/bash',
+             '# Submit all phases of `prepare_trace_for_guess` as SLURM jobs.',
+             'set -e',
+             f'cd "{job_dir}"']
+    dependency = ''
+    for group in PHASE_GROUPS:
+        job_ids = list()
+        for phase in group:
+            if not shards[phase]:
+                continue
+            array = ''
+            if len(shards[phase]) > 1:
+                array = f'--array=0-{len(shards[phase]) - 1} '
+            lines += [f'{phase}=$(sbatch --parsable {array}{dependency}'
+                      f'{phase}.sh)']
+            job_ids += [f'${phase}']
+        if job_ids:
+            dependency = f'--dependency=afterok:{":".join(job_ids)} '
+    submit_script = os.path.join(job_dir, 'submit.sh')
+    with open(submit_script, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(submit_script, 0o755)
+    for phase in shards:
+        cprint(f"Phase '{phase}': {len(shards[phase])} shard(s)", 'yellow')
+    cprint(f"Created SLURM scripts. Submit them with '{submit_script}'.",
+           'green')
+    return submit_script
+
+
+def run_shard_process(phase, index, log_dir):
+    """Run one shard as a subprocess and write its output to a log file.
+
+    Returns:
+        True if the shard finished successfully.
+    """
+    log_file = os.path.join(log_dir, get_shard_name(phase, index) + '.log')
+    with open(log_file, 'w') as log:
+        process = subprocess.run(get_shard_command(phase, index),
+                                 stdout=log, stderr=subprocess.STDOUT)
+    if process.returncode != 0:
+        cprint(f"Shard {get_shard_name(phase, index)} failed. See log file "
+               f"'{log_file}'.", 'red')
+    return process.returncode == 0
+
+
+def run_local(opts, job_dir, workers=None):
+    """Run all shards as local subprocesses like a cluster scheduler would.
+
+    This is useful to test the sharding on a single machine. The phases are
+    run in the same order and with the same dependencies as the SLURM jobs
+    from `write_slurm_scripts()`.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+        job_dir: Directory for the log files.
+        workers: Maximum number of shards running at the same time. By
+            default the number of CPUs.
+
+    Raises:
+        RuntimeError: A shard failed. The following phases are not run.
+    """
+    shards = get_shards(opts)
+    os.makedirs(job_dir, exist_ok=True)
+    for group in PHASE_GROUPS:
+        jobs = [(phase, i) for phase in group
+                for i in range(len(shards[phase]))]
+        cprint(f"Running {len(jobs)} shard(s) of phase(s) {', '.join(group)}.",
+               'magenta')
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            success = list(pool.map(
+                lambda job: run_shard_process(job[0], job[1], job_dir), jobs))
+        if not all(success):
+            raise RuntimeError(f'{success.count(False)} shard(s) failed in '
+                               f"phase(s) {', '.join(group)}.")
+    cprint('All shards finished successfully.', 'green')
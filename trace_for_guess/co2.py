@@ -7,7 +7,9 @@ import os
 import subprocess
 from termcolor import cprint
 
-from trace_for_guess.filenames import get_co2_filename
+from trace_for_guess.filenames import (get_co2_filename,
+                                       get_years_of_new_trace_name)
+from trace_for_guess.journal import atomic_output
 from trace_for_guess.netcdf_metadata import get_metadata_from_trace_file
 from trace_for_guess.skip import skip
 
@@ -52,7 +54,11 @@ def create_co2_files(trace_files, out_dir):
     for f in trace_files:
         if not os.path.isfile(f):
             raise FileNotFoundError(f"Input file not found: '{f}'")
-        metadata = get_metadata_from_trace_file(f)
+        # Only open the file if the years cannot be read from the name.
+        try:
+            metadata = get_years_of_new_trace_name(f)
+        except ValueError:
+            metadata = get_metadata_from_trace_file(f)
         basename = get_co2_filename(metadata['first_year'],
                                     metadata['last_year'])
         co2_files[f] = os.path.join(out_dir, basename)
@@ -61,7 +67,8 @@ def create_co2_files(trace_files, out_dir):
     try:
         for f in trace_files:
             co2_vals = get_co2_values(f)
-            with open(co2_files[f], 'w') as out:
+            with atomic_output(co2_files[f]) as tmp_file, \
+                    open(tmp_file, 'w') as out:
                 for year in co2_vals:
                     # The CO₂ values in the TraCE file are by a factor of 10^6
                     # smalller # than what LPJ-GUESS expects, that’s why we
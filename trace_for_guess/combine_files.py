@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import os
+
+from termcolor import cprint
+
+from trace_for_guess.journal import atomic_output
+
+# Number of time steps that are read and written at once (10 years).
+TIME_CHUNK = 120
+
+
+def is_field(variable):
+    """Whether a netCDF4 variable is a map (with latitude and longitude)."""
+    return 'lat' in variable.dimensions and 'lon' in variable.dimensions
+
+
+def combine_files(in_files, out_file, out_var, func, attributes=None):
+    """Calculate a new variable from variables in several NetCDF files.
+
+    The input files are read in chunks of `TIME_CHUNK` time steps, so only a
+    small part of the data is in memory at once. The output file contains
+    only the new variable and all variables of the first input file that are
+    not maps (coordinates, time bounds, 'co2vmr', etc.). The input variables
+    are *not* copied into the output file.
+
+    Args:
+        in_files: Dictionary with the variable name as key and the path to
+            the NetCDF file that contains it as value. The first file serves
+            as template for dimensions, attributes, and the data type.
+        out_file: Path to the output file (will be overwritten).
+        out_var: Name of the new variable.
+        func: Function that takes the input variables as keyword arguments
+            (masked numpy arrays) and returns the new variable.
+        attributes: Optional dictionary with NetCDF attributes for `out_var`.
+            By default the attributes of the first input variable are used.
+
+    Returns:
+        The output file (equals `out_file`).
+
+    Raises:
+        FileNotFoundError: One of the input files does not exist.
+    """
+    import netCDF4
+    import numpy as np
+    for f in in_files.values():
+        if not os.path.isfile(f):
+            raise FileNotFoundError(f"Input file does not exist: '{f}'")
+    out_dir = os.path.dirname(out_file)
+    if out_dir and not os.path.isdir(out_dir):
+        cprint(f"Directory '{out_dir}' does not exist yet. I will create it.",
+               'yellow')
+        os.makedirs(out_dir)
+    if attributes is None:
+        attributes = dict()
+    datasets = {v: netCDF4.Dataset(f, 'r') for (v, f) in in_files.items()}
+    try:
+        template_var = list(in_files)[0]
+        template = datasets[template_var]
+        with atomic_output(out_file) as tmp_file, \
+                netCDF4.Dataset(tmp_file, 'w',
+                                format=template.data_model) as out:
+            out.setncatts({a: template.getncattr(a)
+                           for a in template.ncattrs()})
+            for name, dim in template.dimensions.items():
+                out.createDimension(
+                    name, None if dim.isunlimited() else len(dim))
+            for name, var in template.variables.items():
+                if is_field(var):
+                    continue
+                new = out.createVariable(name, var.datatype, var.dimensions)
+                new.setncatts({a: var.getncattr(a) for a in var.ncattrs()})
+                new[:] = var[:]
+            in_var = template.variables[template_var]
+            fill_value = getattr(in_var, '_FillValue', None)
+            new = out.createVariable(out_var, in_var.datatype,
+                                     in_var.dimensions, fill_value=fill_value)
+            new.setncatts({a: in_var.getncattr(a) for a in in_var.ncattrs()
+                           if a != '_FillValue'})
+            new.setncatts(attributes)
+            time_steps = in_var.shape[0]
+            for start in range(0, time_steps, TIME_CHUNK):
+                end = min(start + TIME_CHUNK, time_steps)
+                arrays = {v: datasets[v].variables[v][start:end]
+                          for v in in_files}
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    new[start:end] = func(**arrays)
+    finally:
+        for ds in datasets.values():
+            ds.close()
+    return out_file
@@ -9,6 +9,7 @@ import subprocess
 from termcolor import cprint
 import yaml
 
+from trace_for_guess.journal import atomic_output
 from trace_for_guess.skip import skip
 
 
@@ -42,7 +43,7 @@ def compress_and_chunk(in_file, out_file):
     chunk_time = opts['chunks']['time']
     chunk_cache = opts['chunks']['cache']
     cprint(f"Compressing and chunking file '{in_file}'...", 'yellow')
-    try:
+    with atomic_output(out_file) as tmp_file:
         subprocess.run(['ncks',
                         '--deflate', str(compression_level),
                         '--chunk_dimension', f'lon,{chunk_lon}',
@@ -50,12 +51,7 @@ def compress_and_chunk(in_file, out_file):
                         '--chunk_dimension', f'time,{chunk_time}',
                         '--chunk_cache', str(chunk_cache),
                         '--fl_fmt', 'netcdf4',
-                        in_file, out_file], check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+                        in_file, tmp_file], check=True)
     assert(os.path.isfile(out_file))
     cprint(f"Successfully created file: '{out_file}'", 'green')
     return out_file
@@ -9,6 +9,7 @@ import subprocess
 
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
 from trace_for_guess.skip import skip
 
 
@@ -36,14 +37,9 @@ def cat_files(filelist, out_file):
     cprint('Concatenating files:', 'yellow')
     for f in filelist:
         cprint('\t' + f, 'yellow')
-    try:
-        subprocess.run(['cdo', 'mergetime'] + filelist + [out_file],
+    with atomic_output(out_file) as tmp_file:
+        subprocess.run(['cdo', 'mergetime'] + filelist + [tmp_file],
                        check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
     assert os.path.isfile(out_file)
     cprint(f"Created file '{out_file}'.", 'green')
     return out_file
@@ -4,16 +4,19 @@
 
 import json
 import os
+import re
 import shutil
 import subprocess
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.resources import reserve
 from trace_for_guess.skip import skip
 
 
-def adjust_longitude(netcdf_file, lon):
+def adjust_longitude(netcdf_file, lon, file_range=None):
     """Convert longitude to correct range, matching the NetCDF file.
 
     If the file’s longitude is in [0,360) °E, and `lon` is negative (in
@@ -26,6 +29,8 @@ def adjust_longitude(netcdf_file, lon):
     Args:
         netcdf_file: Path to NetCDF file.
         lon: Longitude value.
+        file_range: Optional result of `get_longitude_range()` for
+            `netcdf_file`. If it is not given, the file is probed.
 
     Returns:
         Longitude value in correct range.
@@ -39,7 +44,8 @@ def adjust_longitude(netcdf_file, lon):
     if lon < -180 or lon >= 360:
         raise ValueError("Longitude value is out of any supported range: %.2f"
                          % lon)
-    file_range = get_longitude_range(netcdf_file)
+    if file_range is None:
+        file_range = get_longitude_range(netcdf_file)
     # Convert longitude to [-180,+180) °E format.
     if min(file_range) < 0 and lon > 180:
         return lon - 360
@@ -50,7 +56,7 @@ def adjust_longitude(netcdf_file, lon):
         return lon
 
 
-def crop_file(in_file, out_file, ext):
+def crop_file(in_file, out_file, ext, lon_range=None):
     """Crop a NetCDF file to give rectangle using NCO.
 
     The file is automatically converted to [0,360] °E longitude format.
@@ -61,6 +67,8 @@ def crop_file(in_file, out_file, ext):
         ext: The rectangular region (extent) to crop to, given as a list of
             [lon1, lon2, lat1, lat2]. Longitude in [0,360) °E and latitude in
             [-90,+90] °N.
+        lon_range: Optional result of `get_longitude_range()` for `in_file`.
+            If it is not given, the file is probed with `ncks`.
 
     Returns:
         Name of output file (same as `out_file`).
@@ -82,13 +90,15 @@ def crop_file(in_file, out_file, ext):
     cprint("Cropping file '%s'..." % in_file, 'yellow')
     if shutil.which("ncks") is None:
         raise RuntimeError("Executable `ncks` not found.")
-    try:
-        # ADJUST LONGITUDE
-        ext_adj = list()
-        ext_adj[:] = ext
-        ext_adj[0] = adjust_longitude(in_file, ext[0])
-        ext_adj[1] = adjust_longitude(in_file, ext[1])
-        # CROP
+    # ADJUST LONGITUDE
+    if lon_range is None:
+        lon_range = get_longitude_range(in_file)
+    ext_adj = list()
+    ext_adj[:] = ext
+    ext_adj[0] = adjust_longitude(in_file, ext[0], lon_range)
+    ext_adj[1] = adjust_longitude(in_file, ext[1], lon_range)
+    # CROP
+    with reserve('crop', [in_file]), atomic_output(out_file) as tmp_file:
         subprocess.run(["ncks",
                         "--overwrite",
                         "--dimension", "lon,%.2f,%.2f" % (ext_adj[0],
@@ -96,7 +106,7 @@ def crop_file(in_file, out_file, ext):
                         "--dimension", "lat,%.2f,%.2f" % (ext_adj[2],
                                                           ext_adj[3]),
                         in_file,
-                        out_file], check=True)
+                        tmp_file], check=True)
         # ROTATE LONGITUDE
         # See here for the documentation about rotating longitude:
         # http://nco.sourceforge.net/nco.html#msa_usr_rdr
@@ -106,21 +116,13 @@ def crop_file(in_file, out_file, ext):
         # ordered correctly from East to West.
         # Note that we rotate after cropping for performance reasons. This way
         # only the cropped grid cells need to be rotated.
-        subprocess.run(['ncap2',
-                        '--overwrite',
-                        '--script', 'where(lon < 0) lon=lon+360',
-                        out_file, out_file], check=True)
-    except Exception:
-        print(f'DEBUG: ext = {ext}')
-        print(f'DEBUG: ext_adj = {ext_adj}')
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        # Remove temporary file created by ncks.
-        for g in glob(f'{out_file}.pid*.ncks.tmp'):
-            cprint(f"Removing file '{g}'.", 'red')
-            os.remove(g)
-        raise
+        # If the cropped region has no negative longitudes (e.g. all TraCE
+        # files, which are in [0,360) °E already), there is nothing to rotate.
+        if min(ext_adj[0], ext_adj[1]) < 0:
+            subprocess.run(['ncap2',
+                            '--overwrite',
+                            '--script', 'where(lon < 0) lon=lon+360',
+                            tmp_file, tmp_file], check=True)
     if not os.path.isfile(out_file):
         raise RuntimeError("Cropping with `ncks` failed: No output file "
                            "created.")
@@ -128,14 +130,60 @@ def crop_file(in_file, out_file, ext):
     return out_file
 
 
-def crop_file_list(filelist, out_dir, ext):
+def get_crop_operator(ext):
+    """Compose a CDO operator that crops to the given rectangle.
+
+    The operator can be chained with other CDO operators (see
+    `trace_for_guess.cdo_chain`) instead of running `crop_file()` with an
+    intermediate file. CDO returns the longitude in the requested range, so
+    the result is in [0,360] °E just like with `crop_file()`.
+
+    Args:
+        ext: The rectangular region (extent) to crop to, given as a list of
+            [lon1, lon2, lat1, lat2]. Longitude in [0,360) °E and latitude in
+            [-90,+90] °N.
+
+    Returns:
+        A string with the CDO operator `sellonlatbox`.
+
+    >>> get_crop_operator([130, 230, 50, 80])
+    'sellonlatbox,130.00,230.00,50.00,80.00'
+
+    Circle around 0° longitude:
+    >>> get_crop_operator([350, 40, -20, 20])
+    'sellonlatbox,350.00,400.00,-20.00,20.00'
+    """
+    lon1, lon2, lat1, lat2 = ext
+    if lon2 < lon1:
+        lon2 += 360
+    return 'sellonlatbox,%.2f,%.2f,%.2f,%.2f' % (lon1, lon2, lat1, lat2)
+
+
+def get_file_family(filename):
+    """Get a name for all files that differ only by numbers in their name.
+
+    Files of one family (e.g. all TraCE files of one variable or all CRU-JRA
+    files) are assumed to have the same grid.
+
+    >>> get_file_family('/data/crujra.V1.1.5d.pre.1958.365d.noc.nc')
+    'crujra.V#.#.#d.pre.#.#d.noc.nc'
+    """
+    return re.sub(r'\d+', '#', os.path.basename(filename))
+
+
+def crop_file_list(filelist, out_dir, ext, workers=None):
     """Crop all files in the list and store the output files in a directory.
 
+    The files are cropped in parallel. The longitude range of the grid is
+    probed only once for each file family (see `get_file_family()`).
+
     Args:
         filelist: List of input NetCDF file paths.
         out_dir: Path to output directory.
         ext: The rectangular region (extent) to crop to, given as a list of
         [lon1, lon2, lat1, lat2].
+        workers: Maximum number of parallel `ncks` processes. By default the
+            number of CPUs.
 
     Returns:
         List of paths to cropped files.
@@ -145,25 +193,25 @@ def crop_file_list(filelist, out_dir, ext):
                'yellow')
         os.makedirs(out_dir)
         assert os.path.isdir(out_dir), 'Dir was not created.'
-    result_list = list()
-    for f in filelist:
-        try:
-            out_file = os.path.join(out_dir, os.path.basename(f))
-            result_list += [crop_file(f, out_file, ext)]
-            assert os.path.isfile(result_list[-1]), 'Cropped file not created.'
-        except Exception:
-            if os.path.isfile(out_file):
-                cprint(f"Removing file '{out_file}'.", 'red')
-                os.remove(out_file)
-            # Remove temporary file created by ncks.
-            for g in glob(f'{out_file}.pid*.ncks.tmp'):
-                cprint(f"Removing file '{g}'.", 'red')
-                os.remove(g)
-            raise
-    assert len(filelist) == len(result_list), \
-        'Lengths of input and return list don’t match up: '\
-        f'len(filelist)={len(filelist)} does not equal '\
-        f'len(result_list)={len(result_list)}'
+    result_list = [os.path.join(out_dir, os.path.basename(f))
+                   for f in filelist]
+    jobs = [(f, out_file) for (f, out_file) in zip(filelist, result_list)
+            if not skip(f, out_file)]
+    lon_ranges = dict()  # key=file family; value=longitude range
+    for f, out_file in jobs:
+        family = get_file_family(f)
+        if family not in lon_ranges:
+            lon_ranges[family] = get_longitude_range(f)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(crop_file, f, out_file, ext,
+                               lon_ranges[get_file_family(f)])
+                   for (f, out_file) in jobs]
+        # Raise the first error, if any. `crop_file()` has already cleaned up
+        # its output.
+        for future in futures:
+            future.result()
+    for f in result_list:
+        assert os.path.isfile(f), f"Cropped file not created: '{f}'"
     return result_list
 
 
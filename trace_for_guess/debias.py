@@ -3,11 +3,14 @@
 # SPDX-License-Identifier: MIT
 
 import os
-import subprocess
 
-import xarray as xr
 from termcolor import cprint
 
+from trace_for_guess.bias_methods import apply_bias, get_bias_method
+from trace_for_guess.combine_files import combine_files
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.netcdf_io import open_dataarray, open_dataset
+from trace_for_guess.resources import reserve
 from trace_for_guess.skip import skip
 
 
@@ -25,9 +28,11 @@ def debias_trace_file(trace_file, bias_file, out_file):
 
     Raises:
         FileNotFoundError: `trace_file` or `bias_file` doesn’t exist.
-        NotImplementedError: The NetCDF variable in the TraCE file is unknown.
+        NotImplementedError: The variable of the bias file is not in the
+            TraCE file or has no bias correction.
         RuntimeError: No output file was produced.
     """
+    import numpy as np
     if not os.path.isfile(bias_file):
         raise FileNotFoundError("Bias file does not exist: '%s'" % bias_file)
     if not os.path.isfile(trace_file):
@@ -41,48 +46,32 @@ def debias_trace_file(trace_file, bias_file, out_file):
                'yellow')
         os.makedirs(out_dir)
     cprint(f"Debiasing TraCE file '{trace_file}'...", 'yellow')
-    try:
-        with xr.open_dataset(trace_file, decode_times=False) as trace:
-            # Find the variable in the TraCE file.
-            if 'TREFHT' in trace.data_vars:
-                var = 'TREFHT'
-            elif 'PRECT' in trace.data_vars:
-                var = 'PRECT'
-            elif 'CLDTOT' in trace.data_vars:
-                var = 'CLDTOT'
-            else:
-                raise NotImplementedError("Could not find known variable in "
-                                          "TraCE file: '%s'." % trace_file)
-            # The bias map as xarray Dataset.
-            bias = xr.open_dataarray(bias_file, decode_times=False).load()
-            # How many years are in the monthly TraCE file?
-            years = len(trace[var]) // 12
-            # Repeat the monthly bias values for each year.
-            bias = xr.concat([bias] * years, dim='time')
-            # Overwrite the time dimension. If it does not match the TraCE
-            # file, the arithmetic operation does not work.
-            bias.time.values = trace.time.values
-            # Apply the bias to the TraCE data.
-            if var == "TREFHT":
-                output = trace[var] - bias
-            elif var == "PRECT":
-                output = trace[var] / bias
-            elif var == 'CLDTOT':
-                output = trace[var]**bias
-            else:
-                raise NotImplementedError("No bias correction defined for "
-                                          "variable '%s'." % var)
-            output.to_netcdf(out_file, mode='w', engine='netcdf4')
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+    with reserve('debias', [trace_file, bias_file]), \
+            atomic_output(out_file) as tmp_file, \
+            open_dataset(trace_file) as trace, \
+            open_dataarray(bias_file) as bias:
+        # The bias variable is named like the TraCE variable.
+        var = bias.name
+        if var not in trace.data_vars:
+            raise NotImplementedError("Could not find variable '%s' of the "
+                                      "bias file in TraCE file: '%s'." %
+                                      (var, trace_file))
+        # Correct the raw values in place instead of aligning the bias with
+        # the time axis of the TraCE file. The values of a memory-mapped
+        # NetCDF3 file are read-only, so they are corrected in a copy.
+        output = trace[var].copy(data=np.array(trace[var].values))
+        apply_bias(output.values, bias.values, get_bias_method(bias))
+        output.to_netcdf(tmp_file, mode='w', engine='netcdf4')
     assert os.path.isfile(out_file), f"No output file created: '{out_file}'"
     cprint(f"Successfully created '{out_file}'.", 'green')
     return out_file
 
 
+def get_fsds(FSDSC, FSDSCL, CLDTOT):
+    """Calculate FSDS from arrays of FSDSC, FSDSCL, and debiased CLDTOT."""
+    return (1 - CLDTOT) * FSDSC + CLDTOT * FSDSCL
+
+
 def debias_fsds_file(fsdsc_file, fsdscl_file, cldtot_file, out_file):
     """Apply bias-correction to an FSDS TraCE-21ka file.
 
@@ -119,18 +108,16 @@ def debias_fsds_file(fsdsc_file, fsdscl_file, cldtot_file, out_file):
                'yellow')
         os.makedirs(out_dir)
     cprint(f"Creating debiased FSDS file in '{out_file}'...", 'yellow')
-    try:
-        subprocess.run(['ncks', '--append', fsdsc_file, out_file], check=True)
-        subprocess.run(['ncks', '--append', fsdscl_file, out_file], check=True)
-        subprocess.run(['ncks', '--append', cldtot_file, out_file], check=True)
-        script = 'FSDS = (1 - CLDTOT) * FSDSC + CLDTOT * FSDSCL'
-        subprocess.run(['ncap2', '--append', '--script', script, out_file],
-                       check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+    # Only FSDS is written into the output file. The other variables of the
+    # FSDSC file (e.g. 'co2vmr') are copied.
+    combine_files(
+        in_files={'FSDSC': fsdsc_file, 'FSDSCL': fsdscl_file,
+                  'CLDTOT': cldtot_file},
+        out_file=out_file,
+        out_var='FSDS',
+        func=get_fsds,
+        attributes={'long_name': 'Downwelling solar flux at surface'}
+    )
     assert os.path.isfile(out_file), f"No output file created: '{out_file}'"
     cprint(f"Successfully created '{out_file}'.", 'green')
     return out_file
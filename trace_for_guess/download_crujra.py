@@ -27,8 +27,10 @@ if which('wget') is None:
 
 url_prefix = "https://vesg.ipsl.upmc.fr/thredds/fileServer/work/p529viov/crujra/"
 
-for year in range(1958, 2018):
-    filename = "crujra.V1.1.5d.pre.%d.365d.noc.nc.gz" % year
+# The temperature ('tmp') is only needed for quantile mapping of TREFHT (see
+# `bias_methods` in "options.yaml").
+for (var, year) in [(v, y) for v in ['pre', 'tmp'] for y in range(1958, 2018)]:
+    filename = "crujra.V1.1.5d.%s.%d.365d.noc.nc.gz" % (var, year)
     cprint("Downloading '%s'..." % filename, 'yellow')
     run(["wget",
          "--directory-prefix=%s" % folder,
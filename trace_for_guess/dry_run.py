@@ -0,0 +1,249 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import re
+
+from termcolor import cprint
+
+from trace_for_guess.bias_methods import get_method_name
+from trace_for_guess.calculate_bias import get_bias_file
+from trace_for_guess.filenames import (get_new_trace_name, get_trace_filenames,
+                                       predict_slice_years, read_slice_years)
+from trace_for_guess.find_input import find_files
+from trace_for_guess.fused_chain import INPUT_VARS
+from trace_for_guess.heap import HeapManager
+from trace_for_guess.pipeline import (OUTPUT_VARS, get_directories,
+                                      get_trace_vars, use_fused_chain)
+from trace_for_guess.weather_generator import DAILY_DIR
+
+
+class Planner:
+    """Decide which processing stages would run, based on timestamps only.
+
+    The decision follows the rules of `trace_for_guess.skip.skip()`, but
+    nothing is removed and no subprocess is started. An output file counts as
+    changed if one of its input files will be changed by an earlier stage.
+
+    Args:
+        heap_manager: A `HeapManager` object to look up evicted files. It
+            must not be activated.
+    """
+
+    def __init__(self, heap_manager):
+        self.heap_manager = heap_manager
+        self.stages = list()  # List of dictionaries, see `add()`.
+        self.changed = set()  # All output files that will be (re-)created.
+
+    def get_reason(self, in_files, out_files):
+        """Explain why a stage needs to run.
+
+        Returns:
+            A string with the reason or `None` if the stage can be skipped.
+        """
+        for i in in_files:
+            if i in self.changed:
+                return f"input '{os.path.basename(i)}' will change"
+            if not os.path.isfile(i):
+                return f"input '{i}' not found"
+        for o in out_files:
+            if (self.heap_manager.is_evicted(o) and
+                    not self.heap_manager.products_are_current(o)):
+                return 'evicted file is needed again'
+            if not os.path.isfile(o):
+                return 'output missing'
+        for i in in_files:
+            for o in out_files:
+                if os.path.getmtime(o) <= os.path.getmtime(i):
+                    return f"input '{os.path.basename(i)}' is newer"
+        return None
+
+    def add(self, stage, in_files, out_files):
+        """Plan one processing stage.
+
+        Args:
+            stage: Short name of the processing stage.
+            in_files: List of files that are read by the stage.
+            out_files: List of files that are created by the stage.
+
+        Returns:
+            The list `out_files`.
+        """
+        reason = self.get_reason(in_files, out_files)
+        if reason is not None:
+            self.changed.update(out_files)
+        self.stages += [{'stage': stage,
+                         'out_files': out_files,
+                         'run': reason is not None,
+                         'reason': reason or 'up-to-date'}]
+        return out_files
+
+
+def find_input_file(filename):
+    """Find an input file without failing if it doesn’t exist.
+
+    Returns:
+        The path to the file or, if it wasn’t found, the bare file name.
+    """
+    try:
+        return find_files(filename)
+    except OSError:
+        return filename
+
+
+def make_plan(opts):
+    """Plan which stages a full run would execute and why.
+
+    The plan is derived only from file names and timestamps. The names of
+    the 100-years slices are predicted from the original TraCE file names
+    (see `predict_slice_years()`) or, if a previous run found that they
+    differ from the time axis, from the heap. Preparing the bias files and the
+    precipitation standard deviation is only checked by the existence of the
+    final files. Joining of output files, Zarr stores, and CO₂ files are not
+    part of the plan.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+
+    Returns:
+        A list of dictionaries with the keys 'stage', 'out_files', 'run', and
+        'reason', in the order of execution.
+    """
+    dirs = get_directories(opts)
+    heap_manager = HeapManager(dirs['heap'], mode=opts['heap_eviction'])
+    planner = Planner(heap_manager)
+    corrections = read_slice_years(dirs['heap'])
+    time_range = opts['time_range']
+
+    template = planner.add('prepare', [], [os.path.join(
+        dirs['cropped_dir'], 'regrid_template_file.nc')])[0]
+    prec_std = planner.add('prepare', [], [os.path.join(dirs['heap'],
+                                                        'prec_std.nc')])[0]
+    bias_files = dict()
+    for var in opts['cru_vars']:
+        bias_files[var] = planner.add('prepare', [], [get_bias_file(
+            dirs['heap'], var, get_method_name(var, opts.get('bias_methods')))
+        ])[0]
+
+    def get_path(dir_name, var, first, last):
+        """Path of an intermediary or output file of one slice."""
+        return os.path.join(dirs[dir_name],
+                            get_new_trace_name(first, last, var))
+
+    fused = use_fused_chain(opts)
+    fused_dir = 'out_dir' if opts['output_format'] == 'netcdf' else \
+        'final_time_dir'
+    split_paths = dict()  # key=(TraCE variable, first year); value=path
+    # key=(output variable, first year, last year); value=monthly slice file
+    slice_paths = dict()
+
+    for var in get_trace_vars(opts):
+        for name in get_trace_filenames(var, time_range):
+            if var == 'PRECT':
+                f = planner.add('add_prect', [
+                    find_input_file(re.sub('PRECT', v, name))
+                    for v in ['PRECC', 'PRECL']
+                ], [os.path.join(dirs['heap_input'], name)])[0]
+            elif var == 'FSDSCL':
+                f = planner.add('fsdscl', [
+                    find_input_file(re.sub('FSDSCL', v, name))
+                    for v in ['CLDTOT', 'FSDS', 'FSDSC']
+                ], [os.path.join(dirs['heap_input'], name)])[0]
+            else:
+                f = find_input_file(name)
+            f = planner.add('crop', [f], [os.path.join(dirs['cropped_dir'],
+                                                       name)])[0]
+            f = planner.add('time', [f], [os.path.join(dirs['time_unit_dir'],
+                                                       name)])[0]
+            slices = predict_slice_years(name, corrections)
+            stub = os.path.join(dirs['split_dir'], os.path.splitext(name)[0])
+            split_files = planner.add('split', [f], [
+                f'{stub}_{i:06}.nc' for i in range(len(slices))
+            ])
+            for split, (first, last) in zip(split_files, slices):
+                split_paths[(var, first)] = split
+                if fused:
+                    # All stages of the slice run in memory (see
+                    # `trace_for_guess.fused_chain`).
+                    if var not in INPUT_VARS:
+                        continue
+                    in_files = [split_paths[(v, first)]
+                                for v in INPUT_VARS[var]] + [template]
+                    in_files += [bias_files[v] for v in INPUT_VARS[var]
+                                 if v in bias_files]
+                    out_vars = [var]
+                    if var == 'PRECT':
+                        in_files.append(prec_std)
+                        out_vars.append('WET')
+                    for v in out_vars:
+                        slice_paths[(v, first, last)] = get_path(
+                            fused_dir, v, first, last)
+                    planner.add('slice', in_files, [
+                        slice_paths[(v, first, last)] for v in out_vars])
+                    continue
+                # The rescaled FSDS file itself is not needed.
+                if var != 'FSDS':
+                    rescaled = planner.add(
+                        'rescale', [split, template],
+                        [get_path('rescaled_dir', var, first, last)])[0]
+                if var in bias_files:
+                    f = planner.add(
+                        'debias', [rescaled, bias_files[var]],
+                        [get_path('debiased_dir', var, first, last)])[0]
+                elif var == 'FSDS':
+                    f = planner.add('debias', [
+                        get_path('rescaled_dir', 'FSDSC', first, last),
+                        get_path('rescaled_dir', 'FSDSCL', first, last),
+                        get_path('debiased_dir', 'CLDTOT', first, last)
+                    ], [get_path('debiased_dir', var, first, last)])[0]
+                if var not in OUTPUT_VARS:
+                    continue
+                days_files = [planner.add(
+                    'days', [f], [get_path('final_time_dir', var, first, last)]
+                )[0]]
+                if var == 'PRECT':
+                    f = planner.add(
+                        'wet_days', [f, prec_std],
+                        [get_path('wet_days_dir', 'WET', first, last)])[0]
+                    days_files += [planner.add(
+                        'days', [f],
+                        [get_path('final_time_dir', 'WET', first, last)])[0]]
+                for (v, f) in zip([var, 'WET'], days_files):
+                    slice_paths[(v, first, last)] = f
+                if opts['output_format'] != 'netcdf':
+                    continue
+                for (v, f) in zip([var, 'WET'], days_files):
+                    slice_paths[(v, first, last)] = planner.add(
+                        'compress', [f], [os.path.join(
+                            dirs['out_dir'], os.path.basename(f))])[0]
+    if opts.get('weather_generator', dict()).get('daily') == 'yes':
+        for (var, first, last) in slice_paths:
+            trefht = slice_paths.get(('TREFHT', first, last))
+            if var != 'PRECT' or trefht is None:
+                continue
+            in_files = [slice_paths[(var, first, last)], trefht]
+            planner.add('daily', in_files + [prec_std], [
+                os.path.join(dirs['out_dir'], DAILY_DIR, os.path.basename(f))
+                for f in in_files])
+    planner.add('gridlist', [template], [os.path.join(dirs['out_dir'],
+                                                      'gridlist.txt')])
+    return planner.stages
+
+
+def print_plan(stages):
+    """Print the stages that would run and a summary.
+
+    Args:
+        stages: List of stages as returned by `make_plan()`.
+    """
+    for s in stages:
+        if not s['run']:
+            continue
+        color = 'red' if 'not found' in s['reason'] else 'yellow'
+        names = ', '.join(os.path.basename(f) for f in s['out_files'][:2])
+        if len(s['out_files']) > 2:
+            names += ', ...'
+        cprint(f"{s['stage']:<10} {names} ({s['reason']})", color)
+    count = len([s for s in stages if s['run']])
+    cprint(f'Dry run: {count} of {len(stages)} stages would run.', 'magenta')
@@ -2,12 +2,19 @@
 #
 # SPDX-License-Identifier: MIT
 
+import fcntl
+import json
 import os
 import re
 
 from trace_for_guess.netcdf_metadata import (get_metadata_from_trace_file,
                                              get_metadata_from_trace_files)
 
+# Name of the file in the heap directory with the years of the 100-years
+# slices of those original TraCE files whose time axis doesn’t match the years
+# in the file name (see `save_slice_years()`).
+SLICE_YEARS_NAME = 'slice_years.json'
+
 
 def get_cru_filenames():
     """Create list of original CRU files between 1900 and 1990."""
@@ -19,9 +26,13 @@ def get_cru_filenames():
             years_vars]
 
 
-def get_crujra_filenames():
-    """Create a list of all original CRU-JRA filenames from 1958 to 1990."""
-    return [f'crujra.V1.1.5d.pre.{year}.365d.noc.nc' for year in
+def get_crujra_filenames(var='pre'):
+    """Create a list of all original CRU-JRA filenames from 1958 to 1990.
+
+    >>> get_crujra_filenames('tmp')[-1]
+    'crujra.V1.1.5d.tmp.1990.365d.noc.nc'
+    """
+    return [f'crujra.V1.1.5d.{var}.{year}.365d.noc.nc' for year in
             range(1958, 1991)]
 
 
@@ -59,6 +70,101 @@ def get_time_range_of_trace_file(filename):
                          f"pattern: '{filename}'")
 
 
+def get_model_years_of_trace_file(filename):
+    """Get the range of model years only from given TraCE-21ka filename.
+
+    Model years are counted from 22,000 years BP (the beginning of the TraCE
+    simulation) and are used in the names of the output files.
+
+    Args:
+        filename: The base filename or path of the original TraCE file.
+
+    Returns:
+        A list with two integers: first and last model year.
+
+    Raises:
+        ValueError: If `filename` does not match the original TraCE-21ka naming
+            pattern as expected.
+
+    >>> get_model_years_of_trace_file(
+    ...     'trace.36.400BP-1990CE.cam2.h0.PRECT.2160101-2204012.nc')
+    [21601, 22040]
+    """
+    match_obj = re.match(r'.*\.(\d{5})\d\d-(\d{5})\d\d\.nc$',
+                         os.path.basename(filename))
+    if not match_obj:
+        raise ValueError("Given file name does not match TraCE-21ka naming "
+                         f"pattern: '{filename}'")
+    return [int(match_obj.group(1)), int(match_obj.group(2))]
+
+
+def predict_slice_years(filename, corrections=None):
+    """Predict the years of the 100-years slices of an original TraCE file.
+
+    This is what `split_file()` will produce, but derived only from the file
+    name without reading the file. The model year in the file name can
+    differ by one year from the year in the time axis. The years of files
+    whose split files have been found to differ are taken from
+    `corrections`.
+
+    Args:
+        filename: The base filename or path of the original TraCE file.
+        corrections: Optional dictionary from `read_slice_years()`.
+
+    Returns:
+        A list of tuples, each with the first and last model year of a slice.
+
+    >>> predict_slice_years(
+    ...     'trace.23.08700-08501BP.cam2.h0.PRECT.1330101-1350012.nc')
+    [(13301, 13400), (13401, 13500)]
+    """
+    if corrections and os.path.basename(filename) in corrections:
+        return corrections[os.path.basename(filename)]
+    first, last = get_model_years_of_trace_file(filename)
+    return [(y, min(y + 99, last)) for y in range(first, last + 1, 100)]
+
+
+def read_slice_years(heap_dir):
+    """Read the corrected years of the slices from the heap directory.
+
+    Args:
+        heap_dir: Path to the heap directory.
+
+    Returns:
+        Dictionary with the base name of the original TraCE file as key and
+        a list of tuples like from `predict_slice_years()` as value.
+    """
+    path = os.path.join(heap_dir, SLICE_YEARS_NAME)
+    if not os.path.isfile(path):
+        return dict()
+    with open(path) as f:
+        return {name: [tuple(y) for y in years]
+                for (name, years) in json.load(f).items()}
+
+
+def save_slice_years(heap_dir, filename, years):
+    """Remember the years of the slices of one original TraCE file.
+
+    The file in the heap is locked while it is changed, so that parallel
+    processes (e.g. cluster shards) don’t overwrite each other’s entries.
+
+    Args:
+        heap_dir: Path to the heap directory.
+        filename: The base filename or path of the original TraCE file.
+        years: A list of tuples with the first and last model year of each
+            split file, as read from their time axes.
+    """
+    path = os.path.join(heap_dir, SLICE_YEARS_NAME)
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        corrections = read_slice_years(heap_dir)
+        corrections[os.path.basename(filename)] = [tuple(y) for y in years]
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(corrections, f, indent=1)
+        os.replace(tmp_file, path)
+
+
 def get_all_trace_filenames(variables: list):
     """Create a list of ALL original TraCE-21ka NetCDF filenames.
 
@@ -178,15 +284,50 @@ def derive_new_trace_name(trace_file, var):
     if not os.path.isfile(trace_file):
         raise FileNotFoundError(f"Could not find TraCE file '{trace_file}'.")
     metadata = get_metadata_from_trace_file(trace_file)
-    first_year = metadata['first_year']
-    last_year = metadata['last_year']
-    name = f'trace_{first_year:05}-{last_year:05}_{var}.nc'
-    return name
+    return get_new_trace_name(metadata['first_year'], metadata['last_year'],
+                              var)
+
+
+def get_new_trace_name(first_year, last_year, var):
+    """Compose the basename of a TraCE file with absolute calendar.
+
+    >>> get_new_trace_name(21601, 21700, 'PRECT')
+    'trace_21601-21700_PRECT.nc'
+    """
+    return f'trace_{first_year:05}-{last_year:05}_{var}.nc'
+
+
+def get_years_of_new_trace_name(filename):
+    """Get first and last year from a name by `derive_new_trace_name()`.
+
+    Args:
+        filename: File name or path in the format of `derive_new_trace_name()`.
+
+    Returns:
+        A dictionary with the keys 'first_year' and 'last_year' like
+        `get_metadata_from_trace_file()`, but without opening the file.
+
+    Raises:
+        ValueError: `filename` does not match the naming pattern.
+
+    >>> get_years_of_new_trace_name('/output/trace_21601-21700_PRECT.nc')
+    {'first_year': 21601, 'last_year': 21700}
+    """
+    match_obj = re.match(r'trace_(\d+)-(\d+)_.*',
+                         os.path.basename(filename))
+    if not match_obj:
+        raise ValueError('Given file name was not created by '
+                         f'derive_new_trace_name(): {filename}')
+    return {'first_year': int(match_obj.group(1)),
+            'last_year': int(match_obj.group(2))}
 
 
 def derive_new_concat_trace_name(trace_filelist, var):
     """Compose a new basename for the concatenation of many TraCE files.
 
+    If all files are named by `derive_new_trace_name()`, the years are taken
+    from the names without opening the files.
+
     Args:
         trace_filelist: List of TraCE file paths.
         var: The CCSM3 variable in the NetCDF file.
@@ -194,10 +335,14 @@ def derive_new_concat_trace_name(trace_filelist, var):
     Returns:
         String with new base filename.
     """
-    metadata = get_metadata_from_trace_files(trace_filelist)
-    first_year = metadata['first_year']
-    last_year = metadata['last_year']
-    return f'trace_{first_year:05}-{last_year:05}_{var}.nc'
+    try:
+        years = [get_years_of_new_trace_name(f) for f in trace_filelist]
+        metadata = {'first_year': min(y['first_year'] for y in years),
+                    'last_year': max(y['last_year'] for y in years)}
+    except ValueError:
+        metadata = get_metadata_from_trace_files(trace_filelist)
+    return get_new_trace_name(metadata['first_year'], metadata['last_year'],
+                              var)
 
 
 def get_co2_filename(first_year, last_year):
@@ -7,6 +7,10 @@ import os
 
 import yaml
 
+# Paths of files found by `find_files()` during this run: key=filename;
+# value=path.
+_found_files = dict()
+
 
 def find_files(filenames):
     """Find file(s) recursively in the directories given in 'options.yaml'.
@@ -14,6 +18,9 @@ def find_files(filenames):
     Additionally to input directories search also the 'input' subdirectory of
     the `heap` directory. It contains unzipped and PRECT files.
 
+    Once a file has been found, its path is remembered for the rest of the
+    run so that the directories are not searched again.
+
     Args:
         filenames: List of filenames (or one file name string).
 
@@ -27,6 +34,14 @@ def find_files(filenames):
         ValueError: The input list is empty or one of the file names is an
             empty string.
     """
+    # Allow for single file path string as input instead of a list.
+    is_list = isinstance(filenames, list)
+    if not is_list:
+        filenames = [filenames]
+    if filenames and all(os.path.isfile(_found_files.get(f, ''))
+                         for f in filenames):
+        result = [_found_files[f] for f in filenames]
+        return result if is_list else result[0]
     opts = yaml.load(open('options.yaml'))
     heap_input = os.path.join(opts['directories']['heap'], '0_input')
     dirs = ['external_files', heap_input]
@@ -40,10 +55,6 @@ def find_files(filenames):
             raise NotADirectoryError("This path for input files from "
                                      "'options.yaml' is not a directory: "
                                      "'%s'." % d)
-    # Allow for single file path string as input instead of a list.
-    is_list = isinstance(filenames, list)
-    if not is_list:
-        filenames = [filenames]
     if len(filenames) == 0:
         raise ValueError("Parameter 'filenames' is an empty list.")
     result = list()
@@ -64,6 +75,7 @@ def find_files(filenames):
                      + glob.glob(os.path.join(d, '**', f)))
             if found:
                 result += [found[0]]  # Take the first hit.
+                _found_files[f] = found[0]
                 break  # Leave directory loop.
         if not found:
             raise FileNotFoundError(f"Could not find file '{f}' anywhere in "
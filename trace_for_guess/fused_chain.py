@@ -0,0 +1,325 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Fused processing of one 100-years slice: Instead of writing a file after
+# each stage (rescaled, debiased, wet days, final time unit) and compressing
+# the result at the end, the split TraCE files of the slice are read once and
+# all stages are applied to numpy arrays in memory. Only the final output
+# files (the variable and, for PRECT, the wet days) are written, compressed
+# and chunked, with their final metadata.
+#
+# The arithmetic is the same as in the stage-by-stage functions
+# (`calculate_fsdscl()`, `regrid_file()`, `debias_trace_file()`,
+# `debias_fsds_file()`, `create_wet_days_file()`, `convert_months_to_days()`,
+# and `set_metadata()`), which are still used if the intermediary files are
+# to be kept for debugging (option 'keep_intermediate_files').
+#
+# One slice of one variable in the resolution of the regrid template needs
+# to fit into memory.
+
+import contextlib
+import os
+import re
+
+from termcolor import cprint
+
+from trace_for_guess.bias_methods import apply_bias, get_bias_method
+from trace_for_guess.calculate_fsdscl import get_fsdscl
+from trace_for_guess.combine_files import TIME_CHUNK, is_field
+from trace_for_guess.debias import get_fsds
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.months import (NOLEAP_DAYS_PER_MONTH,
+                                    get_seconds_per_month)
+from trace_for_guess.netcdf_io import open_dataarray
+from trace_for_guess.regrid import apply_weights, load_weights
+from trace_for_guess.resources import reserve
+from trace_for_guess.skip import skip
+from trace_for_guess.wet_days import NODATA, get_wet_days_values
+
+# The TraCE variables that are needed to create an output variable. FSDSCL is
+# derived from FSDS, FSDSC, and CLDTOT in memory, so the radiation variables
+# of one slice are read only once.
+INPUT_VARS = {'FSDS': ['FSDS', 'FSDSC', 'CLDTOT'], 'PRECT': ['PRECT'],
+              'TREFHT': ['TREFHT']}
+
+
+def convert_months_to_days_values(values, units):
+    """Convert a relative time axis from 'months since' to 'days since'.
+
+    The calendar is 'noleap' (365 days per year). The reference date stays
+    the same. This gives the same result as `cdo settunits,days`.
+
+    Args:
+        values: Time values in months since the reference date.
+        units: The time unit, e.g. 'months since 1-1-15 00:00:00'.
+
+    Returns:
+        Tuple with the array of time values in days and the new time unit.
+
+    Raises:
+        ValueError: The unit is not 'months since'.
+
+    >>> convert_months_to_days_values([0, 1, 12, 13.5],
+    ...                               'months since 1-1-15 00:00:00')
+    (array([  0.,  31., 365., 410.]), 'days since 1-1-15 00:00:00')
+    """
+    import numpy as np
+    match_obj = re.match(r'\s*months\s+since\s+(-?\d+)-(\d+)-(\d+)(.*)$',
+                         units)
+    if not match_obj:
+        raise ValueError(f"Time unit is not 'months since': '{units}'")
+    ref_month = int(match_obj.group(2)) - 1
+    values = np.asarray(values, dtype='float64')
+    whole = np.floor(values).astype(int)
+    months = ref_month + whole
+    # Days from the beginning of the year to the beginning of each month.
+    cumulative = np.cumsum((0,) + NOLEAP_DAYS_PER_MONTH)
+    days = (365 * (months // 12) + cumulative[months % 12] -
+            cumulative[ref_month])
+    days = days + (values - whole) * np.array(NOLEAP_DAYS_PER_MONTH)[
+        months % 12]
+    return (days, 'days since ' + units.split('since', 1)[1].strip())
+
+
+def get_radiation_blocks(blocks):
+    """Derive the variables for debiasing FSDS from the original variables.
+
+    Args:
+        blocks: Dictionary with FSDS, FSDSC, and CLDTOT as keys and masked
+            arrays as values.
+
+    Returns:
+        Dictionary with FSDSC, FSDSCL, and CLDTOT as keys and masked arrays
+        as values.
+    """
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fsdscl = get_fsdscl(blocks['FSDS'], blocks['FSDSC'], blocks['CLDTOT'])
+    return {'FSDSC': blocks['FSDSC'], 'FSDSCL': np.ma.masked_invalid(fsdscl),
+            'CLDTOT': blocks['CLDTOT']}
+
+
+def read_regridded(split_files, target, alg, weights_dir, derive=None):
+    """Read variables from the split files of a slice and regrid them.
+
+    All files must be on the same grid. They are read in blocks of
+    `TIME_CHUNK` time steps, and the blocks of all variables are regridded
+    together with one sparse matrix product.
+
+    Args:
+        split_files: Dictionary with the TraCE variable as key and the split
+            file as value.
+        target: Dictionary with the 'lat' and 'lon' values of the target
+            grid.
+        alg: Regrid algorithm (see `trace_for_guess.regrid`).
+        weights_dir: Directory for the cached weights files.
+        derive: Optional function that calculates the variables to regrid
+            from the blocks of the variables in `split_files` (see
+            `get_radiation_blocks()`).
+
+    Returns:
+        Dictionary with the variable as key and a masked array (time, lat,
+        lon) on the target grid as value.
+
+    Raises:
+        ValueError: The split files have different grids.
+    """
+    import netCDF4
+    import numpy as np
+    with contextlib.ExitStack() as stack:
+        datasets = {v: stack.enter_context(netCDF4.Dataset(f, 'r'))
+                    for (v, f) in split_files.items()}
+        first = list(datasets.values())[0]
+        source = {d: first.variables[d][:] for d in ['lat', 'lon']}
+        for (v, ds) in datasets.items():
+            if not all(np.array_equal(ds.variables[d][:], source[d])
+                       for d in source):
+                raise ValueError(f"The grid of '{split_files[v]}' differs "
+                                 'from the other split files.')
+        weights = load_weights(source['lat'], source['lon'], target['lat'],
+                               target['lon'], alg, weights_dir)
+        row_sums = np.asarray(weights.sum(axis=1)).ravel()
+        steps = first.variables[list(datasets)[0]].shape[0]
+        shape = (len(target['lat']), len(target['lon']))
+        arrays = dict()
+        for start in range(0, steps, TIME_CHUNK):
+            end = min(start + TIME_CHUNK, steps)
+            blocks = {v: datasets[v].variables[v][start:end]
+                      for v in datasets}
+            if derive is not None:
+                blocks = derive(blocks)
+            # Regrid all variables of this block at once.
+            result = apply_weights(
+                weights, np.ma.concatenate(list(blocks.values())), row_sums)
+            result = result.reshape((len(blocks), end - start) + shape)
+            for (i, (v, block)) in enumerate(blocks.items()):
+                if v not in arrays:
+                    arrays[v] = np.ma.masked_array(
+                        np.empty((steps,) + shape, dtype=block.dtype),
+                        mask=np.zeros((steps,) + shape, dtype=bool))
+                arrays[v][start:end] = result[i]
+    return arrays
+
+
+def write_output(out_file, var, values, src, target, opts, copy_variables,
+                 attributes=None, fill_value=None):
+    """Write one output variable to a compressed and chunked NetCDF file.
+
+    Args:
+        out_file: Path to the output file.
+        var: Name of the output variable.
+        values: Array (time, lat, lon) on the target grid.
+        src: Open netCDF4 dataset of the split file. The global attributes
+            and the time axis are taken from it.
+        target: Dictionary with the 'lat' and 'lon' values and attributes of
+            the target grid.
+        opts: Dictionary with the content of 'options.yaml'. The keys
+            'nc_attributes', 'compression_level', and 'chunks' are used.
+        copy_variables: Whether all variables from `src` without latitude or
+            longitude (e.g. 'co2vmr') are copied. Otherwise only the time
+            axis is copied.
+        attributes: Dictionary with additional attributes for `var`.
+        fill_value: Fill value for `var`.
+    """
+    import netCDF4
+    nc_attributes = opts['nc_attributes']
+    compression_level = opts['compression_level']
+    with netCDF4.Dataset(out_file, 'w', format='NETCDF4') as out:
+        out.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+        for (name, dim) in src.dimensions.items():
+            if name in target:
+                out.createDimension(name, len(target[name]))
+            else:
+                out.createDimension(name,
+                                    None if dim.isunlimited() else len(dim))
+        time_vars = ['time', getattr(src.variables['time'], 'bounds', None)]
+        for (name, variable) in src.variables.items():
+            if name in target or is_field(variable):
+                continue
+            if 'lat' in variable.dimensions or 'lon' in variable.dimensions:
+                continue
+            if not copy_variables and name != 'time':
+                continue
+            attrs = {a: variable.getncattr(a) for a in variable.ncattrs()}
+            new = out.createVariable(name, variable.dtype,
+                                     variable.dimensions,
+                                     fill_value=attrs.pop('_FillValue', None))
+            data = variable[:]
+            if name in time_vars:
+                (data, attrs['units']) = convert_months_to_days_values(
+                    data, src.variables['time'].units)
+            new.setncatts(attrs)
+            new[:] = data
+        for name in ['lat', 'lon']:
+            new = out.createVariable(name, target[name].dtype, (name,))
+            new.setncatts(target['attrs'][name])
+            new[:] = target[name]
+        dims = ('time', 'lat', 'lon')
+        chunks = [min(opts['chunks'][d], size)
+                  for (d, size) in zip(dims, values.shape)]
+        new = out.createVariable(var, values.dtype, dims,
+                                 zlib=compression_level > 0,
+                                 complevel=compression_level,
+                                 chunksizes=chunks, fill_value=fill_value)
+        if attributes:
+            new.setncatts(attributes)
+        new[:] = values
+        # Same as `set_metadata()`.
+        for name in nc_attributes:
+            if name in out.variables:
+                out.variables[name].setncatts(nc_attributes[name])
+
+
+def process_slice(var, split_files, out_files, template_file, bias_files,
+                  prec_std_file, opts, weights_dir):
+    """Create the output files of one 100-years slice in memory.
+
+    Args:
+        var: One of the keys of `INPUT_VARS`.
+        split_files: Dictionary with the TraCE variables in `INPUT_VARS` as
+            keys and the split files of the slice as values.
+        out_files: Dictionary with the output variable as key and the output
+            file as value. For PRECT, this also contains 'WET'.
+        template_file: The cropped regrid template.
+        bias_files: Dictionary with the TraCE variable as key and the bias
+            file as value.
+        prec_std_file: File with the precipitation standard deviation. Only
+            needed for wet days.
+        opts: Dictionary with the content of 'options.yaml'.
+        weights_dir: Directory for the cached regrid weights.
+
+    Returns:
+        The `out_files` dictionary.
+
+    Raises:
+        FileNotFoundError: An input file doesn’t exist.
+        ValueError: `var` is not supported.
+    """
+    import netCDF4
+    import numpy as np
+    if var not in INPUT_VARS:
+        raise ValueError(f"Cannot process variable '{var}' in memory.")
+    in_files = [split_files[v] for v in INPUT_VARS[var]] + [template_file]
+    in_files += [bias_files[v] for v in INPUT_VARS[var] if v in bias_files]
+    if 'WET' in out_files:
+        in_files.append(prec_std_file)
+    for f in in_files:
+        if not os.path.isfile(f):
+            raise FileNotFoundError(f"Input file doesn’t exist: '{f}'")
+    if skip(in_files, list(out_files.values())):
+        return out_files
+    cprint(f"Processing slice '{os.path.basename(out_files[var])}' in "
+           'memory...', 'yellow')
+    # All arrays of the slice are held in memory until the files are
+    # written.
+    with reserve('slice', in_files):
+        with netCDF4.Dataset(template_file, 'r') as template:
+            target = {d: template.variables[d][:] for d in ['lat', 'lon']}
+            target['attrs'] = {d: {a: template.variables[d].getncattr(a)
+                                   for a in template.variables[d].ncattrs()}
+                               for d in ['lat', 'lon']}
+        # key=TraCE variable; value=array on the target grid
+        arrays = read_regridded(
+            {v: split_files[v] for v in INPUT_VARS[var]}, target,
+            opts['regrid_algorithm'], weights_dir,
+            derive=get_radiation_blocks if var == 'FSDS' else None)
+        for v in arrays:
+            if v in bias_files:
+                with open_dataarray(bias_files[v]) as bias:
+                    apply_bias(arrays[v], bias.values, get_bias_method(bias))
+        outputs = dict()  # key=output variable; value=(array, attributes)
+        if var == 'FSDS':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fsds = get_fsds(arrays['FSDSC'], arrays['FSDSCL'],
+                                arrays['CLDTOT'])
+            outputs['FSDS'] = (fsds.astype(arrays['FSDSC'].dtype), {
+                'long_name': 'Downwelling solar flux at surface'})
+        else:
+            outputs[var] = (arrays[var], dict())
+        if 'WET' in out_files:
+            prect = arrays['PRECT']
+            # Convert from kg/m²/s to mm/month.
+            seconds = get_seconds_per_month(len(prect))[:, None, None]
+            prect_mm = np.ma.filled(prect * seconds, np.nan)
+            with open_dataarray(prec_std_file) as std:
+                wet = get_wet_days_values(prect_mm, std.values,
+                                          opts['precip_threshold'])
+            outputs['WET'] = (wet, {'missing_value': NODATA})
+        # The split file of FSDS contains 'co2vmr' for the CO₂ files.
+        copy_source = split_files[INPUT_VARS[var][0]]
+        with contextlib.ExitStack() as stack:
+            src = stack.enter_context(netCDF4.Dataset(copy_source, 'r'))
+            for (out_var, (values, attributes)) in outputs.items():
+                tmp_file = stack.enter_context(
+                    atomic_output(out_files[out_var]))
+                if out_var == 'WET':
+                    attributes.update(opts['nc_attributes']['wet_days'])
+                write_output(tmp_file, out_var, values, src, target, opts,
+                             copy_variables=(var == 'FSDS'),
+                             attributes=attributes,
+                             fill_value=NODATA if out_var == 'WET' else None)
+    for f in out_files.values():
+        assert os.path.isfile(f), f"No output file created: '{f}'"
+        cprint(f"Successfully created '{f}'.", 'green')
+    return out_files
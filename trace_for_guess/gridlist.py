@@ -5,9 +5,10 @@
 import math
 import os
 
-import xarray as xr
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.netcdf_io import open_dataset
 from trace_for_guess.skip import skip
 
 
@@ -48,24 +49,20 @@ def create_gridlist(netcdf_file, gridlist_file):
         raise FileNotFoundError(f"Input file doesn’t exist: '{netcdf_file}'")
     if skip(netcdf_file, gridlist_file):
         return
-    try:
-        with xr.open_dataset(netcdf_file, decode_times=False) as ds, \
-                open(gridlist_file, 'w') as gridlist:
-            var = list(ds.var())[0]  # Assuming there’s only one variable.
-            assert var != ""
-            assert 'time' in ds[var].coords
-            lon_name = get_longitude(ds).name
-            lat_name = get_latitude(ds).name
-            for x in range(len(get_longitude(ds).values)):
-                for y in range(len(get_latitude(ds).values)):
-                    # If the value is NAN in the first time step, the whole
-                    # grid cell will be dismissed.
-                    index_dict = {'time': 0, lon_name: x, lat_name: y}
-                    if not math.isnan(ds[var][index_dict]):
-                        gridlist.write(f"{x}\t{y}\n")
-    except Exception:
-        cprint(f"Removing file '{gridlist_file}'.", 'red')
-        os.remove(gridlist_file)
-        raise
+    with atomic_output(gridlist_file) as tmp_file, \
+            open_dataset(netcdf_file) as ds, \
+            open(tmp_file, 'w') as gridlist:
+        var = list(ds.var())[0]  # Assuming there’s only one variable.
+        assert var != ""
+        assert 'time' in ds[var].coords
+        lon_name = get_longitude(ds).name
+        lat_name = get_latitude(ds).name
+        for x in range(len(get_longitude(ds).values)):
+            for y in range(len(get_latitude(ds).values)):
+                # If the value is NAN in the first time step, the whole grid
+                # cell will be dismissed.
+                index_dict = {'time': 0, lon_name: x, lat_name: y}
+                if not math.isnan(ds[var][index_dict]):
+                    gridlist.write(f"{x}\t{y}\n")
     assert(os.path.isfile(gridlist_file))
     cprint(f"Successfully created gridlist file '{gridlist_file}'.", 'green')
@@ -0,0 +1,361 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import fcntl
+import fnmatch
+import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from termcolor import cprint
+
+from trace_for_guess.resources import is_alive
+
+# Name of the file in the heap directory that remembers evicted files across
+# runs.
+MANIFEST_NAME = 'heap_manifest.json'
+
+# Name of the file in the heap directory with the number of running tasks of
+# each process that shares the heap.
+TASKS_NAME = 'heap_tasks.json'
+
+# Files that are cheap to keep but expensive to re-create. They are never
+# evicted, even if they are registered.
+KEEP_PATTERNS = ['bias_*', 'prec_std*', '*_mean.nc', 'modern_trace_*',
+                 'regrid_template_file.nc', '*weights*']
+
+# The heap manager that is used by `trace_for_guess.skip`. It is set with
+# `activate()`.
+_active_manager = None
+
+
+class HeapManager:
+    """Evict intermediary files in the heap as soon as they are consumed.
+
+    The pipeline registers each intermediary file with the number of
+    processing stages that will read it. Each of these consumers releases the
+    file when it has finished, naming the file(s) it produced. When the last
+    consumer has released a file, it is evicted:
+
+    - 'delete': The file is replaced by an empty placeholder file with the
+      same modification time. So `trace_for_guess.skip.skip()` still sees a
+      file with the original timestamp and can skip the following stages on a
+      re-run. Only if a product of the evicted file is missing or outdated
+      does `skip()` remove the placeholder so that the file is created again.
+    - 'compress': The file is deflated with `ncks` and keeps its original
+      modification time.
+    - 'keep': Nothing is done (the behavior before the heap manager).
+
+    The placeholders and products are remembered in a manifest file in the
+    heap directory. Several processes can share one heap (see
+    `trace_for_guess.cluster`). Each of them only adds its own changes to the
+    manifest file.
+
+    Args:
+        heap_dir: Path to the heap directory.
+        quota: Maximum disk usage of the heap in bytes. `None` or 0 means no
+            limit.
+        mode: One of 'delete', 'compress', or 'keep'.
+    """
+
+    def __init__(self, heap_dir, quota=None, mode='delete'):
+        if mode not in ['delete', 'compress', 'keep']:
+            raise ValueError(f"Unknown heap eviction mode: '{mode}'")
+        self.heap_dir = heap_dir
+        self.quota = quota
+        self.mode = mode
+        self.manifest_file = os.path.join(heap_dir, MANIFEST_NAME)
+        self.tasks_file = os.path.join(heap_dir, TASKS_NAME)
+        self.consumers = dict()  # key=path; value=remaining consumers
+        self.products = dict()  # key=path; value=list of product paths
+        self.active_tasks = 0
+        self.lock = threading.RLock()
+        self.evicted = dict()  # key=path; value=dict with mtime & products
+        # Changes of this process that still need to be merged into the
+        # manifest file:
+        self.new_evictions = dict()  # like `self.evicted`
+        self.restored = set()  # paths
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.evicted = json.load(f)['evicted']
+
+    def save_manifest(self):
+        """Merge the changes into the list of evicted files in the heap.
+
+        The manifest file is locked while it is updated so that no other
+        process can overwrite the changes at the same time.
+        """
+        with self.lock, open(self.manifest_file + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            evicted = dict()
+            if os.path.isfile(self.manifest_file):
+                with open(self.manifest_file) as f:
+                    evicted = json.load(f)['evicted']
+            for path in self.restored:
+                evicted.pop(path, None)
+            evicted.update(self.new_evictions)
+            tmp_file = self.manifest_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'evicted': evicted}, f, indent=1)
+            os.replace(tmp_file, self.manifest_file)
+            self.evicted = evicted
+            self.new_evictions.clear()
+            self.restored.clear()
+
+    def register(self, path, consumers):
+        """Announce an intermediary file and how many stages will read it.
+
+        Files that match `KEEP_PATTERNS` are ignored.
+
+        Args:
+            path: Path to the intermediary file. It doesn’t need to exist yet.
+            consumers: Number of stages that read the file.
+        """
+        if any(fnmatch.fnmatch(os.path.basename(path), p)
+               for p in KEEP_PATTERNS):
+            return
+        path = os.path.abspath(path)
+        with self.lock:
+            self.consumers[path] = self.consumers.get(path, 0) + consumers
+            self.products.setdefault(path, list())
+
+    def release(self, path, products):
+        """Declare that one consumer of a registered file has finished.
+
+        When the last consumer has released the file, it is evicted.
+
+        Args:
+            path: Path to the registered intermediary file.
+            products: The file(s) created by the consumer from `path`.
+        """
+        if not isinstance(products, list):
+            products = [products]
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self.consumers:
+                return
+            self.products[path] += [os.path.abspath(p) for p in products]
+            self.consumers[path] -= 1
+            if self.consumers[path] > 0:
+                return
+            del self.consumers[path]
+            self.evict(path, self.products.pop(path))
+
+    def evict(self, path, products):
+        """Delete or compress a consumed intermediary file.
+
+        Args:
+            path: Absolute path to the file.
+            products: List of absolute paths of all files produced from
+                `path`.
+        """
+        if self.mode == 'keep' or not os.path.isfile(path):
+            return
+        if self.is_evicted(path):
+            return
+        mtime = os.path.getmtime(path)
+        if self.mode == 'delete':
+            cprint(f"Evicting consumed file '{path}'.", 'cyan')
+            # Truncate the file, but keep its timestamp.
+            open(path, 'w').close()
+            os.utime(path, (mtime, mtime))
+        elif self.mode == 'compress':
+            if path in self.evicted:
+                return  # already compressed
+            if not path.endswith('.nc') or shutil.which('ncks') is None:
+                return
+            cprint(f"Compressing consumed file '{path}'.", 'cyan')
+            tmp_file = path + '.deflate.tmp'
+            try:
+                subprocess.run(['ncks', '--overwrite', '--deflate', '1',
+                                '--fl_fmt', 'netcdf4', path, tmp_file],
+                               check=True)
+                os.replace(tmp_file, path)
+                os.utime(path, (mtime, mtime))
+            finally:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+        with self.lock:
+            entry = {'mtime': mtime, 'products': products}
+            self.evicted[path] = entry
+            self.new_evictions[path] = entry
+            self.restored.discard(path)
+            self.save_manifest()
+
+    def is_evicted(self, path):
+        """Whether the file is an empty placeholder of an evicted file."""
+        path = os.path.abspath(path)
+        return (self.mode == 'delete' and path in self.evicted and
+                os.path.isfile(path) and os.path.getsize(path) == 0)
+
+    def products_are_current(self, path):
+        """Whether all files produced from an evicted file are up-to-date.
+
+        A product that has been evicted itself counts as up-to-date if its
+        own products are up-to-date.
+        """
+        path = os.path.abspath(path)
+        if path not in self.evicted:
+            return True
+        mtime = self.evicted[path]['mtime']
+        for p in self.evicted[path]['products']:
+            if not os.path.isfile(p) or os.path.getmtime(p) < mtime:
+                return False
+            if self.is_evicted(p) and not self.products_are_current(p):
+                return False
+        return True
+
+    def restore(self, path):
+        """Remove the placeholder of an evicted file so it can be created."""
+        path = os.path.abspath(path)
+        with self.lock:
+            if self.is_evicted(path):
+                cprint(f"Evicted file '{path}' is needed again.", 'yellow')
+                os.remove(path)
+            if path in self.evicted:
+                del self.evicted[path]
+                self.new_evictions.pop(path, None)
+                self.restored.add(path)
+                self.save_manifest()
+
+    def get_heap_size(self):
+        """Sum up the size of all files in the heap in bytes."""
+        size = 0
+        for root, dirs, files in os.walk(self.heap_dir):
+            for f in files:
+                f = os.path.join(root, f)
+                if os.path.isfile(f):
+                    size += os.path.getsize(f)
+        return size
+
+    def update_tasks(self, change):
+        """Change the number of running tasks of this process in the heap.
+
+        The counts of all processes sharing the heap are kept in a file so
+        that `throttle()` also waits for tasks of other processes (e.g. local
+        cluster shards). Entries of processes that don’t exist anymore are
+        dropped.
+
+        Args:
+            change: Number of tasks that were started (positive) or finished
+                (negative).
+        """
+        host = socket.gethostname()
+        with self.lock, open(self.tasks_file + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.active_tasks += change
+            tasks = dict()
+            if os.path.isfile(self.tasks_file):
+                with open(self.tasks_file) as f:
+                    tasks = json.load(f)
+            tasks = {k: n for (k, n) in tasks.items()
+                     if k.split(':')[0] != host or
+                     is_alive(int(k.split(':')[1]))}
+            key = f'{host}:{os.getpid()}'
+            if self.active_tasks > 0:
+                tasks[key] = self.active_tasks
+            else:
+                tasks.pop(key, None)
+            tmp_file = self.tasks_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(tasks, f, indent=1)
+            os.replace(tmp_file, self.tasks_file)
+
+    def count_running_tasks(self):
+        """Count the running tasks of all processes on this machine.
+
+        Tasks of other machines sharing the heap are not counted because it
+        cannot be checked whether their processes still exist.
+        """
+        if not os.path.isfile(self.tasks_file):
+            return 0
+        with open(self.tasks_file + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            with open(self.tasks_file) as f:
+                tasks = json.load(f)
+        host = socket.gethostname()
+        return sum(n for (k, n) in tasks.items()
+                   if k.split(':')[0] == host and
+                   is_alive(int(k.split(':')[1])))
+
+    def task_started(self):
+        """Count a task as running (see `throttle()`)."""
+        self.update_tasks(1)
+
+    def task_finished(self):
+        """Count a task as finished (see `throttle()`)."""
+        self.update_tasks(-1)
+
+    @contextlib.contextmanager
+    def running_task(self):
+        """Count a task as running while the context is active.
+
+        Use it like this:
+
+            heap_manager.throttle()
+            with heap_manager.running_task():
+                ...
+        """
+        self.task_started()
+        try:
+            yield
+        finally:
+            self.task_finished()
+
+    def throttle(self, interval=10):
+        """Wait until the heap has shrunk below the disk quota.
+
+        Running tasks (see `running_task()`) of this or other processes on
+        this machine will release and evict files eventually. If no task is
+        running, there is nothing to wait for and a warning is printed
+        instead.
+
+        Args:
+            interval: Seconds between two checks of the heap size.
+        """
+        if not self.quota:
+            return
+        waiting = False
+        while self.get_heap_size() > self.quota:
+            if self.count_running_tasks() <= 0:
+                cprint('The heap exceeds the disk quota of '
+                       f'{self.quota / 1e9:.1f} GB.', 'red')
+                return
+            if not waiting:
+                cprint('The heap exceeds the disk quota. Waiting for running '
+                       'tasks to finish...', 'yellow')
+                waiting = True
+            time.sleep(interval)
+
+
+def activate(manager):
+    """Make the heap manager known to `trace_for_guess.skip`."""
+    global _active_manager
+    _active_manager = manager
+
+
+def get_active_manager():
+    """Get the heap manager set with `activate()` or `None`."""
+    return _active_manager
+
+
+def create_heap_manager(opts):
+    """Create and activate a heap manager from the 'options.yaml' settings.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+
+    Returns:
+        A `HeapManager` object.
+    """
+    quota = opts['heap_quota'] * 1e9  # GB to bytes
+    manager = HeapManager(opts['directories']['heap'], quota,
+                          opts['heap_eviction'])
+    activate(manager)
+    return manager
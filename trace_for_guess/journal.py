@@ -0,0 +1,201 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Crash recovery: Each processing stage writes its output under a temporary
+# name (see `get_tmp_name()`) and renames it only when it is complete. So a
+# file with the final name is never a partial file, and `skip()` can trust
+# it on a re-run.
+# If the script is killed (e.g. by the out-of-memory killer or the wall time
+# limit of a batch job), cleanup code doesn’t run. Therefore all running tasks
+# are listed in a journal file in the heap. On the next start, the remains of
+# the unfinished tasks are removed, and these tasks are run again.
+
+import contextlib
+import os
+import threading
+import time
+from glob import escape, glob
+
+from termcolor import cprint
+
+from trace_for_guess.checksums import record_checksums
+from trace_for_guess.progress import report_task
+
+# Name of the file in the heap directory listing the running tasks.
+JOURNAL_NAME = 'journal.txt'
+
+# The journal that is used by `journal_task()`. It is set with
+# `open_journal()`.
+_active_journal = None
+
+
+def get_tmp_name(out_file):
+    """Get the temporary file name under which `out_file` is written.
+
+    >>> get_tmp_name('heap/trace_21601-21700_PRECT.nc')
+    'heap/trace_21601-21700_PRECT.nc.tmp'
+    """
+    return out_file + '.tmp'
+
+
+def is_tmp_name(path):
+    """Whether a path is a temporary file name from `get_tmp_name()`.
+
+    >>> is_tmp_name('heap/trace_21601-21700_PRECT.nc.tmp')
+    True
+    """
+    return path.endswith(get_tmp_name(''))
+
+
+def remove_remains(path):
+    """Remove all files whose path begins with `path`.
+
+    These are the file itself, temporary files (e.g. from `atomic_output()`
+    or NCO commands like '*.pid1234.ncks.tmp'), or all files with `path` as
+    common prefix.
+    """
+    for f in glob(escape(path) + '*'):
+        if os.path.isfile(f):
+            cprint(f"Removing file '{f}'.", 'red')
+            os.remove(f)
+
+
+class Journal:
+    """List of running tasks in a file to recover from a crash.
+
+    Each line of the journal file is either 'start' or 'finish', followed by
+    a tab and the path of the output file of the task. The path may also be
+    the common prefix of several output files (e.g. from `cdo splitsel`).
+    Each line is flushed to disk immediately.
+
+    When the journal is opened, tasks from a previous run that have been
+    started, but never finished, are cleaned up (see `recover()`).
+
+    Args:
+        heap_dir: Path to the heap directory.
+        name: File name of the journal in the heap directory.
+    """
+
+    def __init__(self, heap_dir, name=JOURNAL_NAME):
+        self.journal_file = os.path.join(heap_dir, name)
+        self.lock = threading.Lock()
+        self.recover()
+        self.file = open(self.journal_file, 'a')
+
+    def recover(self):
+        """Remove the output of tasks that were interrupted in a previous run.
+
+        For each unfinished task, the output file (or all output files with
+        the path as prefix) and temporary files are removed (see
+        `remove_remains()`). The journal is cleared afterwards.
+        """
+        if not os.path.isfile(self.journal_file):
+            return
+        running = list()
+        with open(self.journal_file) as f:
+            for line in f:
+                (action, _, path) = line.rstrip('\n').partition('\t')
+                if action == 'start':
+                    running.append(path)
+                elif action == 'finish' and path in running:
+                    running.remove(path)
+        for path in running:
+            cprint(f"Cleaning up interrupted task from previous run: '{path}'",
+                   'yellow')
+            remove_remains(path)
+        os.remove(self.journal_file)
+
+    def write(self, action, path):
+        """Append a line to the journal and flush it to disk."""
+        with self.lock:
+            self.file.write(f'{action}\t{path}\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """Close the journal file."""
+        self.file.close()
+
+
+def open_journal(heap_dir, name=JOURNAL_NAME):
+    """Open the journal in the heap and make it known to `journal_task()`.
+
+    Remains of tasks that were interrupted in a previous run are removed.
+
+    Args:
+        heap_dir: Path to the heap directory.
+        name: File name of the journal in the heap directory.
+
+    Returns:
+        A `Journal` object.
+    """
+    global _active_journal
+    if _active_journal is not None:
+        _active_journal.close()
+    _active_journal = Journal(heap_dir, name)
+    return _active_journal
+
+
+@contextlib.contextmanager
+def journal_task(path):
+    """Mark a task as running in the journal while the context is active.
+
+    Without an open journal (see `open_journal()`), nothing is recorded.
+    When the task has finished successfully, it is reported to the progress
+    telemetry (see `trace_for_guess.progress`).
+
+    Args:
+        path: Path of the output file. For tasks with several output files,
+            the common prefix of all output file paths.
+    """
+    journal = _active_journal
+    path = os.path.abspath(path)
+    if journal:
+        journal.write('start', path)
+    started = time.time()
+    try:
+        yield
+        report_task(path, time.time() - started)
+    finally:
+        if journal:
+            journal.write('finish', path)
+
+
+@contextlib.contextmanager
+def atomic_output(out_file):
+    """Write a file under a temporary name and rename it when complete.
+
+    The context yields the temporary file path to write to. When the context
+    is left without error, the temporary file is renamed to `out_file`.
+    Otherwise it is removed. The task is recorded in the journal (see
+    `journal_task()`), and the checksums of the finished file are recorded
+    (see `trace_for_guess.checksums`).
+
+    If `out_file` is itself the temporary file of an outer `atomic_output()`
+    (e.g. `compress_and_chunk()` writing to the temporary file of its
+    caller), the task is journaled and recorded only by the outer context.
+
+    Use it like this:
+
+        with atomic_output(out_file) as tmp_file:
+            subprocess.run(['cdo', 'copy', in_file, tmp_file], check=True)
+
+    Args:
+        out_file: Path to the final output file.
+
+    Raises:
+        RuntimeError: No file was written to the temporary path.
+    """
+    tmp_file = get_tmp_name(out_file)
+    nested = is_tmp_name(out_file)
+    with (contextlib.nullcontext() if nested else journal_task(out_file)):
+        try:
+            yield tmp_file
+            if not os.path.isfile(tmp_file):
+                raise RuntimeError(f"No output file created: '{out_file}'")
+            os.replace(tmp_file, out_file)
+            if not nested:
+                record_checksums(out_file)
+        finally:
+            remove_remains(tmp_file)
@@ -0,0 +1,113 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import functools
+
+# Number of days in each month of the 365-days calendar ('noleap') of
+# TraCE-21ka and CRU-JRA.
+NOLEAP_DAYS_PER_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+@functools.lru_cache()
+def get_month_index(time_steps, first_month=0):
+    """Get the month number (0 to 11) for each step of a monthly time axis.
+
+    The returned array is cached and must not be modified.
+
+    Args:
+        time_steps: Length of the monthly time axis.
+        first_month: Month number (0 for January) of the first time step.
+
+    Returns:
+        A read-only numpy array of integers with length `time_steps`.
+
+    >>> get_month_index(14, first_month=11).tolist()
+    [11, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 0]
+    """
+    import numpy as np
+    months = (np.arange(time_steps) + first_month) % 12
+    months.flags.writeable = False
+    return months
+
+
+@functools.lru_cache()
+def get_days_per_month(time_steps, first_month=0):
+    """Get the number of days for each step of a monthly time axis.
+
+    The calendar is 'noleap' (365 days per year). The returned array is cached
+    and must not be modified.
+
+    Args:
+        time_steps: Length of the monthly time axis.
+        first_month: Month number (0 for January) of the first time step.
+
+    Returns:
+        A read-only numpy array of integers with length `time_steps`.
+
+    >>> get_days_per_month(3).tolist()
+    [31, 28, 31]
+    """
+    import numpy as np
+    days = np.array(NOLEAP_DAYS_PER_MONTH)[get_month_index(time_steps,
+                                                           first_month)]
+    days.flags.writeable = False
+    return days
+
+
+@functools.lru_cache()
+def get_seconds_per_month(time_steps, first_month=0):
+    """Get the number of seconds for each step of a monthly time axis.
+
+    The calendar is 'noleap' (365 days per year). The returned array is cached
+    and must not be modified.
+
+    Args:
+        time_steps: Length of the monthly time axis.
+        first_month: Month number (0 for January) of the first time step.
+
+    Returns:
+        A read-only numpy array of integers with length `time_steps`.
+
+    >>> get_seconds_per_month(2).tolist()
+    [2678400, 2419200]
+    """
+    seconds = get_days_per_month(time_steps, first_month) * SECONDS_PER_DAY
+    seconds.flags.writeable = False
+    return seconds
+
+
+def get_factor_like(data_array, table):
+    """Wrap a calendar array so that it broadcasts along the time dimension.
+
+    Multiplying an xarray DataArray with the result applies the factor to
+    each time step without copying the table for every grid cell. The monthly
+    time axis is assumed to start with January.
+
+    Args:
+        data_array: xarray DataArray with a monthly 'time' dimension.
+        table: One of the functions `get_month_index()`,
+            `get_days_per_month()`, or `get_seconds_per_month()`.
+
+    Returns:
+        xarray DataArray with only the 'time' dimension.
+    """
+    import xarray as xr
+    time = data_array['time']
+    return xr.DataArray(table(len(time)), dims=['time'],
+                        coords={'time': time})
+
+
+def flux_to_mm_per_month(data_array):
+    """Convert precipitation from kg/m²/s to mm/month.
+
+    The length of each month is taken into account. See the README.md for a
+    detailed explanation of the formula.
+
+    Args:
+        data_array: xarray DataArray with a monthly 'time' dimension starting
+            in January.
+    """
+    return data_array * get_factor_like(data_array, get_seconds_per_month)
@@ -0,0 +1,142 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Editing of NetCDF files in place with netCDF4-python instead of NCO and CDO
+# commands. Renaming variables and setting attributes only change the header,
+# and rewriting the time axis only changes the values of the coordinate
+# variable. The data variables are not copied as they would be by `ncatted`,
+# `ncrename`, `ncap2`, or `cdo copy`, and no process is started.
+#
+# All changes to one file should be made while it is open once (see
+# `edit_dataset()`). In classic NetCDF3 files, the netCDF library moves the
+# data only if the header grows beyond its reserved space.
+
+import contextlib
+import os
+import re
+
+from trace_for_guess.months import NOLEAP_DAYS_PER_MONTH
+
+# Name of the variable in the TraCE files with the date of each time step as
+# integer 'YYYYMMDD', where year 0 is 22,000 years BP.
+DATE_VAR = 'date'
+
+
+@contextlib.contextmanager
+def edit_dataset(filename):
+    """Open a NetCDF file to edit it in place.
+
+    Use it like this:
+
+        with edit_dataset(tmp_file) as ds:
+            rename_variables(ds, {'PRECC': 'PRECT'})
+            set_variable_attributes(ds, {'PRECT': {'units': 'kg m-2 s-1'}})
+
+    Raises:
+        FileNotFoundError: `filename` does not exist.
+    """
+    import netCDF4
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"NetCDF file doesn’t exist: '{filename}'")
+    with netCDF4.Dataset(filename, 'r+') as ds:
+        yield ds
+
+
+def rename_variables(ds, names):
+    """Rename variables like `ncrename --variable`.
+
+    Args:
+        ds: A `netCDF4.Dataset` object opened for writing.
+        names: Dictionary with the old name as key and the new name as value.
+
+    Raises:
+        KeyError: A variable is not in the dataset.
+    """
+    for (old, new) in names.items():
+        if old not in ds.variables:
+            raise KeyError(f"Variable '{old}' not found in '{ds.filepath()}'.")
+        ds.renameVariable(old, new)
+
+
+def set_variable_attributes(ds, attributes):
+    """Set (or overwrite) text attributes like `ncatted -a key,var,o,c,val`.
+
+    Variables that are not in the dataset are ignored.
+
+    Args:
+        ds: A `netCDF4.Dataset` object opened for writing.
+        attributes: Dictionary with the variable name as key and a
+            dictionary of attribute names and values as value. The values are
+            written as text.
+    """
+    for (var, var_attributes) in attributes.items():
+        if var not in ds.variables:
+            continue
+        for (key, value) in var_attributes.items():
+            ds.variables[var].setncattr(key, str(value))
+
+
+def set_time(ds, values, units, calendar=None):
+    """Overwrite the values and unit of the time coordinate in place.
+
+    Args:
+        ds: A `netCDF4.Dataset` object opened for writing.
+        values: Numpy array with the new time values.
+        units: The new time unit.
+        calendar: The calendar. If `None`, the calendar attribute is left as
+            it is.
+    """
+    time = ds.variables['time']
+    time[:] = values
+    time.setncattr('units', units)
+    if calendar is not None:
+        time.setncattr('calendar', calendar)
+
+
+def convert_dates_to_months(dates, units):
+    """Convert integer dates 'YYYYMMDD' to a 'months since' time axis.
+
+    The calendar is 'noleap'. Each whole month begins at the day of the month
+    of the reference date, and the fraction of a month is measured in the days
+    of that month. This is the inverse of
+    `trace_for_guess.fused_chain.convert_months_to_days_values()`, so that the
+    days come out exactly right in the final time unit.
+
+    Args:
+        dates: Numpy array of integer dates 'YYYYMMDD'.
+        units: The time unit, e.g. 'months since 1-1-15 00:00:00'.
+
+    Returns:
+        Numpy array with the months since the reference date.
+
+    Raises:
+        ValueError: The unit is not 'months since'.
+
+    >>> convert_dates_to_months([10115, 10215, 10301, 20115, 115],
+    ...                         'months since 1-1-15 00:00:00').tolist()
+    [0.0, 1.0, 1.5, 12.0, -12.0]
+    """
+    import numpy as np
+    match_obj = re.match(r'\s*months\s+since\s+(-?\d+)-(\d+)-(\d+)', units)
+    if not match_obj:
+        raise ValueError(f"Time unit is not 'months since': '{units}'")
+    (ref_year, ref_month, ref_day) = [int(x) for x in match_obj.groups()]
+    lengths = np.array(NOLEAP_DAYS_PER_MONTH)
+    # Days from the beginning of the year to the beginning of each month.
+    cumulative = np.cumsum((0,) + NOLEAP_DAYS_PER_MONTH)
+
+    def get_days(year, month, day):
+        """Days since the beginning of year 0 (month from 0 to 11)."""
+        return 365 * year + cumulative[month] + day - 1
+
+    dates = np.asarray(dates).astype('int64')
+    days = get_days(dates // 10000, dates // 100 % 100 - 1, dates % 100)
+    days = days - get_days(ref_year, ref_month - 1, ref_day)
+    # Shift the days so that the whole months begin at the same days of the
+    # year as the calendar months.
+    days = days + cumulative[ref_month - 1]
+    (years, day_of_year) = np.divmod(days, 365)
+    month = np.searchsorted(cumulative, day_of_year, side='right') - 1
+    fraction = (day_of_year - cumulative[month]) / lengths[month]
+    return 12 * years + month - (ref_month - 1) + fraction
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import contextlib
+import os
+import warnings
+
+# The first bytes of classic NetCDF3 files (classic and 64-bit offset format).
+# Only these can be memory-mapped by `scipy.io.netcdf_file`.
+NETCDF3_MAGIC = [b'CDF\x01', b'CDF\x02']
+
+
+def is_netcdf3(filename):
+    """Whether the file is in classic NetCDF3 format (without compression).
+
+    Raises:
+        FileNotFoundError: `filename` does not exist.
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"File not found: '{filename}'")
+    with open(filename, 'rb') as f:
+        return f.read(4) in NETCDF3_MAGIC
+
+
+@contextlib.contextmanager
+def open_dataset(filename):
+    """Open a NetCDF file with xarray, memory-mapped if the format allows.
+
+    Classic NetCDF3 files store each variable as contiguous (or regularly
+    strided) binary data. They are opened with `scipy.io.netcdf_file` and the
+    variables are wrapped *without copying* as numpy views of the memory-mapped
+    file. So only those parts of the file that are actually read are loaded
+    into (page cache) memory. Masking of missing values is applied lazily by
+    xarray when values are accessed.
+
+    Other files (e.g. NetCDF4) are opened with `xarray.open_dataset()` as
+    usual. Times are never decoded.
+
+    Use this function as a context manager:
+
+        with open_dataset('file.nc') as ds:
+            ...
+
+    The data must not be used after the context has been left.
+
+    Args:
+        filename: Path to the NetCDF file.
+
+    Raises:
+        FileNotFoundError: `filename` does not exist.
+    """
+    import xarray as xr
+    if not is_netcdf3(filename):
+        with xr.open_dataset(filename, decode_times=False) as ds:
+            yield ds
+        return
+    import scipy.io
+    nc = scipy.io.netcdf_file(filename, mode='r', mmap=True,
+                              maskandscale=False)
+    try:
+        variables = {name: xr.Variable(var.dimensions, var.data,
+                                       attrs=dict(var._attributes))
+                     for name, var in nc.variables.items()}
+        yield xr.decode_cf(xr.Dataset(variables, attrs=dict(nc._attributes)),
+                           decode_times=False)
+    finally:
+        # If views of the data are still referenced, scipy warns and keeps
+        # the memory map open until they are garbage-collected.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            nc.close()
+
+
+@contextlib.contextmanager
+def open_dataarray(filename):
+    """Open a NetCDF file with only one data variable like `open_dataset()`.
+
+    Raises:
+        FileNotFoundError: `filename` does not exist.
+        ValueError: The file does not contain exactly one data variable.
+    """
+    with open_dataset(filename) as ds:
+        if len(ds.data_vars) != 1:
+            raise ValueError('Expected exactly one data variable in file '
+                             f"'{filename}', but found {len(ds.data_vars)}.")
+        yield ds[list(ds.data_vars)[0]]
@@ -3,13 +3,15 @@
 # SPDX-License-Identifier: MIT
 
 import os
+import re
 import shutil
 import subprocess
 
-import xarray as xr
 import yaml
 from termcolor import cprint
 
+from trace_for_guess.netcdf_edit import edit_dataset, set_variable_attributes
+
 
 def get_metadata_from_trace_file(trace_file):
     """Get time range and variable from given TraCE file.
@@ -70,6 +72,39 @@ def get_metadata_from_trace_files(trace_filelist):
             'last_year': last_year}
 
 
+def get_years_from_time_axis(trace_file):
+    """Get the years of the first and last time step without calling `cdo`.
+
+    Only the first and the last value of the time coordinate are read. The
+    years are the same as from `get_metadata_from_trace_file()`.
+
+    Args:
+        trace_file: An existing NetCDF file with the time unit 'months since'.
+
+    Returns:
+        A dictionary with the keys 'first_year' and 'last_year'.
+
+    Raises:
+        FileNotFoundError: If `trace_file` does not exist.
+        ValueError: The time unit is not 'months since'.
+    """
+    import netCDF4
+    if not os.path.isfile(trace_file):
+        raise FileNotFoundError(f"Could not find TraCE file '{trace_file}'.")
+    with netCDF4.Dataset(trace_file, 'r') as ds:
+        time = ds.variables['time']
+        units = time.units
+        values = [float(time[0]), float(time[-1])]
+    match_obj = re.match(r'\s*months\s+since\s+(-?\d+)-(\d+)-', units)
+    if not match_obj:
+        raise ValueError(f"Time unit is not 'months since' in '{trace_file}': "
+                         f"'{units}'")
+    (ref_year, ref_month) = [int(x) for x in match_obj.groups()]
+    # Whole months are counted from the beginning of the reference year.
+    years = [ref_year + (ref_month - 1 + int(v // 1)) // 12 for v in values]
+    return {'first_year': years[0], 'last_year': years[1]}
+
+
 def set_attributes(da, var):
     """Set NetCDF attributes for XArray object to values that LPJ-GUESS expects.
 
@@ -85,30 +120,22 @@ def set_attributes(da, var):
 def set_metadata(trace_file):
     """Set NetCDF metadata of given file to CF standards for LPJ-GUESS.
 
+    The attributes from `options.yaml` are written in place (see
+    `trace_for_guess.netcdf_edit`).
+
     Args:
         trace_file: Full path to TraCE-21ka NetCDF file.
 
     Raises:
         FileNotFoundError: If `trace_file` does not exist.
-        RuntimeError: Executable `ncatted` is not in the PATH
     """
     if not os.path.isfile(trace_file):
         raise FileNotFoundError(f"TraCE file doesn’t exist: '{trace_file}'")
-    if shutil.which('ncatted') is None:
-        raise RuntimeError("Executable `ncatted` not found.")
     cprint(f"Setting metadata for file '{trace_file}'.", 'yellow')
     attributes = yaml.load(open("options.yaml"))["nc_attributes"]
-    ncatted_args = list()
-    for var in attributes:
-        with xr.open_dataset(trace_file, decode_times=False) as ds:
-            if var not in ds:
-                continue
-        for key in attributes[var]:
-            val = attributes[var][key]
-            ncatted_args += ['--attribute', f'{key},{var},o,c,{val}']
     try:
-        subprocess.run(['ncatted', '--overwrite'] + ncatted_args +
-                       [trace_file], check=True)
+        with edit_dataset(trace_file) as ds:
+            set_variable_attributes(ds, attributes)
     except Exception:
         if os.path.isfile(trace_file):
             cprint(f"Removing file '{trace_file}'.", 'red')
@@ -0,0 +1,921 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import re
+import warnings
+
+from termcolor import cprint
+
+from trace_for_guess.add_precc_precl import add_precc_and_precl_to_prect
+from trace_for_guess.aggregate_modern_trace import (aggregate_modern_trace,
+                                                    extract_modern_years)
+from trace_for_guess.bias_methods import get_method, get_method_name
+from trace_for_guess.calculate_bias import (calculate_bias,
+                                            calculate_quantile_bias,
+                                            get_bias_file)
+from trace_for_guess.calculate_fsdscl import calculate_fsdscl
+from trace_for_guess.cdo_chain import run_cdo_chain
+from trace_for_guess.checksums import CHECKSUMS_NAME, open_manifest
+from trace_for_guess.co2 import create_co2_files
+from trace_for_guess.compress import compress_and_chunk
+from trace_for_guess.concatenate import cat_files
+from trace_for_guess.convert_time_unit import (convert_kabp_to_months,
+                                               convert_months_to_days)
+from trace_for_guess.crop import (check_region, crop_file, crop_file_list,
+                                  expand_extent, get_crop_operator)
+from trace_for_guess.debias import debias_fsds_file, debias_trace_file
+from trace_for_guess.filenames import (derive_new_concat_trace_name,
+                                       get_cru_filenames, get_crujra_filenames,
+                                       get_model_years_of_trace_file,
+                                       get_modern_trace_filename,
+                                       get_new_trace_name,
+                                       get_trace_filenames,
+                                       get_years_of_new_trace_name,
+                                       predict_slice_years, read_slice_years,
+                                       save_slice_years)
+from trace_for_guess.find_input import find_files
+from trace_for_guess.fused_chain import INPUT_VARS, process_slice
+from trace_for_guess.gridlist import create_gridlist
+from trace_for_guess.heap import create_heap_manager
+from trace_for_guess.journal import JOURNAL_NAME, atomic_output, open_journal
+from trace_for_guess.netcdf_metadata import (get_years_from_time_axis,
+                                             set_metadata)
+from trace_for_guess.prec_standard_deviation import get_prec_standard_deviation
+from trace_for_guess.progress import open_progress
+from trace_for_guess.rescale import rescale_file
+from trace_for_guess.resources import create_budget
+from trace_for_guess.skip import skip
+from trace_for_guess.split import split_file
+from trace_for_guess.unzip import unzip_files_if_needed
+from trace_for_guess.weather_generator import create_daily_slices
+from trace_for_guess.wet_days import create_wet_days_file
+from trace_for_guess.zarr_store import (get_store_name, init_store,
+                                        write_slice_to_store)
+
+# The variables that go into the output directory. WET is derived from PRECT.
+OUTPUT_VARS = ['FSDS', 'PRECT', 'TREFHT', 'WET']
+
+# All TraCE variables that are read from the original TraCE files.
+# It is important that "CLDTOT" comes before "FSDS" because CLDTOT needs to be
+# debiased before FSDS files can be debiased.
+TRACE_VARS = ['CLDTOT', 'FSDSC', 'FSDSCL', 'FSDS', 'PRECT', 'TREFHT']
+
+
+def get_directories(opts):
+    """Get the paths of the output directory and the heap directories.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+
+    Returns:
+        A dictionary with the directory name as key and the path as value.
+    """
+    heap = opts['directories']['heap']  # Any intermediary files
+    return {
+        'heap': heap,
+        'out_dir': opts['directories']['output'],  # All output files
+        # Searched by find_files(). Tiles (see `trace_for_guess.tiles`) share
+        # the input directory of the whole region.
+        'heap_input': opts['directories'].get(
+            'heap_input', os.path.join(heap, '0_input')),
+        'cropped_dir': os.path.join(heap, '1_cropped'),
+        'time_unit_dir': os.path.join(heap, '2_time'),  # 'months since'
+        'split_dir': os.path.join(heap, '3_split'),
+        'rescaled_dir': os.path.join(heap, '4_rescaled'),
+        'debiased_dir': os.path.join(heap, '5_debiased'),
+        'wet_days_dir': os.path.join(heap, '6_wet_days'),
+        'final_time_dir': os.path.join(heap, '7_final_time')  # 'days since'
+    }
+
+
+def use_fused_chain(opts):
+    """Whether the stages of each slice are run in memory.
+
+    See `trace_for_guess.fused_chain`. The intermediary files of each stage
+    are only created if they shall be kept for debugging or if the regridding
+    is done by `ncremap`.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+    """
+    return (opts.get('keep_intermediate_files', 'no') != 'yes' and
+            opts.get('regrid_engine', 'ncremap') == 'native')
+
+
+def get_trace_vars(opts):
+    """Get the TraCE variables whose files need to be cropped and split.
+
+    If the slices are processed in memory, FSDSCL is derived from the split
+    files of the other radiation variables (see
+    `trace_for_guess.fused_chain`).
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+
+    Returns:
+        A sublist of `TRACE_VARS`.
+    """
+    if use_fused_chain(opts):
+        return [v for v in TRACE_VARS if v != 'FSDSCL']
+    return TRACE_VARS
+
+
+class Pipeline:
+    """Downscale and debias TraCE-21ka files for LPJ-GUESS.
+
+    `run()` creates all output files for the time range in the options, just
+    like the script `prepare_trace_for_guess`. `get_slice()` builds only the
+    processing stages that are needed for one 100-years slice of one variable.
+    Every stage is skipped if its output file is already up-to-date (see
+    `trace_for_guess.skip`), and the result of every stage is cached for the
+    lifetime of the `Pipeline` object.
+
+    Example:
+        pipeline = Pipeline(yaml.load(open('options.yaml')))
+        pipeline.get_slice('TREFHT', 21601)
+
+    NOTE: Some processing stages still read their own settings from the file
+    'options.yaml' in the working directory.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+        journal_name: File name of the journal in the heap (see
+            `trace_for_guess.journal`). Several processes that share the heap
+            (see `trace_for_guess.cluster`) need different journals.
+        checksums_name: File name of the checksum manifest in the heap (see
+            `trace_for_guess.checksums`). Like the journal, it must be
+            different for each process that shares the heap.
+
+    Raises:
+        ValueError: A value in `opts` is not valid.
+    """
+
+    def __init__(self, opts, journal_name=JOURNAL_NAME,
+                 checksums_name=CHECKSUMS_NAME):
+        self.opts = opts
+        self.extent = opts['region']['lon'] + opts['region']['lat']
+        self.time_range = opts['time_range']
+        if (not isinstance(self.time_range, list) or
+                len(self.time_range) != 2 or
+                not all(isinstance(y, int) for y in self.time_range)):
+            raise ValueError('Bad value in options.yaml for "time_range": '
+                             f'{self.time_range}')
+        if opts['output_format'] not in ['netcdf', 'zarr']:
+            raise ValueError('Bad value in options.yaml for "output_format". '
+                             'Use "netcdf" or "zarr".')
+        check_region(self.extent)
+        # We need to crop the TraCE files with an additional margin of at least
+        # the TraCE grid cell size because otherwise the cropped TraCE files
+        # can cover a smaller area than the cropped CRU files (which has a
+        # higher resolution).
+        self.trace_extent = expand_extent(self.extent, 4.0)
+
+        dirs = get_directories(opts)
+        self.heap = dirs['heap']
+        self.out_dir = dirs['out_dir']
+        self.heap_input = dirs['heap_input']
+        self.cropped_dir = dirs['cropped_dir']
+        self.time_unit_dir = dirs['time_unit_dir']
+        self.split_dir = dirs['split_dir']
+        self.rescaled_dir = dirs['rescaled_dir']
+        self.debiased_dir = dirs['debiased_dir']
+        self.wet_days_dir = dirs['wet_days_dir']
+        self.final_time_dir = dirs['final_time_dir']
+        # All directories are created here so that parallel processes don’t
+        # race to create them.
+        for d in dirs.values():
+            if not os.path.isdir(d):
+                cprint(f"Directory '{d}' does not exist yet. I will create "
+                       "it.", 'yellow')
+                os.makedirs(d, exist_ok=True)
+
+        # Remove the remains of tasks that were interrupted when a previous
+        # run was killed. All running tasks are recorded in the journal.
+        self.journal = open_journal(self.heap, journal_name)
+
+        # The checksums of the data in each finished file are recorded so
+        # that two runs can be compared with `--verify`.
+        if opts.get('checksums', 'yes') == 'yes':
+            open_manifest(self.heap, self.out_dir, checksums_name)
+
+        # Finished tasks, throughput, and ETA are written to the heap and
+        # summarized on the terminal (see `trace_for_guess.progress`).
+        self.progress = open_progress(self.heap)
+
+        # The heap manager evicts intermediary files from the heap as soon as
+        # all stages reading them have finished.
+        self.heap_manager = create_heap_manager(opts)
+
+        # Memory-hungry stages only start if they fit into the memory, core,
+        # and file budget of all running tasks (see
+        # `trace_for_guess.resources`).
+        self.budget = create_budget(opts)
+
+        # Cached results of the processing stages:
+        self.regrid_template_file = None
+        self.prec_std_file = None
+        self.bias_files = None  # key=TraCE variable; value=file path
+        self.cropped_files = dict()  # key=original TraCE filename
+        self.split_files = dict()  # key=original TraCE filename
+        # Slice years of the original TraCE files whose time axis doesn’t
+        # match their names (see `correct_slice_years()`):
+        self.slice_years = read_slice_years(self.heap)
+        self.results = dict()  # key=(stage, var, first_year); value=path
+
+    def get_regrid_template(self):
+        """Get the cropped template file that defines the output grid."""
+        if self.regrid_template_file is not None:
+            return self.regrid_template_file
+        # We unzip into `heap_input` so that any unzipped files are available
+        # like original input files.
+        regrid_template_file = unzip_files_if_needed(
+            filenames=[self.opts['regrid_template_file']],
+            unzip_dir=self.heap_input
+        )[0]
+        self.regrid_template_file = crop_file(
+            regrid_template_file,
+            os.path.join(self.cropped_dir, 'regrid_template_file.nc'),
+            self.extent
+        )
+        return self.regrid_template_file
+
+    def get_prec_std_file(self):
+        """Get the file with the standard deviation of CRU-JRA precipitation.
+        """
+        if self.prec_std_file is not None:
+            return self.prec_std_file
+        cprint(f'Going to gather input CRU-JRA files.', 'magenta')
+        crujra_files = unzip_files_if_needed(
+            filenames=get_crujra_filenames(),
+            unzip_dir=self.heap_input)
+        cprint('Going to crop CRU-JRA files and calculate precipitation '
+               'standard deviation.', 'magenta')
+        crujra_files = crop_file_list(crujra_files, self.cropped_dir,
+                                      self.extent)
+        for f in crujra_files:
+            self.heap_manager.register(f, consumers=1)
+        self.prec_std_file = get_prec_standard_deviation(
+            crujra_files, os.path.join(self.heap, 'prec_std.nc'))
+        for f in crujra_files:
+            self.heap_manager.release(f, self.prec_std_file)
+        return self.prec_std_file
+
+    def get_cru_mean_files(self):
+        """Aggregate CRU files to monthly means.
+
+        Returns:
+            Dictionary with the CRU variable as key and the file path as value.
+        """
+        cprint(f'Going to gather input CRU files.', 'magenta')
+        cru_files = unzip_files_if_needed(
+            filenames=get_cru_filenames(),
+            unzip_dir=self.heap_input)
+        cru_mean_files = dict()
+        cprint(f'Going to aggregate CRU files.', 'magenta')
+        for var in ['cld', 'pre', 'tmp', 'wet']:
+            # Filter list of all CRU files to file names containing `var`.
+            files_with_var = [f for f in cru_files if var in f]
+            # Concatenating, cropping, and aggregating are all CDO operators,
+            # so they run as one chained CDO command without intermediate
+            # files.
+            cru_mean_files[var] = run_cdo_chain(
+                in_files=files_with_var,
+                out_file=os.path.join(self.heap, '%s_mean.nc' % var),
+                operators=['mergetime', get_crop_operator(self.extent),
+                           'ymonmean']
+            )
+            # NOTE: We assume that the CRU files are in the desired resolution.
+        return cru_mean_files
+
+    def get_modern_trace_files(self):
+        """Calculate monthly means of the global modern TraCE data.
+
+        We need them to calculate the bias. They don’t depend on the region
+        and are stored in the heap input directory.
+
+        Returns:
+            Dictionary with the TraCE variable as key and the file path as
+            value.
+        """
+        # NOTE: We calculate the means first and then add PRECC and PRECL in
+        # the assumption that the order doesn’t make a difference.
+        cprint(f'Going to calculate means of TraCE data from modern time.',
+               'magenta')
+        modern_trace_files = dict()
+        for var in ['CLDTOT', 'PRECC', 'PRECL', 'TREFHT']:
+            out_file = f'modern_trace_{var}.nc'
+            modern_trace_files[var] = aggregate_modern_trace(
+                trace_file=find_files(get_modern_trace_filename(var)),
+                out_file=os.path.join(self.heap_input, out_file)
+            )
+        # Merge PRECC and PRECL into PRECT and convert from m/s to kg/m²/s.
+        modern_trace_files['PRECT'] = add_precc_and_precl_to_prect(
+            precc_file=modern_trace_files['PRECC'],
+            precl_file=modern_trace_files['PRECL'],
+            prect_file=os.path.join(self.heap_input, 'modern_trace_PRECT.nc')
+        )
+        del modern_trace_files['PRECC']
+        del modern_trace_files['PRECL']
+        return modern_trace_files
+
+    def get_modern_trace_series(self, trace_var):
+        """Extract the monthly values of the modern years from global TraCE.
+
+        The years are the same as in the CRU-JRA dataset. They are used for
+        quantile mapping and are stored in the heap input directory.
+
+        Returns:
+            Path to the file with the TraCE variable.
+        """
+        years = len(get_crujra_filenames())
+        series = dict()
+        for var in (['PRECC', 'PRECL'] if trace_var == 'PRECT'
+                    else [trace_var]):
+            series[var] = extract_modern_years(
+                trace_file=find_files(get_modern_trace_filename(var)),
+                out_file=os.path.join(self.heap_input,
+                                      f'modern_trace_series_{var}.nc'),
+                years=years
+            )
+        if trace_var != 'PRECT':
+            return series[trace_var]
+        return add_precc_and_precl_to_prect(
+            precc_file=series['PRECC'],
+            precl_file=series['PRECL'],
+            prect_file=os.path.join(self.heap_input,
+                                    'modern_trace_series_PRECT.nc')
+        )
+
+    def get_crujra_mean_file(self, crujra_var):
+        """Aggregate the CRU-JRA files of one variable to monthly means.
+
+        Returns:
+            Path to the file with the monthly means of all CRU-JRA years.
+        """
+        crujra_files = unzip_files_if_needed(
+            filenames=get_crujra_filenames(crujra_var),
+            unzip_dir=self.heap_input)
+        return run_cdo_chain(
+            in_files=crujra_files,
+            out_file=os.path.join(self.heap,
+                                  f'crujra_{crujra_var}_monthly_mean.nc'),
+            operators=['mergetime', get_crop_operator(self.extent), 'monmean']
+        )
+
+    def get_quantile_vars(self):
+        """Get the TraCE variables that are debiased with quantile mapping.
+
+        Raises:
+            ValueError: There are no CRU-JRA data for such a variable.
+        """
+        quantile_vars = [v for v in self.opts['cru_vars'] if get_method(
+            get_method_name(v, self.opts.get('bias_methods'))).samples]
+        for var in quantile_vars:
+            if var not in self.opts.get('crujra_vars', dict()):
+                raise ValueError('Quantile mapping is not possible for '
+                                 f"'{var}' because it is not in "
+                                 '`crujra_vars`.')
+        return quantile_vars
+
+    def get_bias_files(self):
+        """Calculate the bias TraCE vs. CRU for all variables in the options.
+
+        Returns:
+            Dictionary with the TraCE variable as key and the file path as
+            value.
+        """
+        if self.bias_files is not None:
+            return self.bias_files
+        cru_mean_files = self.get_cru_mean_files()
+        modern_trace_files = self.get_modern_trace_files()
+        # Rescale modern TraCE files in heap/rescaled.
+        for var in modern_trace_files:
+            modern_trace_files[var] = rescale_file(
+                in_file=modern_trace_files[var],
+                out_file=os.path.join(
+                    self.rescaled_dir,
+                    os.path.basename(modern_trace_files[var])),
+                template_file=self.get_regrid_template(),
+                alg=self.opts['regrid_algorithm'],
+                engine=self.opts.get('regrid_engine', 'ncremap'),
+                weights_dir=self.heap
+            )
+        cprint(f'Going to calculate bias TraCE vs. CRU.', 'magenta')
+        bias_files = dict()
+        for trace_var in self.opts['cru_vars']:
+            cru_var = self.opts['cru_vars'][trace_var]
+            method = get_method_name(trace_var, self.opts.get('bias_methods'))
+            if trace_var in self.get_quantile_vars():
+                crujra_var = self.opts['crujra_vars'][trace_var]
+                series_file = self.get_modern_trace_series(trace_var)
+                bias_files[trace_var] = calculate_quantile_bias(
+                    trace_file=rescale_file(
+                        in_file=series_file,
+                        out_file=os.path.join(self.rescaled_dir,
+                                              os.path.basename(series_file)),
+                        template_file=self.get_regrid_template(),
+                        alg=self.opts['regrid_algorithm'],
+                        engine=self.opts.get('regrid_engine', 'ncremap'),
+                        weights_dir=self.heap
+                    ),
+                    trace_var=trace_var,
+                    crujra_file=self.get_crujra_mean_file(crujra_var),
+                    crujra_var=crujra_var,
+                    bias_file=get_bias_file(self.heap, trace_var, method),
+                    method=method
+                )
+                continue
+            bias_files[trace_var] = calculate_bias(
+                trace_file=modern_trace_files[trace_var],
+                trace_var=trace_var,
+                cru_file=cru_mean_files[cru_var],
+                cru_var=cru_var,
+                bias_file=get_bias_file(self.heap, trace_var, method),
+                method=method
+            )
+        self.bias_files = bias_files
+        return self.bias_files
+
+    def get_input_file(self, var, trace_filename):
+        """Find an original TraCE file or derive it from other TraCE files.
+
+        PRECT is calculated as PRECC + PRECL. FSDSCL is calculated from FSDS,
+        FSDSC, and CLDTOT. Both are created in a special directory in the heap,
+        which will automatically be searched like an input directory.
+
+        Args:
+            var: The TraCE variable.
+            trace_filename: The original TraCE filename for `var` (without
+                path).
+
+        Returns:
+            Path to the input file.
+        """
+        if var == 'PRECT':
+            precc = find_files(re.sub('PRECT', 'PRECC', trace_filename))
+            precl = find_files(re.sub('PRECT', 'PRECL', trace_filename))
+            return add_precc_and_precl_to_prect(
+                precc_file=precc,
+                precl_file=precl,
+                prect_file=os.path.join(self.heap_input, trace_filename)
+            )
+        if var == 'FSDSCL':
+            return calculate_fsdscl(
+                cldtot_file=find_files(
+                    re.sub('FSDSCL', 'CLDTOT', trace_filename)),
+                fsds_file=find_files(re.sub('FSDSCL', 'FSDS', trace_filename)),
+                fsdsc_file=find_files(
+                    re.sub('FSDSCL', 'FSDSC', trace_filename)),
+                out_file=os.path.join(self.heap_input, trace_filename)
+            )
+        return find_files(trace_filename)
+
+    def get_cropped_files(self, var, trace_filenames):
+        """Crop several original TraCE files of one variable.
+
+        Args:
+            var: The TraCE variable.
+            trace_filenames: List of original TraCE filenames (without path).
+
+        Returns:
+            List of paths to the cropped files in the same order.
+        """
+        missing = [n for n in trace_filenames if n not in self.cropped_files]
+        if missing:
+            cprint(f"Going to crop TraCE files of variable '{var}'.",
+                   'magenta')
+            in_files = [self.get_input_file(var, n) for n in missing]
+            cropped = crop_file_list(in_files, self.cropped_dir,
+                                     self.trace_extent)
+            # Each cropped file is read once for the time unit conversion.
+            for f in cropped:
+                self.heap_manager.register(f, consumers=1)
+            self.cropped_files.update(zip(missing, cropped))
+        return [self.cropped_files[n] for n in trace_filenames]
+
+    def get_split_files(self, var, trace_filename):
+        """Split one original TraCE file into 100-years slices.
+
+        Args:
+            var: The TraCE variable.
+            trace_filename: The original TraCE filename (without path).
+
+        Returns:
+            List of paths to the split files.
+        """
+        if trace_filename in self.split_files:
+            return self.split_files[trace_filename]
+        cropped_file = self.get_cropped_files(var, [trace_filename])[0]
+        cprint(f"Going to split TraCE file '{trace_filename}'.", 'magenta')
+        # In order for `cdo splitsel` to work, the time unit of the TraCE files
+        # must be converted from kaBP to a standard calendar.
+        f = convert_kabp_to_months(
+            cropped_file,
+            os.path.join(self.time_unit_dir, os.path.basename(cropped_file)))
+        self.heap_manager.release(cropped_file, f)
+        self.heap_manager.register(f, consumers=1)
+        split_files = split_file(
+            filename=f,
+            out_dir=self.split_dir,
+            slice_count=len(predict_slice_years(trace_filename,
+                                                self.slice_years))
+        )
+        self.heap_manager.release(f, split_files)
+        self.correct_slice_years(trace_filename, split_files)
+        # Each split file is read by one slice: by the rescaling stage or, in
+        # the fused chain, by `process_slice()`.
+        for g in split_files:
+            self.heap_manager.register(g, consumers=1)
+        self.split_files[trace_filename] = split_files
+        return self.split_files[trace_filename]
+
+    def correct_slice_years(self, trace_filename, split_files):
+        """Compare the years of the split files with their predicted names.
+
+        The slices are named from the years in the original TraCE filename
+        (see `get_slices()`). Only the first and last time step of each
+        split file are read. If they don’t match the prediction, the slices
+        are named after their time axis instead. These years are remembered
+        in the heap (see `save_slice_years()`), so that re-runs, the dry
+        run, and cluster shards use the same names. Evicted placeholders
+        (see `trace_for_guess.heap`) were checked when they were created.
+        """
+        expected = predict_slice_years(trace_filename, self.slice_years)
+        split_files = sorted(split_files)
+        if len(expected) != len(split_files):
+            expected = [None] * len(split_files)
+        years = list()
+        for (f, y) in zip(split_files, expected):
+            if y is None or not self.heap_manager.is_evicted(f):
+                actual = get_years_from_time_axis(f)
+                y = (actual['first_year'], actual['last_year'])
+            years.append(y)
+        if years == expected:
+            return
+        cprint(f"The years of the slices of '{trace_filename}' differ from "
+               'its file name. The slices are named after their time axis: '
+               f'{years}', 'yellow')
+        self.slice_years[trace_filename] = years
+        save_slice_years(self.heap, trace_filename, years)
+
+    def get_slices(self, var, trace_filename):
+        """Get all 100-years slices of one original TraCE file.
+
+        Args:
+            var: The TraCE variable.
+            trace_filename: The original TraCE filename (without path).
+
+        Returns:
+            Dictionary with the first year of the slice as key and the path
+            to the split file as value.
+        """
+        # The split files are sorted by the running number in their names.
+        split_files = sorted(self.get_split_files(var, trace_filename))
+        # The names are derived without calling `cdo` for each file. They have
+        # been checked against the time axis in `get_split_files()`.
+        basenames = [get_new_trace_name(first, last, var)
+                     for (first, last) in predict_slice_years(
+                         trace_filename, self.slice_years)]
+        slices = dict()
+        for f, basename in zip(split_files, basenames):
+            first_year = get_years_of_new_trace_name(basename)['first_year']
+            self.results[('basename', var, first_year)] = basename
+            slices[first_year] = f
+        return slices
+
+    def get_slice_years(self, var):
+        """Get the first years of all 100-years slices of a variable.
+
+        Args:
+            var: One of `OUTPUT_VARS` or `TRACE_VARS`.
+
+        Returns:
+            A sorted list of integers.
+        """
+        if var == 'WET':
+            var = 'PRECT'
+        years = list()
+        for name in get_trace_filenames(var, self.time_range):
+            years += list(self.get_slices(var, name))
+        return sorted(years)
+
+    def get_split_file(self, var, first_year):
+        """Find the split file for one 100-years slice.
+
+        Only the original TraCE file that covers `first_year` is split.
+
+        Raises:
+            ValueError: There is no slice starting with `first_year`.
+        """
+        key = ('split', var, first_year)
+        if key in self.results:
+            return self.results[key]
+        for name in get_trace_filenames(var, self.time_range):
+            first, last = get_model_years_of_trace_file(name)
+            # The model year in the filename can differ by one year from the
+            # year in the time axis.
+            if not first - 1 <= first_year <= last + 1:
+                continue
+            slices = self.get_slices(var, name)
+            if first_year in slices:
+                self.results[key] = slices[first_year]
+                return self.results[key]
+        raise ValueError(f"There is no slice of variable '{var}' starting in "
+                         f"year {first_year} within the time range "
+                         f"{self.time_range}.")
+
+    def get_basename(self, var, first_year):
+        """Get the output filename of one 100-years slice."""
+        if var == 'WET':
+            return re.sub('PRECT', 'WET',
+                          self.get_basename('PRECT', first_year))
+        key = ('basename', var, first_year)
+        if key not in self.results:
+            # The names are composed together with the list of slices.
+            self.get_split_file(var, first_year)
+        return self.results[key]
+
+    def get_rescaled(self, var, first_year):
+        """Rescale one slice to the resolution of the regrid template."""
+        key = ('rescaled', var, first_year)
+        if key in self.results:
+            return self.results[key]
+        in_file = self.get_split_file(var, first_year)
+        f = rescale_file(
+            in_file=in_file,
+            out_file=os.path.join(self.rescaled_dir,
+                                  self.get_basename(var, first_year)),
+            template_file=self.get_regrid_template(),
+            alg=self.opts['regrid_algorithm'],
+            engine=self.opts.get('regrid_engine', 'ncremap'),
+            weights_dir=self.heap
+        )
+        self.heap_manager.release(in_file, f)
+        # The files from the rescaling stage on have the high CRU resolution
+        # and take up most of the disk space. They are registered with the heap
+        # manager together with the number of stages reading them.
+        self.heap_manager.register(f, consumers=1)
+        self.results[key] = f
+        return f
+
+    def get_debiased(self, var, first_year):
+        """Debias one slice of CLDTOT, FSDS, PRECT, or TREFHT."""
+        key = ('debiased', var, first_year)
+        if key in self.results:
+            return self.results[key]
+        out_file = os.path.join(self.debiased_dir,
+                                self.get_basename(var, first_year))
+        bias_files = self.get_bias_files()
+        # All variables except FSDS can be debiased with one common function.
+        if var in bias_files:
+            rescaled_file = self.get_rescaled(var, first_year)
+            f = debias_trace_file(trace_file=rescaled_file,
+                                  bias_file=bias_files[var],
+                                  out_file=out_file)
+            self.heap_manager.release(rescaled_file, f)
+        elif var == 'FSDS':
+            consumed_files = [self.get_rescaled('FSDSC', first_year),
+                              self.get_rescaled('FSDSCL', first_year),
+                              self.get_debiased('CLDTOT', first_year)]
+            f = debias_fsds_file(fsdsc_file=consumed_files[0],
+                                 fsdscl_file=consumed_files[1],
+                                 cldtot_file=consumed_files[2],
+                                 out_file=out_file)
+            for g in consumed_files:
+                self.heap_manager.release(g, f)
+        else:
+            raise ValueError(f"Cannot debias variable '{var}'.")
+        # The debiased PRECT file is read for the wet days and for the time
+        # conversion. The debiased CLDTOT file is read by `debias_fsds_file()`.
+        if var == 'PRECT':
+            self.heap_manager.register(f, consumers=2)
+        else:
+            self.heap_manager.register(f, consumers=1)
+        self.results[key] = f
+        return f
+
+    def get_final_time(self, var, first_year):
+        """Convert one output slice to the time unit 'days since'."""
+        key = ('final_time', var, first_year)
+        if key in self.results:
+            return self.results[key]
+        basename = self.get_basename(var, first_year)
+        if var == 'WET':
+            prect_file = self.get_debiased('PRECT', first_year)
+            f = create_wet_days_file(prect_file, self.get_prec_std_file(),
+                                     os.path.join(self.wet_days_dir, basename))
+            self.heap_manager.release(prect_file, f)
+            self.heap_manager.register(f, consumers=1)
+        else:
+            f = self.get_debiased(var, first_year)
+        days_file = convert_months_to_days(
+            f, os.path.join(self.final_time_dir, basename))
+        self.heap_manager.release(f, days_file)
+        self.results[key] = days_file
+        return days_file
+
+    def get_slice(self, var, first_year):
+        """Create one 100-years slice of an output variable.
+
+        Only the processing stages needed for this slice are run. If the
+        output file is already up-to-date, it is returned right away.
+
+        Args:
+            var: One of `OUTPUT_VARS`.
+            first_year: The first model year of the slice, as in the output
+                file names. Year 1 is 22,000 years BP.
+
+        Returns:
+            Path to the output file. If the output format is 'zarr', this is
+            the uncompressed slice in the heap that goes into the Zarr store.
+
+        Raises:
+            ValueError: `var` is not an output variable or there is no slice
+                starting in `first_year`.
+        """
+        if var not in OUTPUT_VARS:
+            raise ValueError(f"'{var}' is not an output variable. Choose one "
+                             f"of these: {OUTPUT_VARS}")
+        key = ('output', var, first_year)
+        if key in self.results:
+            return self.results[key]
+        self.heap_manager.throttle()
+        # Other processes sharing the heap wait for this task if the heap
+        # exceeds the disk quota (see `HeapManager.throttle()`).
+        with self.heap_manager.running_task():
+            if use_fused_chain(self.opts):
+                return self.get_fused_slice(var, first_year)
+            days_file = self.get_final_time(var, first_year)
+            if self.opts['output_format'] == 'zarr':
+                # In Zarr mode, the final time files are still needed for the
+                # Zarr stores and the CO₂ files.
+                self.results[key] = days_file
+                return days_file
+            self.heap_manager.register(days_file, consumers=1)
+            f = os.path.join(self.out_dir, self.get_basename(var, first_year))
+            # The metadata only need to be set if the output file is created
+            # anew. Only the complete file with metadata is given the final
+            # name.
+            if not skip(days_file, f):
+                with atomic_output(f) as tmp_file:
+                    compress_and_chunk(days_file, tmp_file)
+                    set_metadata(tmp_file)
+            self.heap_manager.release(days_file, f)
+            self.results[key] = f
+            return f
+
+    def get_fused_slice(self, var, first_year):
+        """Create one slice of an output variable in memory.
+
+        PRECT and WET are created together. See `get_slice()`.
+        """
+        trace_var = 'PRECT' if var == 'WET' else var
+        out_vars = ['PRECT', 'WET'] if trace_var == 'PRECT' else [var]
+        if self.opts['output_format'] == 'zarr':
+            # The slices are only needed for the Zarr stores and the CO₂
+            # files, so they don’t need to be compressed.
+            out_dir = self.final_time_dir
+            opts = dict(self.opts, compression_level=0)
+        else:
+            out_dir = self.out_dir
+            opts = self.opts
+        split_files = {v: self.get_split_file(v, first_year)
+                       for v in INPUT_VARS[trace_var]}
+        out_files = process_slice(
+            var=trace_var,
+            split_files=split_files,
+            out_files={v: os.path.join(out_dir,
+                                       self.get_basename(v, first_year))
+                       for v in out_vars},
+            template_file=self.get_regrid_template(),
+            bias_files=self.get_bias_files(),
+            prec_std_file=(self.get_prec_std_file() if trace_var == 'PRECT'
+                           else None),
+            opts=opts,
+            weights_dir=self.heap
+        )
+        for f in split_files.values():
+            self.heap_manager.release(f, list(out_files.values()))
+        for v in out_vars:
+            self.results[('output', v, first_year)] = out_files[v]
+        return out_files[var]
+
+    def run(self):
+        """Create all output files for the time range in the options.
+
+        If 'tiling' is enabled in the options, the region is processed in
+        tiles (see `trace_for_guess.tiles`).
+        """
+        if any(self.opts.get('tiling', dict()).get('size', [0, 0])):
+            from trace_for_guess.tiles import run_tiles
+            run_tiles(self)
+            return
+        # The plan of the dry run gives the total number of tasks for the
+        # progress report.
+        from trace_for_guess.dry_run import make_plan
+        self.progress.set_plan(make_plan(self.opts))
+        self.gather(self.get_output_files())
+
+    def get_output_files(self):
+        """Create all 100-years slices of all output variables.
+
+        Returns:
+            Dictionary with the output variable as key and the list of files
+            from `get_slice()` as value.
+        """
+        self.get_regrid_template()
+        self.get_prec_std_file()
+        self.get_bias_files()
+        # Crop all files of one variable at once.
+        for var in get_trace_vars(self.opts):
+            self.get_cropped_files(var, get_trace_filenames(var,
+                                                            self.time_range))
+        output_files = dict()  # key=output variable; value=list of paths
+        for var in OUTPUT_VARS:
+            cprint(f"Going to process TraCE files of variable '{var}'.",
+                   'magenta')
+            output_files[var] = [self.get_slice(var, y)
+                                 for y in self.get_slice_years(var)]
+        return output_files
+
+    def prepare_shared_inputs(self):
+        """Create the files in the heap input directory.
+
+        These are the unzipped input files, the modern TraCE means and (for
+        quantile mapping) series, and the derived TraCE files (see
+        `get_input_file()`). They don’t depend on the region, so they can be
+        shared by the tiles of the region (see `trace_for_guess.tiles`).
+        """
+        cprint(f'Going to gather input files.', 'magenta')
+        unzip_files_if_needed(
+            filenames=([self.opts['regrid_template_file']] +
+                       get_cru_filenames() + get_crujra_filenames()),
+            unzip_dir=self.heap_input)
+        self.get_modern_trace_files()
+        for var in self.get_quantile_vars():
+            self.get_modern_trace_series(var)
+            unzip_files_if_needed(
+                filenames=get_crujra_filenames(self.opts['crujra_vars'][var]),
+                unzip_dir=self.heap_input)
+        for var in get_trace_vars(self.opts):
+            for name in get_trace_filenames(var, self.time_range):
+                self.get_input_file(var, name)
+
+    def gather(self, output_files):
+        """Create the files that combine all slices.
+
+        These are the Zarr stores or concatenated files (depending on the
+        options), the daily weather files (if enabled), the CO₂ files, and the
+        gridlist.
+
+        Args:
+            output_files: Dictionary with the output variable as key and the
+                list of files from `get_slice()` as value.
+        """
+        if self.opts['output_format'] == 'zarr':
+            cprint(f'Writing output into Zarr stores.', 'magenta')
+            for var in output_files:
+                if not output_files[var]:
+                    continue
+                store = init_store(
+                    os.path.join(self.out_dir, get_store_name(var)), var,
+                    output_files[var])
+                # Each slice covers its own chunks in the store, so they could
+                # also be written by parallel workers.
+                for f in output_files[var]:
+                    write_slice_to_store(f, store, var)
+
+        concat_files = dict()  # key=TraCE variable; value=file path
+        if (self.opts['concatenate'] == 'yes' and
+                self.opts['output_format'] == 'netcdf'):
+            cprint(f'Joining output into monolithic files.', 'magenta')
+            for var in output_files:
+                concat_filename = derive_new_concat_trace_name(
+                    output_files[var], var)
+                concat_files[var] = cat_files(
+                    output_files[var],
+                    os.path.join(self.out_dir, concat_filename))
+        elif self.opts['concatenate'] not in ['yes', 'no']:
+            warnings.warn('Bad value in options.yaml for "concatenate". '
+                          'Use "yes" or "no".')
+
+        if self.opts.get('weather_generator', dict()).get('daily') == 'yes':
+            cprint(f'Generating daily weather.', 'magenta')
+            create_daily_slices(output_files, self.get_prec_std_file(),
+                                self.out_dir, self.opts)
+
+        cprint(f'Going to create CO₂ files.', 'magenta')
+        # We choose 'FSDS' as the variable because those files still have the
+        # original TraCE "co2vmr" variable.
+        co2_input = list(output_files['FSDS'])
+        if 'FSDS' in concat_files:
+            co2_input += [concat_files['FSDS']]
+        create_co2_files(co2_input, self.out_dir)
+
+        cprint(f'Creating LPJ-GUESS gridlist file.', 'magenta')
+        # TODO: Use an output file for the gridlist since it must be the
+        # reference for NAN values.
+        create_gridlist(self.get_regrid_template(),
+                        os.path.join(self.out_dir, 'gridlist.txt'))
@@ -8,6 +8,7 @@ import subprocess
 
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
 from trace_for_guess.skip import skip
 
 
@@ -32,14 +33,9 @@ def get_prec_standard_deviation(filelist, out_file):
             raise FileNotFoundError(f"Cannot find file '{f}'.")
     if skip(filelist, out_file):
         return out_file
-    try:
-        cprint('Calculating standard deviation of precipitation...', 'yellow')
+    cprint('Calculating standard deviation of precipitation...', 'yellow')
+    with atomic_output(out_file) as tmp_file:
         subprocess.run(['cdo', 'ymonmean', '-monstd', '-cat', filelist[0],
-                        '-daysum'] + filelist[1:] + [out_file], check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+                        '-daysum'] + filelist[1:] + [tmp_file], check=True)
     cprint(f"Successfully created '{out_file}'.", 'green')
     return out_file
@@ -0,0 +1,257 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Progress and throughput of a run.
+#
+# Each finished task (see `trace_for_guess.journal.journal_task()`) appends a
+# JSON line to a progress file in the heap. All processes of a run append to
+# the same file, so the file is the common record of parallel workers (e.g.
+# the weather generator). Each process reads the lines of the others before it
+# writes its own, and its view of the progress covers all workers.
+#
+# The total number of tasks per stage comes from the plan of the dry run (see
+# `trace_for_guess.dry_run.make_plan()`). Without a plan (e.g. in a cluster
+# shard or a tile), only finished tasks and throughput are reported.
+#
+# Each line is a JSON object with these keys:
+# - 'time': Seconds since the epoch when the task finished.
+# - 'pid': Process ID of the worker.
+# - 'stage': Name of the stage (as in the plan).
+# - 'file': Path of the output file (or common prefix of the output files).
+# - 'files': Number of output files.
+# - 'bytes': Size of the output files.
+# - 'seconds': Duration of the task.
+# - 'done', 'total': Output files of the stage that are finished and planned.
+# - 'all_done', 'all_total': The same for all stages.
+# - 'mb_per_s': Throughput of the stage: output MB per second of task time.
+# - 'eta': Estimated seconds until all planned files are finished, from the
+#   rate of the most recent tasks. `None` without a plan.
+
+import collections
+import json
+import os
+import threading
+import time
+from glob import escape, glob
+
+from termcolor import cprint
+
+# Name of the progress file in the heap directory.
+PROGRESS_NAME = 'progress.jsonl'
+
+# Number of most recent tasks from which the rate for the ETA is calculated.
+RATE_WINDOW = 20
+
+# The progress that is used by `report_task()`. It is set with
+# `open_progress()`.
+_active_progress = None
+
+
+def format_duration(seconds):
+    """Format a duration in seconds compactly.
+
+    >>> format_duration(59)
+    '59s'
+    >>> format_duration(3725)
+    '1h02m'
+    >>> format_duration(180000)
+    '2d02h'
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'{seconds}s'
+    if seconds < 3600:
+        return f'{seconds // 60}m{seconds % 60:02}s'
+    if seconds < 86400:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02}m'
+    return f'{seconds // 86400}d{seconds % 86400 // 3600:02}h'
+
+
+class Progress:
+    """Record finished tasks and summarize the progress of all workers.
+
+    Args:
+        progress_file: Path to the progress file.
+    """
+
+    def __init__(self, progress_file):
+        self.progress_file = progress_file
+        self.lock = threading.Lock()
+        self.file = open(progress_file, 'a')
+        # Lines from previous runs are not counted.
+        self.read_position = self.file.tell()
+        self.planned = dict()  # key=absolute output path; value=stage
+        self.totals = collections.Counter()  # key=stage; value=files
+        self.done = collections.Counter()  # key=stage; value=files
+        self.bytes = collections.Counter()  # key=stage
+        self.seconds = collections.Counter()  # key=stage
+        # Time and number of files of the most recent tasks:
+        self.recent = collections.deque(maxlen=RATE_WINDOW)
+
+    def set_plan(self, stages):
+        """Set the total number of files per stage from a plan.
+
+        Args:
+            stages: List of stages as returned by
+                `trace_for_guess.dry_run.make_plan()`. Only the stages that
+                will run are counted.
+        """
+        with self.lock:
+            for s in stages:
+                if not s['run']:
+                    continue
+                for f in s['out_files']:
+                    self.planned[os.path.abspath(f)] = s['stage']
+                    self.totals[s['stage']] += 1
+
+    def get_files(self, path):
+        """Get the output files of a task from its path or path prefix."""
+        if os.path.isfile(path):
+            return [path]
+        return sorted(f for f in glob(escape(path) + '*')
+                      if os.path.isfile(f) and not f.endswith('.tmp'))
+
+    def get_stage(self, files, path):
+        """Get the stage of a task from the plan or from its directory."""
+        for f in files:
+            if f in self.planned:
+                return self.planned[f]
+        return os.path.basename(os.path.dirname(path))
+
+    def count(self, event):
+        """Add a task event to the summary."""
+        stage = event['stage']
+        self.done[stage] += event['files']
+        self.bytes[stage] += event['bytes']
+        self.seconds[stage] += event['seconds']
+        self.recent.append((event['time'], event['files']))
+
+    def read_events(self):
+        """Count the complete lines that other workers have appended.
+
+        The lines of this process have already been counted in `report()`.
+        Lines that were written by this process before it was forked have
+        been counted by the parent process.
+        """
+        with open(self.progress_file, 'rb') as f:
+            f.seek(self.read_position)
+            text = f.read()
+        text = text[:text.rfind(b'\n') + 1]
+        self.read_position += len(text)
+        for line in text.decode().splitlines():
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event['pid'] != os.getpid():
+                self.count(event)
+
+    def get_all_done(self):
+        """Get the number of finished files of the planned stages."""
+        if not self.totals:
+            return sum(self.done.values())
+        return sum(min(self.done[s], self.totals[s]) for s in self.totals)
+
+    def get_eta(self):
+        """Estimate the seconds until all planned files are finished.
+
+        Returns:
+            The number of seconds or `None` if it cannot be estimated.
+        """
+        if not self.totals or len(self.recent) < 2:
+            return None
+        remaining = sum(self.totals.values()) - self.get_all_done()
+        span = self.recent[-1][0] - self.recent[0][0]
+        files = sum(n for (_, n) in list(self.recent)[1:])
+        if span <= 0 or files == 0:
+            return None
+        return round(max(remaining, 0) * span / files)
+
+    def report(self, path, seconds):
+        """Record a finished task and print a summary line.
+
+        Args:
+            path: Path of the output file or the common prefix of the output
+                files of the task.
+            seconds: Duration of the task.
+        """
+        path = os.path.abspath(path)
+        files = self.get_files(path)
+        event = {'time': round(time.time(), 3),
+                 'pid': os.getpid(),
+                 'stage': self.get_stage(files, path),
+                 'file': path,
+                 'files': len(files),
+                 'bytes': sum(os.path.getsize(f) for f in files),
+                 'seconds': round(seconds, 3)}
+        with self.lock:
+            self.read_events()
+            self.count(event)
+            stage = event['stage']
+            event['done'] = self.done[stage]
+            event['total'] = self.totals.get(stage)
+            event['all_done'] = self.get_all_done()
+            event['all_total'] = sum(self.totals.values()) or None
+            mb_per_s = self.bytes[stage] / 1e6 / max(self.seconds[stage],
+                                                     1e-3)
+            event['mb_per_s'] = round(mb_per_s, 2)
+            event['eta'] = self.get_eta()
+            line = json.dumps(event) + '\n'
+            self.file.write(line)
+            self.file.flush()
+            # Skip the own line unless other workers have written in between.
+            end = self.file.tell()
+            if end == self.read_position + len(line.encode()):
+                self.read_position = end
+        self.print_summary(event)
+
+    def print_summary(self, event):
+        """Print a compact line with the progress of the run and the stage."""
+        if event['total']:
+            stage = f"{event['stage']} {event['done']}/{event['total']}"
+        else:
+            stage = f"{event['stage']} {event['done']}"
+        if event['all_total']:
+            summary = f"{event['all_done']}/{event['all_total']} files"
+        else:
+            summary = f"{event['all_done']} files"
+        eta = ''
+        if event['eta'] is not None:
+            eta = f" | ETA {format_duration(event['eta'])}"
+        cprint(f"[{summary} | {stage} | {event['mb_per_s']:.1f} MB/s{eta}]",
+               'blue')
+
+    def close(self):
+        """Close the progress file."""
+        self.file.close()
+
+
+def open_progress(heap_dir, name=PROGRESS_NAME):
+    """Open the progress file in the heap and make it known to `report_task()`.
+
+    Args:
+        heap_dir: Path to the heap directory.
+        name: File name of the progress file in the heap directory.
+
+    Returns:
+        A `Progress` object.
+    """
+    global _active_progress
+    if _active_progress is not None:
+        _active_progress.close()
+    _active_progress = Progress(os.path.join(heap_dir, name))
+    return _active_progress
+
+
+def report_task(path, seconds):
+    """Record a finished task in the active progress file.
+
+    Without an open progress file (see `open_progress()`), nothing is done.
+
+    Args:
+        path: Path of the output file or the common prefix of the output
+            files of the task.
+        seconds: Duration of the task.
+    """
+    if _active_progress is not None:
+        _active_progress.report(path, seconds)
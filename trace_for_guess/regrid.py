@@ -0,0 +1,393 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Native regridding without external tools: The interpolation from the TraCE
+# grid to the grid of the regrid template is a linear map, so it is stored as
+# a sparse weight matrix with one row per target grid cell and one column per
+# source grid cell. Both grids are rectilinear, so the 2D weights are the
+# Kronecker product of the 1D weights along latitude and longitude. The
+# weights only depend on the coordinates, so they are calculated once for each
+# pair of grids and cached in the heap. Regridding a block of time steps is
+# then one sparse matrix multiplication.
+#
+# Longitudes are compared modulo 360°, so source and target grid may use
+# different longitude ranges (see `adjust_longitude()`) and a global source
+# grid is treated as periodic.
+#
+# Missing values in the source are handled by normalizing each target value
+# by the sum of the weights of the valid source cells. Target cells without
+# any valid source cell are missing.
+
+import hashlib
+import os
+
+from termcolor import cprint
+
+from trace_for_guess.combine_files import TIME_CHUNK, is_field
+from trace_for_guess.journal import atomic_output
+
+# The regrid algorithms that are implemented natively. The names are the same
+# as for ESMF and `ncremap`.
+ALGORITHMS = ['bilinear', 'conserve']
+
+# Target cells whose valid source weights sum up to less than this are set
+# to missing.
+MIN_WEIGHT = 1e-6
+
+
+def sort_longitude(lon):
+    """Order longitudes eastward, starting after the biggest gap.
+
+    Args:
+        lon: Array with longitude values in any range.
+
+    Returns:
+        A tuple (order, values, periodic): `order` contains the indices that
+        sort `lon`. `values` are the sorted longitudes, increasing
+        monotonically from the first value. `periodic` is True if the
+        longitudes circle the whole globe without a gap.
+
+    >>> sort_longitude([350, -5, 5, 15])
+    (array([0, 1, 2, 3]), array([350., 355., 365., 375.]), False)
+    """
+    import numpy as np
+    lon = np.asarray(lon, dtype='float64') % 360
+    order = np.argsort(lon, kind='stable')
+    values = lon[order]
+    gaps = np.diff(np.append(values, values[0] + 360))
+    start = (int(np.argmax(gaps)) + 1) % len(lon)
+    order = np.roll(order, -start)
+    values = np.roll(values, -start)
+    values = values[0] + (values - values[0]) % 360
+    periodic = len(lon) > 2 and gaps.max() < 1.5 * np.median(gaps)
+    return (order, values, bool(periodic))
+
+
+def get_edges(centers, periodic=False):
+    """Get the cell boundaries of sorted cell centers.
+
+    The boundaries lie halfway between the centers. The outer boundaries are
+    extrapolated by half a cell width. For periodic longitudes, the outer
+    boundaries lie halfway to the first cell of the next circle.
+
+    >>> get_edges([1., 2., 4.])
+    array([0.5, 1.5, 3. , 5. ])
+    >>> get_edges([0., 180.], periodic=True)
+    array([-90.,  90., 270.])
+    """
+    import numpy as np
+    centers = np.asarray(centers, dtype='float64')
+    if len(centers) < 2:
+        raise ValueError('Need at least two coordinate values to derive grid '
+                         'cell boundaries.')
+    middle = (centers[:-1] + centers[1:]) / 2
+    if periodic:
+        first = (centers[-1] - 360 + centers[0]) / 2
+        last = (centers[-1] + centers[0] + 360) / 2
+    else:
+        first = centers[0] - (centers[1] - centers[0]) / 2
+        last = centers[-1] + (centers[-1] - centers[-2]) / 2
+    return np.concatenate([[first], middle, [last]])
+
+
+def get_linear_weights(source, target):
+    """Get 1D linear interpolation weights for sorted coordinates.
+
+    Target values outside of the source range are not interpolated (all
+    weights zero).
+
+    Args:
+        source: Sorted source coordinates.
+        target: Target coordinates in the same range as `source`.
+
+    Returns:
+        Dense array of shape (len(target), len(source)).
+
+    >>> get_linear_weights([0., 10.], [2.5, 10., 11.])
+    array([[0.75, 0.25],
+           [0.  , 1.  ],
+           [0.  , 0.  ]])
+    """
+    import numpy as np
+    source = np.asarray(source, dtype='float64')
+    target = np.asarray(target, dtype='float64')
+    weights = np.zeros((len(target), len(source)))
+    i = np.clip(np.searchsorted(source, target, side='right') - 1, 0,
+                len(source) - 2)
+    inside = (target >= source[0]) & (target <= source[-1])
+    w = (target - source[i]) / (source[i + 1] - source[i])
+    rows = np.arange(len(target))[inside]
+    weights[rows, i[inside]] = 1 - w[inside]
+    weights[rows, i[inside] + 1] += w[inside]
+    return weights
+
+
+def get_overlap_weights(source_edges, target_edges):
+    """Get 1D conservative weights from the overlap of cell boundaries.
+
+    Args:
+        source_edges: Sorted boundaries of the source cells.
+        target_edges: Sorted boundaries of the target cells.
+
+    Returns:
+        Dense array of shape (target cells, source cells) with the fraction of
+        each target cell that is covered by each source cell.
+
+    >>> get_overlap_weights([0., 1., 2.], [0.5, 1.5])
+    array([[0.5, 0.5]])
+    """
+    import numpy as np
+    source_edges = np.asarray(source_edges, dtype='float64')
+    target_edges = np.asarray(target_edges, dtype='float64')
+    (s0, s1) = (source_edges[None, :-1], source_edges[None, 1:])
+    (t0, t1) = (target_edges[:-1, None], target_edges[1:, None])
+    overlap = np.clip(np.minimum(s1, t1) - np.maximum(s0, t0), 0, None)
+    return overlap / (t1 - t0)
+
+
+def get_latitude_weights(source, target, alg):
+    """Get the 1D weights along latitude.
+
+    For bilinear interpolation, target latitudes beyond the outermost source
+    latitudes take the value of the outermost source row. Conservative
+    weights are calculated on the sine of latitude so that they are
+    proportional to the area.
+
+    Returns:
+        Dense array of shape (len(target), len(source)).
+    """
+    import numpy as np
+    source = np.asarray(source, dtype='float64')
+    target = np.asarray(target, dtype='float64')
+    s_order = np.argsort(source)
+    t_order = np.argsort(target)
+    s = source[s_order]
+    t = target[t_order]
+    if alg == 'bilinear':
+        sorted_weights = get_linear_weights(s, np.clip(t, s[0], s[-1]))
+    else:
+        s_edges = get_edges(s)
+        # A global grid (e.g. the Gaussian TraCE grid) reaches the poles.
+        if s_edges[0] + 90 < s_edges[1] - s_edges[0]:
+            s_edges[0] = -90
+        if 90 - s_edges[-1] < s_edges[-1] - s_edges[-2]:
+            s_edges[-1] = 90
+        s_edges = np.sin(np.radians(np.clip(s_edges, -90, 90)))
+        t_edges = np.sin(np.radians(np.clip(get_edges(t), -90, 90)))
+        sorted_weights = get_overlap_weights(s_edges, t_edges)
+    weights = np.zeros_like(sorted_weights)
+    weights[np.ix_(t_order, s_order)] = sorted_weights
+    return weights
+
+
+def get_longitude_weights(source, target, alg):
+    """Get the 1D weights along longitude.
+
+    Target longitudes outside of a non-periodic source grid are not
+    interpolated.
+
+    Returns:
+        Dense array of shape (len(target), len(source)).
+    """
+    import numpy as np
+    (s_order, s, periodic) = sort_longitude(source)
+    (t_order, t, _) = sort_longitude(target)
+    if alg == 'bilinear':
+        if periodic:
+            # Close the circle with the first source cell.
+            s = np.append(s, s[0] + 360)
+            s_order = np.append(s_order, s_order[0])
+        # Shift the target longitudes into the range of the source.
+        t = s[0] + (t - s[0]) % 360
+        sorted_weights = get_linear_weights(s, t)
+        weights = np.zeros((len(target), len(source)))
+        for (column, i) in enumerate(s_order):
+            weights[t_order, i] += sorted_weights[:, column]
+        return weights
+    s_edges = get_edges(s, periodic)
+    t_edges = get_edges(t)
+    # Shift the target cells so that they start within the first circle of
+    # the source cells. Then they may also overlap with the source cells one
+    # circle further east.
+    t_edges += s_edges[0] + (t_edges[0] - s_edges[0]) % 360 - t_edges[0]
+    sorted_weights = (get_overlap_weights(s_edges, t_edges) +
+                      get_overlap_weights(s_edges + 360, t_edges))
+    weights = np.zeros_like(sorted_weights)
+    weights[np.ix_(t_order, s_order)] = sorted_weights
+    return weights
+
+
+def get_weights(source_lat, source_lon, target_lat, target_lon, alg):
+    """Calculate the sparse weight matrix between two rectilinear grids.
+
+    Args:
+        source_lat: Latitude values of the source grid.
+        source_lon: Longitude values of the source grid.
+        target_lat: Latitude values of the target grid.
+        target_lon: Longitude values of the target grid.
+        alg: One of `ALGORITHMS`.
+
+    Returns:
+        Sparse matrix (CSR) of shape (target cells, source cells). The cells
+        are numbered in C order of (lat, lon).
+
+    Raises:
+        NotImplementedError: `alg` is not in `ALGORITHMS`.
+    """
+    import scipy.sparse
+    if alg not in ALGORITHMS:
+        raise NotImplementedError(f"Regrid algorithm '{alg}' is not "
+                                  f'implemented natively. Choose one of '
+                                  f"{ALGORITHMS} or the regrid engine "
+                                  "'ncremap'.")
+    lat_weights = get_latitude_weights(source_lat, target_lat, alg)
+    lon_weights = get_longitude_weights(source_lon, target_lon, alg)
+    weights = scipy.sparse.kron(scipy.sparse.csr_matrix(lat_weights),
+                                scipy.sparse.csr_matrix(lon_weights),
+                                format='csr')
+    weights.eliminate_zeros()
+    return weights
+
+
+def get_weights_file(source_lat, source_lon, target_lat, target_lon, alg,
+                     weights_dir):
+    """Get the path of the cached weights for two grids.
+
+    The file name contains a hash of the coordinates, so different grids
+    don’t share a weights file.
+    """
+    import numpy as np
+    digest = hashlib.sha1(alg.encode())
+    for values in [source_lat, source_lon, target_lat, target_lon]:
+        digest.update(np.asarray(values, dtype='float64').tobytes())
+        digest.update(b'|')
+    return os.path.join(weights_dir,
+                        f'weights_{alg}_{digest.hexdigest()[:16]}.npz')
+
+
+def load_weights(source_lat, source_lon, target_lat, target_lon, alg,
+                 weights_dir):
+    """Load the weights for two grids from the cache or calculate them.
+
+    Args:
+        weights_dir: Directory for the cached weights files.
+
+    Returns:
+        Sparse matrix from `get_weights()`.
+    """
+    import scipy.sparse
+    weights_file = get_weights_file(source_lat, source_lon, target_lat,
+                                    target_lon, alg, weights_dir)
+    if os.path.isfile(weights_file):
+        return scipy.sparse.load_npz(weights_file).tocsr()
+    cprint(f"Calculating regrid weights '{weights_file}'...", 'yellow')
+    weights = get_weights(source_lat, source_lon, target_lat, target_lon, alg)
+    os.makedirs(weights_dir, exist_ok=True)
+    with atomic_output(weights_file) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            scipy.sparse.save_npz(f, weights)
+    return weights
+
+
+def apply_weights(weights, block, row_sums=None):
+    """Regrid a block of maps with a weight matrix.
+
+    Args:
+        weights: Sparse matrix from `get_weights()`.
+        block: (Masked) array of shape (..., source lat, source lon).
+        row_sums: Optional precalculated sum of each row in `weights`.
+
+    Returns:
+        Masked array of shape (..., target cells).
+    """
+    import numpy as np
+    shape = block.shape[:-2]
+    values = block.reshape((-1, block.shape[-2] * block.shape[-1]))
+    valid = ~np.ma.getmaskarray(values)
+    if valid.all():
+        numerator = (weights @ np.ma.getdata(values).T).T
+        if row_sums is None:
+            row_sums = np.asarray(weights.sum(axis=1)).ravel()
+        denominator = np.broadcast_to(row_sums, numerator.shape)
+    else:
+        filled = np.where(valid, np.ma.getdata(values), 0)
+        numerator = (weights @ filled.T).T
+        denominator = (weights @ valid.T.astype('float64')).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = numerator / denominator
+    result = np.ma.masked_where(denominator < MIN_WEIGHT, result)
+    return result.reshape(shape + (weights.shape[0],))
+
+
+def regrid_file(in_file, out_file, template_file, alg, weights_dir):
+    """Regrid all maps in a NetCDF file to the grid of a template file.
+
+    Variables with latitude and longitude dimension are regridded in blocks
+    of `TIME_CHUNK` time steps. Latitude and longitude must be the last two
+    dimensions. Variables with only one of the two dimensions (e.g. Gaussian
+    weights) are dropped. All other variables and all attributes are copied.
+    The output file has the same format as the input file.
+
+    Args:
+        in_file: Path of input file.
+        out_file: Output file path.
+        template_file: Path to a NetCDF file that has the desired grid.
+        alg: One of `ALGORITHMS`.
+        weights_dir: Directory for the cached weights files.
+
+    Raises:
+        ValueError: Latitude and longitude are not the last dimensions of a
+            map.
+    """
+    import netCDF4
+    import numpy as np
+    with netCDF4.Dataset(template_file, 'r') as template:
+        target = {d: template.variables[d][:] for d in ['lat', 'lon']}
+        target_attrs = {d: {a: template.variables[d].getncattr(a)
+                            for a in template.variables[d].ncattrs()}
+                        for d in target}
+    with netCDF4.Dataset(in_file, 'r') as src, \
+            netCDF4.Dataset(out_file, 'w', format=src.data_model) as out:
+        source = {d: src.variables[d][:] for d in ['lat', 'lon']}
+        weights = load_weights(source['lat'], source['lon'], target['lat'],
+                               target['lon'], alg, weights_dir)
+        row_sums = np.asarray(weights.sum(axis=1)).ravel()
+        out.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+        for (name, dim) in src.dimensions.items():
+            size = len(target[name]) if name in target else len(dim)
+            out.createDimension(name, None if dim.isunlimited() else size)
+        for (name, var) in src.variables.items():
+            spatial = [d for d in var.dimensions if d in target]
+            if spatial and name not in target and not is_field(var):
+                continue
+            if is_field(var) and var.dimensions[-2:] != ('lat', 'lon'):
+                raise ValueError(f"Variable '{name}' in '{in_file}' doesn’t "
+                                 'have latitude and longitude as last '
+                                 'dimensions.')
+            attrs = {a: var.getncattr(a) for a in var.ncattrs()}
+            fill_value = attrs.pop('_FillValue', None)
+            if is_field(var) and fill_value is None:
+                fill_value = netCDF4.default_fillvals[var.dtype.str[1:]]
+            new_var = out.createVariable(name, var.dtype, var.dimensions,
+                                         fill_value=fill_value)
+            if name in target:
+                new_var.setncatts(target_attrs[name])
+                new_var[:] = target[name]
+                continue
+            new_var.setncatts(attrs)
+            if not is_field(var):
+                new_var[:] = var[:]
+                continue
+            shape = (len(target['lat']), len(target['lon']))
+            steps = var.shape[0] if var.ndim > 2 else 1
+            for start in range(0, steps, TIME_CHUNK):
+                end = min(start + TIME_CHUNK, steps)
+                block = var[start:end] if var.ndim > 2 else var[:]
+                result = apply_weights(weights, block, row_sums)
+                result = result.reshape(block.shape[:-2] + shape)
+                if var.ndim > 2:
+                    new_var[start:end] = result.astype(var.dtype)
+                else:
+                    new_var[:] = result.astype(var.dtype)
+
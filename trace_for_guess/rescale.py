@@ -8,11 +8,19 @@ import subprocess
 
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.regrid import regrid_file
+from trace_for_guess.resources import reserve
 from trace_for_guess.skip import skip
 
+# Programs for regridding: 'native' uses `regrid_file()` with cached weights,
+# 'ncremap' calls the NCO command for each file.
+ENGINES = ['native', 'ncremap']
 
-def rescale_file(in_file, out_file, template_file, alg):
-    """Regrid a NetCDF file using NCO (i.e. the ncremap command).
+
+def rescale_file(in_file, out_file, template_file, alg, engine='ncremap',
+                 weights_dir=None):
+    """Regrid a NetCDF file natively or using NCO (i.e. the ncremap command).
 
     Args:
         in_file: Path of input file.
@@ -21,13 +29,18 @@ def rescale_file(in_file, out_file, template_file, alg):
             resolution.
         alg: ESMF regrid algorithm. See here:
             http://www.earthsystemmodeling.org/esmf_releases/public/ESMF_6_3_0rp1/ESMF_refdoc/node3.html#SECTION03020000000000000000
+        engine: One of `ENGINES`.
+        weights_dir: Directory for the cached weights of the native engine.
+            By default the directory of `out_file`.
 
     Returns:
         The output file (`out_file`).
 
     Raises:
         FileNotFoundError: If `in_file` or `template_file` doesn’t exist.
-        RuntimeError: The `cdo` command is not in the PATH.
+        NotImplementedError: `alg` is not implemented natively.
+        ValueError: `engine` is not one of `ENGINES`.
+        RuntimeError: The `ncremap` command is not in the PATH.
         RuntimeError: The `ncremap` command failed or produced no output
             file.
     """
@@ -36,22 +49,29 @@ def rescale_file(in_file, out_file, template_file, alg):
     if not os.path.isfile(template_file):
         raise FileNotFoundError("Template file doesn’t exist: '%s'" %
                                 template_file)
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown regrid engine '{engine}'. Choose one of "
+                         f'{ENGINES}.')
     if skip([in_file, template_file], out_file):
         return out_file
+    if engine == 'native':
+        cprint("Regridding '%s'..." % in_file, 'yellow')
+        with reserve('regrid', [in_file]), \
+                atomic_output(out_file) as tmp_file:
+            regrid_file(in_file, tmp_file, template_file, alg,
+                        weights_dir or os.path.dirname(out_file))
+        cprint(f"Successfully created '{out_file}'.", 'green')
+        return out_file
     if shutil.which("ncremap") is None:
         raise RuntimeError("Executable `ncremap` not found.")
     cprint("Regridding '%s'..." % in_file, 'yellow')
-    try:
+    with reserve('ncremap', [in_file]), \
+            atomic_output(out_file) as tmp_file:
         subprocess.run(["ncremap",
                         "--algorithm=%s" % alg,
                         "--template_file=%s" % template_file,
                         "--input_file=%s" % in_file,
-                        "--output_file=%s" % out_file], check=True)
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+                        "--output_file=%s" % tmp_file], check=True)
     if not os.path.isfile(out_file):
         raise RuntimeError("Regridding with `ncremap` failed: No output file "
                            "created.")
@@ -0,0 +1,401 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Resource budget for all tasks running at the same time on one machine.
+#
+# Memory-hungry stages (e.g. `ncremap`, loading arrays with xarray, fused
+# slices) can run in parallel threads (cropping), processes (tiles, the
+# weather generator), and local cluster shards. Before such a stage starts,
+# it reserves memory, CPU cores, and open files (see `reserve()`). It is
+# admitted only if the reservations of all running tasks plus its own fit into
+# the budget from 'options.yaml' and if the memory is actually available. A
+# task that is too big for the budget on its own is admitted only when
+# nothing else is running.
+#
+# The reservations are kept in a ledger file in the heap, which is locked
+# while it is read and changed. So all processes of a run (also local cluster
+# shards) share one budget. Entries of processes that don’t exist anymore are
+# ignored. Entries from other machines (cluster nodes sharing the heap) are
+# ignored, too, because each machine has its own budget.
+#
+# The memory of a task is estimated from the size of its input files with a
+# factor for each type of stage. While the task runs, the resident memory of
+# the process and its child processes is sampled. The peak usage above
+# `BASE_MEMORY` updates the factor of the stage type in a profile file in the
+# heap, so the estimates improve from run to run. The factor follows the
+# observations smoothly, small inputs count less, and it is capped. So one
+# small task with a high fixed overhead doesn’t inflate the estimates of the
+# large tasks. If a running task uses more memory than it has reserved, its
+# reservation is raised right away, and queued tasks have to wait for it.
+# When several tasks run in threads of the same process, their usage is not
+# separated, so the learned factors err on the safe side.
+
+import contextlib
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+
+from termcolor import cprint
+
+# Name of the file in the heap directory with the reservations of all
+# running tasks.
+LEDGER_NAME = 'resource_ledger.json'
+
+# Name of the file in the heap directory with the learned memory factors.
+PROFILE_NAME = 'resource_profile.json'
+
+# Memory of a task that doesn’t scale with its input [bytes].
+BASE_MEMORY = 200e6
+
+# Initial guesses for the memory of a task in relation to the size of its
+# input files. They are replaced by learned factors (see above).
+MEMORY_FACTORS = {
+    'bias': 4.0,  # All modern years are loaded and converted.
+    'cdo': 0.5,  # CDO streams time steps.
+    'crop': 0.2,  # `ncks` hyperslabs.
+    'daily': 2.0,
+    'debias': 2.5,
+    'ncremap': 3.0,
+    'regrid': 2.5,
+    'slice': 3.0,  # All stages of a slice in memory.
+    'split': 0.5,
+    'wet_days': 4.0,
+}
+
+# Factor for stage types without a guess.
+DEFAULT_MEMORY_FACTOR = 2.0
+
+# Maximum learned factor. Higher observations are taken as this value.
+MAX_MEMORY_FACTOR = 20.0
+
+# Weight of a new observation in the learned factor when the task needed less
+# memory than estimated.
+LEARNING_RATE = 0.2
+
+# Weight of a new observation in the learned factor when the task needed more
+# memory than estimated. The factor rises faster than it falls to stay on the
+# safe side.
+RISE_RATE = 0.5
+
+# Seconds between two samples of the memory usage of a running task.
+SAMPLE_INTERVAL = 0.5
+
+# Seconds between two attempts to admit a queued task.
+WAIT_INTERVAL = 2
+
+# The budget that is used by `reserve()`. It is set with `activate()`.
+_active_budget = None
+
+# Whether the current thread holds a reservation. Nested reservations are not
+# counted.
+_local = threading.local()
+
+
+def get_available_memory():
+    """Get the memory that is available for new processes [bytes].
+
+    Returns:
+        The value of 'MemAvailable' in '/proc/meminfo' or `None` if it
+        cannot be read (e.g. not on Linux).
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_tree_memory(pid=None):
+    """Get the resident memory of a process and all its descendants [bytes].
+
+    Only works on Linux. Processes that end while they are read are skipped.
+
+    Args:
+        pid: Process ID. By default the current process.
+    """
+    if pid is None:
+        pid = os.getpid()
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        try:
+            with open(f'/proc/{p}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in os.listdir(f'/proc/{p}/task'):
+                with open(f'/proc/{p}/task/{task}/children') as f:
+                    pids += [int(c) for c in f.read().split()]
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def is_alive(pid):
+    """Whether a process with this ID exists on this machine."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MemorySampler(threading.Thread):
+    """Sample the memory usage of this process tree while a task runs.
+
+    Args:
+        on_sample: Function that is called with the peak memory increase
+            since the start [bytes] after each sample.
+    """
+
+    def __init__(self, on_sample):
+        super().__init__(daemon=True)
+        self.on_sample = on_sample
+        self.baseline = get_tree_memory()
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        """Take one sample and report it."""
+        self.peak = max(self.peak, get_tree_memory() - self.baseline)
+        self.on_sample(self.peak)
+
+    def stop(self):
+        """Stop sampling and return the peak memory increase [bytes]."""
+        self.stopped.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+
+class ResourceBudget:
+    """Admit tasks only if they fit into the memory, core, and file budget.
+
+    Args:
+        heap_dir: Path to the heap directory with the ledger and the profile.
+        memory: Maximum memory of all running tasks in bytes. 0 or `None`
+            means no limit other than the available memory.
+        cores: Maximum number of CPU cores of all running tasks. 0 or `None`
+            means the number of CPUs.
+        files: Maximum number of open files of all running tasks. 0 or
+            `None` means no limit.
+    """
+
+    def __init__(self, heap_dir, memory=None, cores=None, files=None):
+        self.ledger_file = os.path.join(heap_dir, LEDGER_NAME)
+        self.profile_file = os.path.join(heap_dir, PROFILE_NAME)
+        self.limits = {'memory': memory or float('inf'),
+                       'cores': cores or os.cpu_count(),
+                       'files': files or float('inf')}
+        self.host = socket.gethostname()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Lock the ledger and the profile against other processes."""
+        with open(self.ledger_file + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def read_json(self, path):
+        """Read a JSON file or return an empty dictionary."""
+        if not os.path.isfile(path):
+            return dict()
+        with open(path) as f:
+            return json.load(f)
+
+    def write_json(self, path, content):
+        """Replace a JSON file atomically."""
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(content, f, indent=1)
+        os.replace(tmp_file, path)
+
+    def read_ledger(self):
+        """Read the reservations of running tasks on this machine."""
+        return {k: v for (k, v) in self.read_json(self.ledger_file).items()
+                if v['host'] != self.host or is_alive(v['pid'])}
+
+    def estimate_memory(self, stage, input_bytes):
+        """Estimate the memory of a task from the size of its input [bytes]."""
+        with self.locked():
+            profile = self.read_json(self.profile_file)
+        factor = profile.get(stage, {}).get(
+            'factor', MEMORY_FACTORS.get(stage, DEFAULT_MEMORY_FACTOR))
+        return BASE_MEMORY + min(factor, MAX_MEMORY_FACTOR) * input_bytes
+
+    def fits(self, ledger, request):
+        """Whether a task can be admitted next to the running tasks."""
+        running = [v for v in ledger.values() if v['host'] == self.host]
+        if not running:
+            return True
+        for (resource, limit) in self.limits.items():
+            used = sum(v[resource] for v in running)
+            if used + request[resource] > limit:
+                return False
+        available = get_available_memory()
+        return available is None or request['memory'] <= available
+
+    def acquire(self, stage, request):
+        """Wait until the task fits into the budget and reserve it.
+
+        Args:
+            stage: Type of the stage (key in `MEMORY_FACTORS`).
+            request: Dictionary with 'memory' [bytes], 'cores', and 'files'.
+
+        Returns:
+            Key of the reservation in the ledger.
+        """
+        key = f'{self.host}:{os.getpid()}:{threading.get_ident()}'
+        waiting = False
+        while True:
+            with self.locked():
+                ledger = self.read_ledger()
+                if self.fits(ledger, request):
+                    ledger[key] = dict(request, stage=stage, host=self.host,
+                                       pid=os.getpid())
+                    self.write_json(self.ledger_file, ledger)
+                    return key
+            if not waiting:
+                cprint(f"Waiting for resources to run stage '{stage}' "
+                       f"({request['memory'] / 1e9:.1f} GB, "
+                       f"{request['cores']} core(s))...", 'yellow')
+                waiting = True
+            time.sleep(WAIT_INTERVAL)
+
+    def raise_reservation(self, key, memory):
+        """Raise the reserved memory of a running task if it uses more."""
+        with self.locked():
+            ledger = self.read_ledger()
+            if key in ledger and memory > ledger[key]['memory']:
+                ledger[key]['memory'] = memory
+                self.write_json(self.ledger_file, ledger)
+
+    def release(self, key, stage, input_bytes, peak):
+        """Remove a reservation and learn from the observed memory.
+
+        Args:
+            key: Key of the reservation (see `acquire()`).
+            stage: Type of the stage.
+            input_bytes: Size of the input files.
+            peak: Observed peak memory increase of the process tree during
+                the task [bytes].
+        """
+        with self.locked():
+            ledger = self.read_ledger()
+            ledger.pop(key, None)
+            self.write_json(self.ledger_file, ledger)
+            if input_bytes <= 0:
+                return
+            profile = self.read_json(self.profile_file)
+            entry = profile.setdefault(stage, {
+                'factor': MEMORY_FACTORS.get(stage, DEFAULT_MEMORY_FACTOR),
+                'samples': 0})
+            factor = min(entry['factor'], MAX_MEMORY_FACTOR)
+            observed = max(peak - BASE_MEMORY, 0) / input_bytes
+            observed = min(observed, MAX_MEMORY_FACTOR)
+            rate = RISE_RATE if observed > factor else LEARNING_RATE
+            # The factor from a small input is dominated by the fixed
+            # overhead and the noise of the measurement, so it counts less.
+            rate *= input_bytes / (input_bytes + BASE_MEMORY)
+            entry['factor'] = factor + rate * (observed - factor)
+            entry['samples'] += 1
+            self.write_json(self.profile_file, profile)
+
+    @contextlib.contextmanager
+    def reserve(self, stage, in_files, cores=1):
+        """Reserve resources for a task while the context is active."""
+        input_bytes = sum(os.path.getsize(f) for f in in_files
+                          if os.path.isfile(f))
+        request = {'memory': self.estimate_memory(stage, input_bytes),
+                   'cores': cores,
+                   'files': len(in_files) + 1}
+        key = self.acquire(stage, request)
+
+        def on_sample(peak):
+            if peak > request['memory']:
+                self.raise_reservation(key, peak)
+
+        sampler = MemorySampler(on_sample)
+        sampler.start()
+        try:
+            yield
+        finally:
+            self.release(key, stage, input_bytes, sampler.stop())
+
+
+def activate(budget):
+    """Make the budget known to `reserve()`."""
+    global _active_budget
+    _active_budget = budget
+
+
+def get_active_budget():
+    """Get the budget set with `activate()` or `None`."""
+    return _active_budget
+
+
+def create_budget(opts):
+    """Create and activate a resource budget from the 'options.yaml' settings.
+
+    Processes that are forked from a process with an active budget (e.g.
+    tiles) keep the budget of their parent, so that they share its ledger.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+
+    Returns:
+        A `ResourceBudget` object.
+    """
+    if get_active_budget() is not None:
+        return get_active_budget()
+    settings = opts.get('resources', dict())
+    budget = ResourceBudget(opts['directories']['heap'],
+                            memory=settings.get('memory', 0) * 1e9,
+                            cores=settings.get('cores', 0),
+                            files=settings.get('open_files', 0))
+    activate(budget)
+    return budget
+
+
+@contextlib.contextmanager
+def reserve(stage, in_files, cores=1):
+    """Run a task within the resource budget.
+
+    The context waits until the task fits into the budget (see
+    `ResourceBudget`). Without an active budget (see `create_budget()`) or
+    within another reservation of the same thread, nothing is done.
+
+    Use it like this:
+
+        with reserve('ncremap', [in_file]):
+            subprocess.run(['ncremap', ...], check=True)
+
+    Args:
+        stage: Type of the stage (key in `MEMORY_FACTORS`).
+        in_files: List of input files. Their size determines the memory
+            estimate.
+        cores: Number of CPU cores the task uses.
+    """
+    budget = get_active_budget()
+    if budget is None or getattr(_local, 'reserved', False):
+        yield
+        return
+    _local.reserved = True
+    try:
+        with budget.reserve(stage, in_files, cores):
+            yield
+    finally:
+        _local.reserved = False
@@ -6,35 +6,39 @@ import os
 
 from termcolor import cprint
 
+from trace_for_guess.heap import get_active_manager
 
-def is_younger(filename, other_files):
-    """Check if the modification of a given file is younger than other file(s).
+# Cache of modification times of existing files for the duration of the run:
+# key=path; value=mtime. Output files are dropped from the cache as soon as
+# `skip()` decides that they will be (re-)created.
+_mtimes = dict()
 
-    Args:
-        filename: Path to the file in question.
-        other_files: A list of files to compare against. It can also be a
-            single file.
+
+def get_mtime(filename):
+    """Get the modification time of a file from the stat cache.
 
     Returns:
-        True if none of the other files have been modified since the the file
-        in question has been modified. False if at least one of the other files
-        has a younger modification timestamp.
+        The modification time or `None` if the file doesn’t exist.
+    """
+    if filename not in _mtimes:
+        try:
+            _mtimes[filename] = os.stat(filename).st_mtime
+        except FileNotFoundError:
+            return None
+    return _mtimes[filename]
 
-    Raises:
-        FileNotFoundError: One of the given files does not exist.
+
+def forget_mtimes(filelist=None):
+    """Remove files from the stat cache because they will change.
+
+    Args:
+        filelist: List of file paths. If `None`, the whole cache is cleared.
     """
-    if not os.path.isfile(filename):
-        raise FileNotFoundError(f"File not found: '{filename}'")
-    # Allow for single file path string as input instead of a list.
-    if not isinstance(other_files, list):
-        other_files = [other_files]
-    for f in other_files:
-        if not os.path.isfile(f):
-            raise FileNotFoundError("File not found: '%s'" % f)
-    for f in other_files:
-        if os.path.getmtime(f) > os.path.getmtime(filename):
-            return False
-    return True
+    if filelist is None:
+        _mtimes.clear()
+        return
+    for f in filelist:
+        _mtimes.pop(f, None)
 
 
 def remove_outdated_files(filelist):
@@ -49,6 +53,20 @@ def remove_outdated_files(filelist):
         if os.path.isfile(f):
             cprint(f"Removing outdated file '{f}'.", 'red')
             os.remove(f)
+    forget_mtimes(filelist)
+
+
+def check_not_evicted(heap_manager, in_files):
+    """Make sure that none of the input files is an evicted placeholder.
+
+    Raises:
+        RuntimeError: An input file has been evicted from the heap.
+    """
+    for f in in_files:
+        if heap_manager.is_evicted(f):
+            raise RuntimeError(f"Input file '{f}' has been evicted from the "
+                               "heap, but it is needed again. Delete it and "
+                               "restart the script to create it anew.")
 
 
 def skip(in_files, out_files):
@@ -59,6 +77,11 @@ def skip(in_files, out_files):
     If only one input file is younger than an output file, all output files are
     removed, and `False` is returned.
 
+    Output files that have been evicted from the heap (see
+    `trace_for_guess.heap`) count as existing as long as the files produced
+    from them are up-to-date. Otherwise they are removed so that they are
+    created again.
+
     Args:
         in_files: List of files that are used to create `out_files`. Can also
             be a single file path.
@@ -71,23 +94,36 @@ def skip(in_files, out_files):
 
     Raises:
         FileNotFoundError: One of the input files was not found.
+        RuntimeError: An input file has been evicted from the heap, but the
+            output files need to be created.
     """
     # Allow for single file path string as input instead of a list.
     if not isinstance(in_files, list):
         in_files = [in_files]
     if not isinstance(out_files, list):
         out_files = [out_files]
-    for f in in_files:
-        if not os.path.isfile(f):
+    # Each file is only stat-ed once per run (see `get_mtime()`).
+    in_mtimes = [get_mtime(f) for f in in_files]
+    for f, mtime in zip(in_files, in_mtimes):
+        if mtime is None:
             raise FileNotFoundError("File not found: '%s'" % f)
-    for i in in_files:
+    heap_manager = get_active_manager()
+    if heap_manager:
         for o in out_files:
-            if not os.path.isfile(o):
-                remove_outdated_files(out_files)
-                return False
-            if is_younger(i, o):
-                remove_outdated_files(out_files)
-                return False
+            if (heap_manager.is_evicted(o) and
+                    not heap_manager.products_are_current(o)):
+                heap_manager.restore(o)
+                forget_mtimes([o])
+    # The output files must be younger than the youngest input file.
+    newest_input = max(in_mtimes, default=None)
+    for o in out_files:
+        mtime = get_mtime(o)
+        if mtime is None or (newest_input is not None and
+                             mtime <= newest_input):
+            remove_outdated_files(out_files)
+            if heap_manager:
+                check_not_evicted(heap_manager, in_files)
+            return False
     for f in out_files:
         cprint(f"Skipping: '{f}'", 'cyan')
     return True
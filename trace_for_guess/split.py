@@ -5,14 +5,17 @@
 import os
 import shutil
 import subprocess
-from glob import glob
+from glob import escape, glob
 
 from termcolor import cprint
 
+from trace_for_guess.checksums import record_checksums
+from trace_for_guess.journal import get_tmp_name, journal_task
+from trace_for_guess.resources import reserve
 from trace_for_guess.skip import skip
 
 
-def split_file(filename, out_dir):
+def split_file(filename, out_dir, slice_count=None):
     """Split a NetCDF file into 100 years files.
 
     Create 100 years files (1200 time steps, 12*100 months) for each
@@ -24,6 +27,10 @@ def split_file(filename, out_dir):
     Args:
         filename: Path of input NetCDF file.
         out_dir: Output directory path.
+        slice_count: Optional number of slices the file will be split into
+            (see `predict_slice_years()`). If given, the names of existing
+            output files are composed directly instead of searching the
+            output directory.
 
     Raises:
         FileNotFoundError: If `filename` or `out_dir` was not found.
@@ -45,19 +52,32 @@ def split_file(filename, out_dir):
     stub_name = os.path.splitext(os.path.basename(filename))[0] + '_'
     stub_path = os.path.join(out_dir, stub_name)
     # We assume that if there are any files obviously created by `cdo
-    # splitsel`, these will be complete. If the creation of files had been
-    # interrupted, all files would have been deleted in the except-block.
-    existing_files = glob(stub_path + '*')
+    # splitsel`, these will be complete. They are created under a temporary
+    # name and renamed only after all of them have been written. If the
+    # creation of files had been interrupted, all files would have been
+    # deleted in the except-block or, after a crash, by the journal (see
+    # `trace_for_guess.journal`).
+    if slice_count is None:
+        existing_files = glob(stub_path + '*')
+    else:
+        existing_files = [f'{stub_path}{i:06}.nc' for i in range(slice_count)]
     if existing_files and skip(filename, existing_files):
         return existing_files
     cprint(f"Splitting file '{filename}' into 100-years slices...", 'yellow')
     if shutil.which("cdo") is None:
         raise RuntimeError("Executable `cdo` not found.")
+    tmp_stub = get_tmp_name(stub_path)
     try:
         years = 100
         timesteps = 12 * years
-        subprocess.run(['cdo', f'splitsel,{timesteps}', filename, stub_path],
-                       check=True)
+        with reserve('split', [filename]), journal_task(stub_path):
+            subprocess.run(['cdo', f'splitsel,{timesteps}', filename,
+                            tmp_stub], check=True)
+            for f in sorted(glob(escape(tmp_stub) + '*')):
+                os.replace(f, stub_path + f[len(tmp_stub):])
+                # The split files are not written with `atomic_output()`, so
+                # their checksums are recorded here.
+                record_checksums(stub_path + f[len(tmp_stub):])
     except Exception:
         for f in glob(stub_path + '*'):
             cprint(f"Removing file '{f}'.", 'red')
@@ -0,0 +1,324 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Spatial tiling for very large regions: The region is divided into
+# rectangular tiles (option 'tiling' in 'options.yaml'). Each tile runs the
+# whole per-slice processing chain in its own process with its own heap
+# directory. The TraCE files of a tile are cropped with the same margin around
+# the tile as for the whole region (see `expand_extent()` in `Pipeline`), so
+# the regridding at the tile borders sees the same neighbouring TraCE cells as
+# without tiling. The final output files of all tiles are then joined into one
+# output file per slice and variable on the grid of the whole region.
+#
+# The input files that don’t depend on the region (unzipped files, modern
+# TraCE means, and derived TraCE files) are created once before the tiles are
+# started, and all tiles read them from the input directory of the heap.
+
+import copy
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from termcolor import cprint
+
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.skip import skip
+
+
+def get_tiles(extent, size):
+    """Divide a region into rectangular tiles.
+
+    Tiles at the eastern and northern border can be smaller than `size`.
+
+    Args:
+        extent: The region as a list of [lon1, lon2, lat1, lat2] (see
+            `check_region()`).
+        size: The tile size in degrees as a list [lon, lat]. A value of 0
+            means that the tiles span the whole region in that direction.
+
+    Returns:
+        List of tiles, each as a list of [lon1, lon2, lat1, lat2].
+
+    >>> get_tiles([130, 230, 50, 80], [50, 0])
+    [[130, 180, 50, 80], [180, 230, 50, 80]]
+    >>> get_tiles([130, 230, 50, 80], [0, 20])
+    [[130, 230, 50, 70], [130, 230, 70, 80]]
+
+    Circle around 0° longitude:
+    >>> get_tiles([340, 20, 0, 10], [20, 0])
+    [[340, 360, 0, 10], [0, 20, 0, 10]]
+
+    Whole globe:
+    >>> len(get_tiles([0, 360, -90, 90], [90, 90]))
+    8
+    """
+    (lon1, lon2, lat1, lat2) = extent
+    width = (lon2 - lon1) % 360 or 360
+    height = lat2 - lat1
+    (lon_size, lat_size) = size
+    lon_size = lon_size or width
+    lat_size = lat_size or height
+    tiles = list()
+    for j in range(math.ceil(height / lat_size)):
+        south = lat1 + j * lat_size
+        north = min(south + lat_size, lat2)
+        for i in range(math.ceil(width / lon_size)):
+            west = (lon1 + i * lon_size) % 360
+            east = (lon1 + min((i + 1) * lon_size, width)) % 360 or 360
+            tiles.append([west, east, south, north])
+    return tiles
+
+
+def get_tile_opts(opts, index, extent):
+    """Derive the options for one tile from the options of the whole region.
+
+    Each tile has its own heap and output directory inside the heap of the
+    region, but shares the input directory of the heap.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+        index: Index of the tile in `get_tiles()`.
+        extent: The tile as a list of [lon1, lon2, lat1, lat2].
+
+    Returns:
+        A new options dictionary.
+    """
+    from trace_for_guess.pipeline import get_directories
+    dirs = get_directories(opts)
+    tile_heap = os.path.join(dirs['heap'], 'tiles', f'tile_{index:03}')
+    tile_opts = copy.deepcopy(opts)
+    tile_opts['region'] = {'lon': extent[:2], 'lat': extent[2:]}
+    tile_opts['directories'] = {
+        'heap': tile_heap,
+        'output': os.path.join(tile_heap, 'output'),
+        'heap_input': dirs['heap_input']
+    }
+    # The tiles are joined slice by slice, so they need the NetCDF slices.
+    tile_opts['output_format'] = 'netcdf'
+    tile_opts['concatenate'] = 'no'
+    tile_opts['tiling'] = {'size': [0, 0]}
+    return tile_opts
+
+
+def run_tile(opts, index, extent):
+    """Create all output files of one tile.
+
+    Args:
+        opts: Dictionary with the content of 'options.yaml'.
+        index: Index of the tile in `get_tiles()`.
+        extent: The tile as a list of [lon1, lon2, lat1, lat2].
+
+    Returns:
+        Dictionary with the output variable as key and the list of output
+        files of the tile as value.
+    """
+    from trace_for_guess.pipeline import Pipeline
+    cprint(f'Processing tile {index}: {extent}', 'magenta')
+    return Pipeline(get_tile_opts(opts, index, extent)).get_output_files()
+
+
+def get_coordinate_keys(values, is_lon):
+    """Get comparable keys for coordinate values of different files.
+
+    Longitudes are compared modulo 360° because the cropped files can use
+    different longitude ranges (see `adjust_longitude()`).
+
+    >>> get_coordinate_keys([-10.25, 350.25, 0.75], is_lon=True)
+    [349.75, 350.25, 0.75]
+    """
+    if is_lon:
+        return [round(float(v) % 360, 4) for v in values]
+    return [round(float(v), 4) for v in values]
+
+
+def get_target_indices(target_keys, keys):
+    """Find the positions of coordinate keys in the target coordinates.
+
+    Args:
+        target_keys: Coordinate keys of the joined file.
+        keys: Coordinate keys of one tile.
+
+    Returns:
+        A tuple (source, target): `source` is an array of the indices in
+        `keys` that are part of the target grid and `target` their positions
+        in `target_keys`, sorted in ascending order. If the target positions
+        are contiguous, `target` is a slice.
+
+    >>> get_target_indices([1, 2, 3, 4], [4, 3, 9])
+    (array([1, 0]), slice(2, 4, None))
+    """
+    import numpy as np
+    position = {k: i for (i, k) in enumerate(target_keys)}
+    pairs = sorted((position[k], i) for (i, k) in enumerate(keys)
+                   if k in position)
+    target = np.array([t for (t, _) in pairs], dtype=int)
+    source = np.array([s for (_, s) in pairs], dtype=int)
+    if len(target) and target[-1] - target[0] + 1 == len(target):
+        target = slice(int(target[0]), int(target[-1]) + 1)
+    return (source, target)
+
+
+def mosaic_files(tile_files, out_file, template_file, compression_level,
+                 chunks):
+    """Join the output files of several tiles into one file.
+
+    The grid of the joined file is the grid of the template file of the whole
+    region. Coordinates of a tile that are not in the template grid are
+    ignored. Variables without latitude or longitude dimension and all
+    attributes are copied from the first tile. The data of each tile is read
+    in blocks of latitude rows and written into the compressed and chunked
+    output file directly, so each output chunk is written only once.
+
+    Args:
+        tile_files: List of output files of one slice and variable from all
+            tiles.
+        out_file: Path to the joined output file (will not be overwritten).
+        template_file: The cropped regrid template of the whole region.
+        compression_level: Deflation level (0 to 9).
+        chunks: Dictionary with the chunk size for the dimensions.
+
+    Returns:
+        Path to the output file (equals `out_file`).
+
+    Raises:
+        FileNotFoundError: One of the input files is missing.
+    """
+    import netCDF4
+    for f in tile_files + [template_file]:
+        if not os.path.isfile(f):
+            raise FileNotFoundError(f"Input file not found: '{f}'")
+    if skip(tile_files + [template_file], out_file):
+        return out_file
+    cprint(f"Joining {len(tile_files)} tiles into '{out_file}'...", 'yellow')
+    with netCDF4.Dataset(template_file, 'r') as template:
+        coords = {'lat': template.variables['lat'][:],
+                  'lon': template.variables['lon'][:]}
+    target_keys = {d: get_coordinate_keys(coords[d], d == 'lon')
+                   for d in coords}
+    with atomic_output(out_file) as tmp_file, \
+            netCDF4.Dataset(tile_files[0], 'r') as first, \
+            netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as out:
+        out.setncatts({a: first.getncattr(a) for a in first.ncattrs()})
+        for (name, dim) in first.dimensions.items():
+            size = len(coords[name]) if name in coords else len(dim)
+            out.createDimension(name, None if dim.isunlimited() else size)
+        spatial = list()  # Variables with latitude or longitude dimension.
+        for (name, var) in first.variables.items():
+            attrs = {a: var.getncattr(a) for a in var.ncattrs()}
+            fill_value = attrs.pop('_FillValue', None)
+            kwargs = dict()
+            if 'lat' in var.dimensions and 'lon' in var.dimensions:
+                shape = [len(out.dimensions[d]) for d in var.dimensions]
+                kwargs = {'zlib': compression_level > 0,
+                          'complevel': compression_level,
+                          'chunksizes': [min(chunks.get(d, s), s) for (d, s)
+                                         in zip(var.dimensions, shape)]}
+            new_var = out.createVariable(name, var.dtype, var.dimensions,
+                                         fill_value=fill_value, **kwargs)
+            new_var.setncatts(attrs)
+            if name in coords:
+                new_var[:] = coords[name]
+            elif 'lat' in var.dimensions or 'lon' in var.dimensions:
+                spatial.append(name)
+            else:
+                new_var[:] = var[:]
+        for f in tile_files:
+            with netCDF4.Dataset(f, 'r') as tile:
+                indices = {d: get_target_indices(
+                    target_keys[d],
+                    get_coordinate_keys(tile.variables[d][:], d == 'lon'))
+                    for d in coords}
+                for name in spatial:
+                    copy_tile_variable(tile.variables[name],
+                                       out.variables[name], indices)
+    assert os.path.isfile(out_file)
+    cprint(f"Successfully created '{out_file}'.", 'green')
+    return out_file
+
+
+def copy_tile_variable(source, target, indices):
+    """Copy the values of one tile into the joined variable.
+
+    Variables with a time axis are copied in blocks of latitude rows.
+
+    Args:
+        source: The netCDF4 variable in the tile file.
+        target: The netCDF4 variable in the joined file.
+        indices: Dictionary with 'lat' and 'lon' as keys and the result of
+            `get_target_indices()` as values.
+    """
+    import numpy as np
+    from trace_for_guess.validate import get_block_rows
+    dims = source.dimensions
+    if any(len(indices[d][0]) == 0 for d in indices if d in dims):
+        return  # The tile is not part of the target grid.
+    write_index = [slice(None)] * source.ndim
+    if 'lon' in dims:
+        write_index[dims.index('lon')] = indices['lon'][1]
+    if 'lat' not in dims:
+        block = np.take(source[:], indices['lon'][0], axis=dims.index('lon'))
+        target[tuple(write_index)] = block
+        return
+    axis = dims.index('lat')
+    (lat_source, lat_target) = indices['lat']
+    rows = len(lat_source)
+    if 'time' in dims and 'lon' in dims:
+        rows = get_block_rows(source)
+    for start in range(0, len(lat_source), rows):
+        part = lat_source[start:start + rows]
+        # Read the contiguous range of source rows and select the target rows
+        # from it.
+        read_index = [slice(None)] * source.ndim
+        read_index[axis] = slice(int(part.min()), int(part.max()) + 1)
+        block = np.take(source[tuple(read_index)], part - part.min(),
+                        axis=axis)
+        if 'lon' in dims:
+            block = np.take(block, indices['lon'][0], axis=dims.index('lon'))
+        if isinstance(lat_target, slice):
+            write_index[axis] = slice(lat_target.start + start,
+                                      lat_target.start + start + len(part))
+        else:
+            write_index[axis] = lat_target[start:start + len(part)]
+        target[tuple(write_index)] = block
+
+
+def run_tiles(pipeline):
+    """Create all output files of the region tile by tile.
+
+    The tiles are processed in parallel processes. Afterwards the output files
+    of the tiles are joined and the files combining all slices are created
+    with `Pipeline.gather()`.
+
+    Args:
+        pipeline: The `Pipeline` object of the whole region.
+    """
+    opts = pipeline.opts
+    tiles = get_tiles(pipeline.extent, opts['tiling']['size'])
+    cprint(f'Going to process the region in {len(tiles)} tiles.', 'magenta')
+    # The tiles only read the shared input files, so they need to exist
+    # before the tiles are started.
+    pipeline.prepare_shared_inputs()
+    workers = opts['tiling'].get('workers') or None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tile_outputs = list(pool.map(run_tile, [opts] * len(tiles),
+                                     range(len(tiles)), tiles))
+    if opts['output_format'] == 'zarr':
+        # The Zarr stores are created from the joined files in the heap.
+        mosaic_dir = os.path.join(pipeline.heap, 'tiles', 'mosaic')
+    else:
+        mosaic_dir = pipeline.out_dir
+    os.makedirs(mosaic_dir, exist_ok=True)
+    cprint(f'Going to join the output files of all tiles.', 'magenta')
+    template_file = pipeline.get_regrid_template()
+    output_files = dict()  # key=output variable; value=list of paths
+    for var in tile_outputs[0]:
+        output_files[var] = list()
+        for (i, f) in enumerate(tile_outputs[0][var]):
+            output_files[var].append(mosaic_files(
+                tile_files=[t[var][i] for t in tile_outputs],
+                out_file=os.path.join(mosaic_dir, os.path.basename(f)),
+                template_file=template_file,
+                compression_level=opts['compression_level'],
+                chunks=opts['chunks']))
+    pipeline.gather(output_files)
@@ -10,6 +10,7 @@ import shutil
 from termcolor import cprint
 
 from trace_for_guess.find_input import find_files
+from trace_for_guess.journal import atomic_output
 
 
 def gunzip(filename, targetdir):
@@ -31,15 +32,11 @@ def gunzip(filename, targetdir):
         targetdir, re.sub('\\.gz$', '', os.path.basename(filename))
     )
     cprint(f"Decompressing '{filename}'...", 'yellow')
-    try:
-        with open(targetfile, 'xb') as o, gzip.open(filename, 'rb') as i:
-            shutil.copyfileobj(i, o)
-    except Exception:
-        # Clean up target file.
-        if os.path.isfile(targetfile):
-            cprint(f"Removing file '{targetfile}'...", 'red')
-            os.remove(targetfile)
-        raise
+    # The decompressed file appears under its name only when it is complete.
+    # Otherwise `find_files()` could find a partial file on a re-run.
+    with atomic_output(targetfile) as tmp_file, \
+            open(tmp_file, 'xb') as o, gzip.open(filename, 'rb') as i:
+        shutil.copyfileobj(i, o)
     assert targetfile
     assert os.path.isfile(targetfile)
     cprint(f"Successfully created file '{targetfile}'.", 'green')
@@ -0,0 +1,232 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Validation of the final output files: Are there missing values in grid cells
+# of the gridlist? Are the values physically plausible? Is the time axis
+# continuous within and between the 100-years files?
+
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+from termcolor import cprint
+
+from trace_for_guess.filenames import get_years_of_new_trace_name
+
+# Plausible value ranges [min, max] of the output variables in the units of
+# the output files. Values outside of these ranges indicate a processing error.
+VALID_RANGES = {
+    'FSDS': [0.0, 500.0],  # [W/m²]
+    'PRECT': [0.0, 0.002],  # [kg/m²/s] (= 173 mm/day)
+    'TREFHT': [173.15, 333.15],  # [K] (= -100 to +60 °C)
+    'WET': [0, 31],  # [days]
+}
+
+# Range of the length of one monthly time step in days.
+MONTH_LENGTHS = [28, 31]
+
+# Approximate number of values that are read at once from one file.
+BLOCK_SIZE = 2**24  # = 64 MB in float32
+
+# Name of the summary file in the output directory.
+SUMMARY_FILE = 'validation.txt'
+
+
+def read_gridlist(gridlist_file):
+    """Read the grid cell indices from a CF gridlist file.
+
+    Returns:
+        List of (lon index, lat index) tuples.
+    """
+    with open(gridlist_file) as f:
+        return [tuple(int(i) for i in line.split()[:2])
+                for line in f if line.strip()]
+
+
+def get_block_rows(variable):
+    """Get the number of latitude rows to read at once from a variable.
+
+    The output files are chunked by grid cell (see 'chunks' in
+    'options.yaml'). Reading the whole time axis for a multiple of the
+    latitude chunk size decompresses each chunk exactly once.
+    """
+    shape = dict(zip(variable.dimensions, variable.shape))
+    chunking = variable.chunking()
+    lat_chunk = 1
+    if chunking != 'contiguous':
+        lat_chunk = chunking[variable.dimensions.index('lat')]
+    rows = BLOCK_SIZE // max(shape['time'] * shape['lon'], 1)
+    return max(rows // lat_chunk, 1) * lat_chunk
+
+
+def get_file_statistics(filename, var, gridlist):
+    """Calculate summary statistics of one output file.
+
+    The data is read in blocks of latitude rows along the chunk layout of the
+    file. All statistics are calculated with vectorized numpy reductions.
+
+    Args:
+        filename: Path to the output NetCDF file.
+        var: The output variable in the file.
+        gridlist: List of (lon index, lat index) tuples from the gridlist.
+
+    Returns:
+        Dictionary with the statistics of the file.
+    """
+    import netCDF4
+    import numpy as np
+    stats = {'file': os.path.basename(filename), 'var': var,
+             'min': np.nan, 'max': np.nan, 'missing': 0,
+             'missing_in_gridlist': 0, 'problems': []}
+    with netCDF4.Dataset(filename, 'r') as ds:
+        if var not in ds.variables:
+            stats['problems'].append(f"Variable '{var}' not found.")
+            return stats
+        variable = ds.variables[var]
+        time = ds.variables['time']
+        stats['time_units'] = time.units
+        times = time[:].astype('float64')
+        stats['first_time'] = float(times[0])
+        stats['last_time'] = float(times[-1])
+        steps = np.diff(times)
+        bad_steps = (steps < MONTH_LENGTHS[0]) | (steps > MONTH_LENGTHS[1])
+        if bad_steps.any():
+            stats['problems'].append(
+                f'{bad_steps.sum()} time steps are not monthly, e.g. between '
+                f'time {times[:-1][bad_steps][0]} and '
+                f'{times[1:][bad_steps][0]}.')
+        lat_count = len(ds.dimensions['lat'])
+        lon_count = len(ds.dimensions['lon'])
+        in_gridlist = np.zeros((lat_count, lon_count), dtype=bool)
+        for (x, y) in gridlist:
+            if x >= lon_count or y >= lat_count:
+                stats['problems'].append(f'Gridlist cell ({x}, {y}) is not '
+                                         'in the grid.')
+            else:
+                in_gridlist[y, x] = True
+        # Read the axes in the order (time, lat, lon).
+        axes = [variable.dimensions.index(d) for d in ['time', 'lat', 'lon']]
+        rows = get_block_rows(variable)
+        for start in range(0, lat_count, rows):
+            end = min(start + rows, lat_count)
+            index = [slice(None)] * variable.ndim
+            index[variable.dimensions.index('lat')] = slice(start, end)
+            block = np.ma.masked_invalid(variable[tuple(index)])
+            block = block.transpose(axes)
+            missing = np.ma.getmaskarray(block)
+            stats['missing'] += int(missing.sum())
+            stats['missing_in_gridlist'] += int(
+                missing[:, in_gridlist[start:end]].sum())
+            if missing.all():
+                continue
+            stats['min'] = np.nanmin([stats['min'], block.min()])
+            stats['max'] = np.nanmax([stats['max'], block.max()])
+    if stats['missing_in_gridlist']:
+        stats['problems'].append(f"{stats['missing_in_gridlist']} missing "
+                                 'values in grid cells of the gridlist.')
+    if var in VALID_RANGES:
+        (low, high) = VALID_RANGES[var]
+        if stats['min'] < low or stats['max'] > high:
+            stats['problems'].append(
+                f"Values [{stats['min']:g}, {stats['max']:g}] outside of "
+                f'plausible range [{low:g}, {high:g}].')
+    return stats
+
+
+def check_continuity(stats_list):
+    """Check that consecutive files of one variable follow without gap.
+
+    Files that cover the years of other files (concatenated files) are not
+    part of the sequence. Problems are appended to the statistics of the
+    later file.
+
+    Args:
+        stats_list: List of statistics from `get_file_statistics()` for one
+            variable. The names must match `derive_new_trace_name()`.
+    """
+    years = [get_years_of_new_trace_name(s['file']) for s in stats_list]
+    sequence = list()
+    for (s, y) in zip(stats_list, years):
+        covers_other = any(y is not other and
+                           y['first_year'] <= other['first_year'] and
+                           other['last_year'] <= y['last_year']
+                           for other in years)
+        if not covers_other:
+            sequence.append((y['first_year'], s))
+    sequence = [s for (_, s) in sorted(sequence, key=lambda x: x[0])]
+    for (previous, s) in zip(sequence[:-1], sequence[1:]):
+        last_year = get_years_of_new_trace_name(previous['file'])['last_year']
+        first_year = get_years_of_new_trace_name(s['file'])['first_year']
+        if first_year != last_year + 1:
+            s['problems'].append(f"Years don’t follow '{previous['file']}'.")
+        if 'first_time' not in s or 'first_time' not in previous:
+            continue
+        if s['time_units'] != previous['time_units']:
+            s['problems'].append('Time unit differs from '
+                                 f"'{previous['file']}'.")
+            continue
+        step = s['first_time'] - previous['last_time']
+        if not MONTH_LENGTHS[0] <= step <= MONTH_LENGTHS[1]:
+            s['problems'].append(f'Time gap of {step:g} days after '
+                                 f"'{previous['file']}'.")
+
+
+def write_summary(stats_list, summary_file):
+    """Write the statistics of all files as a tab-separated table."""
+    columns = ['file', 'var', 'min', 'max', 'missing', 'missing_in_gridlist']
+    with open(summary_file, 'w') as f:
+        f.write('\t'.join(columns + ['problems']) + '\n')
+        for s in stats_list:
+            f.write('\t'.join([str(s[c]) for c in columns] +
+                              ['; '.join(s['problems']) or 'OK']) + '\n')
+
+
+def validate_output(out_dir, workers=None):
+    """Validate all NetCDF output files in the output directory in parallel.
+
+    The files are expected to be named by `derive_new_trace_name()`. A summary
+    table is written to `SUMMARY_FILE` in `out_dir`.
+
+    Args:
+        out_dir: Path to the output directory with the file 'gridlist.txt'.
+        workers: Maximum number of parallel processes. By default the number
+            of CPUs.
+
+    Returns:
+        True if no problems were found, False otherwise.
+
+    Raises:
+        FileNotFoundError: The gridlist file is missing.
+    """
+    gridlist_file = os.path.join(out_dir, 'gridlist.txt')
+    if not os.path.isfile(gridlist_file):
+        raise FileNotFoundError(f"Gridlist file not found: '{gridlist_file}'")
+    gridlist = read_gridlist(gridlist_file)
+    files = dict()  # key=file path; value=variable
+    for f in sorted(glob(os.path.join(out_dir, 'trace_*.nc'))):
+        match_obj = re.match(r'trace_\d+-\d+_(.+)\.nc$', os.path.basename(f))
+        if match_obj:
+            files[f] = match_obj.group(1)
+    if not files:
+        cprint(f"No NetCDF output files found in '{out_dir}'.", 'red')
+        return False
+    cprint(f'Validating {len(files)} output files...', 'yellow')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        stats_list = list(pool.map(get_file_statistics, files.keys(),
+                                   files.values(),
+                                   [gridlist] * len(files)))
+    for var in set(files.values()):
+        check_continuity([s for s in stats_list if s['var'] == var])
+    summary_file = os.path.join(out_dir, SUMMARY_FILE)
+    write_summary(stats_list, summary_file)
+    for s in stats_list:
+        for problem in s['problems']:
+            cprint(f"{s['file']}: {problem}", 'red')
+    if any(s['problems'] for s in stats_list):
+        cprint(f"Validation failed. See summary in '{summary_file}'.", 'red')
+        return False
+    cprint(f"All output files are valid. Summary in '{summary_file}'.",
+           'green')
+    return True
@@ -0,0 +1,425 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Stochastic weather generator for models that need daily input.
+#
+# Daily precipitation and temperature are generated from the monthly output
+# files of one 100-years slice:
+# - Precipitation: A day is wet with the probability that the gamma
+#   distribution of daily precipitation exceeds the threshold (the same
+#   probability as for the wet days, see `trace_for_guess.wet_days`). The
+#   amounts of the wet days are drawn from that gamma distribution and then
+#   scaled so that the monthly sum equals the monthly TraCE value.
+# - Temperature: Normally distributed anomalies with a constant standard
+#   deviation are added to the monthly mean. The anomalies are centered so that
+#   the monthly mean is preserved.
+#
+# The random numbers come from a counter-based generator: each number is a
+# hash of the seed, the absolute day (in the time unit of the output files),
+# the absolute grid cell (from latitude and longitude), and a stream number.
+# So any slice and any tile of the region gets the same values, no matter in
+# which order or in which process it is generated. The slices are processed
+# one year (365 days) at a time, which is written to the output file before
+# the next year is read.
+
+import contextlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from termcolor import cprint
+
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.months import NOLEAP_DAYS_PER_MONTH, SECONDS_PER_DAY
+from trace_for_guess.netcdf_io import open_dataarray
+from trace_for_guess.resources import reserve
+from trace_for_guess.skip import skip
+from trace_for_guess.wet_days import get_gamma_cdf, get_gamma_parameters
+
+# Name of the subdirectory of the output directory for the daily files.
+DAILY_DIR = 'daily'
+
+# Random number streams for the different draws of one day and grid cell.
+# The gamma distribution takes two numbers for each attempt.
+WET_STREAM = 0
+BOOST_STREAM = 1
+TEMPERATURE_STREAM = 2
+GAMMA_STREAM = 3
+STREAMS = 16
+
+# Maximum number of attempts of the rejection method for gamma variates. The
+# probability that all attempts fail is below 1e-5.
+GAMMA_ATTEMPTS = 4
+
+# Number of distinct grid cell keys (see `get_cell_keys()`).
+CELL_KEYS = 18001 * 36000
+
+# Catch potential zero divide (like in `trace_for_guess.wet_days`).
+ALMOST_ZERO = 0.00000001
+
+
+def mix(x):
+    """Scramble 64-bit unsigned integers (the SplitMix64 finalizer).
+
+    >>> import numpy as np
+    >>> mix(np.array([0, 1], dtype='uint64')).tolist()
+    [0, 6238072747940578789]
+    """
+    import numpy as np
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def get_uniform(seed, counters, stream):
+    """Get uniformly distributed random numbers in the open interval (0, 1).
+
+    Args:
+        seed: Integer seed from the options.
+        counters: Array of unique unsigned 64-bit integers for each day and
+            grid cell (see `get_counters()`).
+        stream: Number of the draw for the same day and grid cell.
+
+    Returns:
+        Float64 array of the same shape as `counters`.
+
+    >>> import numpy as np
+    >>> u = get_uniform(1, np.arange(100000, dtype='uint64'), 0)
+    >>> bool(0 < u.min() and u.max() < 1 and abs(u.mean() - 0.5) < 0.01)
+    True
+    """
+    import numpy as np
+    key = mix(np.array([seed], dtype='uint64') +
+              np.uint64(0x9E3779B97F4A7C15))
+    x = mix((counters * np.uint64(STREAMS) + np.uint64(stream)) ^ key)
+    return ((x >> np.uint64(11)).astype('float64') + 0.5) * 2.0**-53
+
+
+def get_cell_keys(lat, lon):
+    """Get a unique number for each grid cell from its coordinates.
+
+    The coordinates are rounded to 0.01°, so the keys don’t depend on the
+    extent of the region or the tile.
+
+    Returns:
+        Unsigned 64-bit integer array (lat, lon).
+
+    >>> get_cell_keys([-90, 0], [-1, 359]).tolist()
+    [[35900, 35900], [324035900, 324035900]]
+    """
+    import numpy as np
+    lat_keys = np.round((np.asarray(lat, dtype='float64') + 90) * 100)
+    lon_keys = np.round(np.mod(np.asarray(lon, dtype='float64'), 360) * 100)
+    return (lat_keys[:, None] * 36000 + lon_keys[None, :]).astype('uint64')
+
+
+def get_counters(days, cell_keys):
+    """Combine absolute days and grid cells to unique counters (day, cell).
+
+    Args:
+        days: Integer array with the absolute day numbers.
+        cell_keys: Array (lat, lon) from `get_cell_keys()`.
+    """
+    import numpy as np
+    days = np.asarray(days).astype('int64').astype('uint64')
+    return days[:, None] * np.uint64(CELL_KEYS) + cell_keys.reshape(-1)
+
+
+def get_year_days(value, units):
+    """Get the 365 days of the year that contains a time value.
+
+    The calendar is 'noleap'. The days are counted from the reference date of
+    the time unit, so day 0 of the year is 1 January, no matter where in
+    January (or in the year) the monthly time stamp lies.
+
+    Args:
+        value: A time value in the year, e.g. the time stamp of January.
+        units: The time unit, e.g. 'days since 1-1-15 00:00:00'.
+
+    Returns:
+        Float array with the time values of 1 January to 31 December.
+
+    Raises:
+        ValueError: The unit is not 'days since'.
+
+    >>> days = get_year_days(380.5, 'days since 1-1-15 00:00:00')
+    >>> float(days[0]), float(days[-1])
+    (351.0, 715.0)
+    >>> float(get_year_days(15.5, 'days since 1-1-1 00:00:00')[0])
+    0.0
+    """
+    import numpy as np
+    match_obj = re.match(r'\s*days\s+since\s+(-?\d+)-(\d+)-(\d+)', units)
+    if not match_obj:
+        raise ValueError(f"Time unit is not 'days since': '{units}'")
+    # Day of the year of the reference date (0 for 1 January).
+    cumulative = np.cumsum((0,) + NOLEAP_DAYS_PER_MONTH)
+    ref_day = (cumulative[int(match_obj.group(2)) - 1] +
+               int(match_obj.group(3)) - 1)
+    year = np.floor((float(value) + ref_day) / 365)
+    return 365 * year - ref_day + np.arange(365, dtype='float64')
+
+
+def sample_gamma(shape, seed, counters):
+    """Draw gamma variates with scale 1 (Marsaglia & Tsang 2000).
+
+    For a shape below 1, a variate for shape + 1 is scaled by `U^(1/shape)`.
+    Each attempt of the rejection method uses its own random number streams.
+
+    Args:
+        shape: Flat array with the shape parameter of each variate.
+        seed: Integer seed.
+        counters: Flat array with the counter of each variate.
+    """
+    import numpy as np
+    from scipy.special import ndtri
+    boost = shape < 1
+    a = np.where(boost, shape + 1, shape)
+    d = a - 1.0 / 3
+    c = 1 / np.sqrt(9 * d)
+    # If all attempts fail, the mode is taken.
+    result = d.copy()
+    todo = np.arange(len(a))
+    for attempt in range(GAMMA_ATTEMPTS):
+        z = ndtri(get_uniform(seed, counters[todo],
+                              GAMMA_STREAM + 2 * attempt))
+        u = get_uniform(seed, counters[todo], GAMMA_STREAM + 2 * attempt + 1)
+        v = (1 + c[todo] * z)**3
+        with np.errstate(invalid='ignore'):
+            accept = (v > 0) & (np.log(u) < 0.5 * z**2 + d[todo] -
+                                d[todo] * v + d[todo] * np.log(v))
+        result[todo[accept]] = d[todo[accept]] * v[accept]
+        todo = todo[~accept]
+        if not todo.size:
+            break
+    result[boost] *= get_uniform(seed, counters[boost],
+                                 BOOST_STREAM)**(1 / shape[boost])
+    return result
+
+
+def generate_precipitation(monthly, std, threshold, seed, counters):
+    """Generate one year of daily precipitation.
+
+    Args:
+        monthly: Array (12, cells) with monthly mean precipitation
+            [mm/day].
+        std: Array (12, cells) with the standard deviation of daily
+            precipitation [mm].
+        threshold: Minimum precipitation [mm/day] to count a day as “wet”.
+        seed: Integer seed.
+        counters: Array (365, cells) from `get_counters()`.
+
+    Returns:
+        Array (365, cells) with daily precipitation [mm/day].
+    """
+    import numpy as np
+    # Missing values (NaN) stay missing.
+    monthly = np.where(monthly < 0, 0, monthly)
+    positive = np.where(monthly > 0, monthly, ALMOST_ZERO)
+    std = np.where(std > 0, std, ALMOST_ZERO)
+    # Probability of a dry day in each month.
+    dry = get_gamma_cdf(threshold, positive, std)
+    (shape, scale) = get_gamma_parameters(positive, std)
+    daily = np.zeros(counters.shape)
+    first_day = 0
+    for (month, days) in enumerate(NOLEAP_DAYS_PER_MONTH):
+        block = slice(first_day, first_day + days)
+        first_day += days
+        u = get_uniform(seed, counters[block], WET_STREAM)
+        wet = u >= dry[month]
+        amounts = np.zeros(u.shape)
+        amounts[wet] = sample_gamma(
+            np.broadcast_to(shape[month], u.shape)[wet], seed,
+            counters[block][wet]) * np.broadcast_to(scale[month], u.shape)[wet]
+        # Without any wet day (or amount), the precipitation falls on the
+        # days closest to being wet.
+        total = amounts.sum(axis=0)
+        fallback = np.where(wet.any(axis=0), wet, u == u.max(axis=0))
+        amounts = np.where(total > 0, amounts, fallback)
+        daily[block] = (amounts * (monthly[month] * days) /
+                        amounts.sum(axis=0))
+    return daily
+
+
+def generate_temperature(monthly, temperature_std, seed, counters):
+    """Generate one year of daily temperature.
+
+    Args:
+        monthly: Array (12, cells) with monthly mean temperature.
+        temperature_std: Standard deviation of the daily anomalies.
+        seed: Integer seed.
+        counters: Array (365, cells) from `get_counters()`.
+
+    Returns:
+        Array (365, cells) with daily temperature.
+    """
+    import numpy as np
+    from scipy.special import ndtri
+    month_of_day = np.repeat(np.arange(12), NOLEAP_DAYS_PER_MONTH)
+    anomalies = ndtri(get_uniform(seed, counters, TEMPERATURE_STREAM))
+    first_day = 0
+    for days in NOLEAP_DAYS_PER_MONTH:
+        block = slice(first_day, first_day + days)
+        first_day += days
+        anomalies[block] -= anomalies[block].mean(axis=0)
+    return monthly[month_of_day] + temperature_std * anomalies
+
+
+def create_daily_files(prect_file, trefht_file, prec_std_file, out_files,
+                       opts):
+    """Generate daily precipitation and temperature for one slice.
+
+    The monthly input files must start in January and cover whole years.
+    Their time unit must be 'days since' (like the output files).
+
+    Args:
+        prect_file: Monthly output file with PRECT [kg/m²/s].
+        trefht_file: Monthly output file with TREFHT.
+        prec_std_file: File with the day-to-day standard deviation of
+            precipitation for each month.
+        out_files: Dictionary with the paths of the output files for 'PRECT'
+            and 'TREFHT'.
+        opts: Dictionary with the options from options.yaml.
+
+    Returns:
+        The dictionary `out_files`.
+
+    Raises:
+        FileNotFoundError: An input file doesn’t exist.
+        ValueError: The monthly files don’t cover whole years.
+    """
+    import netCDF4
+    import numpy as np
+    in_files = {'PRECT': prect_file, 'TREFHT': trefht_file}
+    for f in list(in_files.values()) + [prec_std_file]:
+        if not os.path.isfile(f):
+            raise FileNotFoundError(f"Input file doesn’t exist: '{f}'")
+    if skip(list(in_files.values()) + [prec_std_file],
+            list(out_files.values())):
+        return out_files
+    cprint(f"Generating daily weather for '{os.path.basename(prect_file)}' "
+           f"and '{os.path.basename(trefht_file)}'...", 'yellow')
+    settings = opts['weather_generator']
+    seed = int(settings['seed'])
+    for f in out_files.values():
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+    with open_dataarray(prec_std_file) as std:
+        std = std.values.astype('float64').reshape((12, -1))
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(reserve('daily', list(in_files.values())))
+        tmp_files = {v: stack.enter_context(atomic_output(f))
+                     for (v, f) in out_files.items()}
+        sources = {v: stack.enter_context(netCDF4.Dataset(f, 'r'))
+                   for (v, f) in in_files.items()}
+        outputs = {v: stack.enter_context(
+            create_daily_file(tmp_files[v], sources[v], v, opts))
+            for v in sources}
+        prect = sources['PRECT']
+        time = prect.variables['time']
+        if len(time) % 12 or not time.units.startswith('days since'):
+            raise ValueError(f"File '{prect_file}' does not contain whole "
+                             "years with time unit 'days since'.")
+        cell_keys = get_cell_keys(prect.variables['lat'][:],
+                                  prect.variables['lon'][:])
+        grid = cell_keys.shape
+        for year in range(len(time) // 12):
+            months = slice(year * 12, (year + 1) * 12)
+            days = get_year_days(time[months][0], time.units)
+            counters = get_counters(days, cell_keys)
+            monthly = {v: np.ma.filled(sources[v].variables[v][months].astype(
+                'float64'), np.nan).reshape((12, -1)) for v in sources}
+            with np.errstate(divide='ignore', invalid='ignore'):
+                daily = {
+                    'PRECT': generate_precipitation(
+                        monthly['PRECT'] * SECONDS_PER_DAY, std,
+                        opts['precip_threshold'], seed, counters
+                    ) / SECONDS_PER_DAY,
+                    'TREFHT': generate_temperature(
+                        monthly['TREFHT'], settings['temperature_std'], seed,
+                        counters)
+                }
+            for var in outputs:
+                outputs[var].variables['time'][year * 365:
+                                               (year + 1) * 365] = days
+                outputs[var].variables[var][year * 365:(year + 1) * 365] = \
+                    np.ma.masked_invalid(daily[var].reshape((365,) + grid))
+    cprint(f"Successfully created '{out_files['PRECT']}' and "
+           f"'{out_files['TREFHT']}'.", 'green')
+    return out_files
+
+
+def create_daily_file(out_file, src, var, opts):
+    """Create an empty daily NetCDF file with the grid of a monthly file.
+
+    Args:
+        out_file: Path of the new file.
+        src: Open netCDF4 dataset of the monthly file.
+        var: The variable.
+        opts: Dictionary with the options from options.yaml.
+
+    Returns:
+        The open netCDF4 dataset.
+    """
+    import netCDF4
+    out = netCDF4.Dataset(out_file, 'w', format='NETCDF4')
+    out.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+    out.createDimension('time', None)
+    for d in ['lat', 'lon']:
+        out.createDimension(d, len(src.dimensions[d]))
+        new = out.createVariable(d, src.variables[d].datatype, (d,))
+        new.setncatts({a: src.variables[d].getncattr(a)
+                       for a in src.variables[d].ncattrs()})
+        new[:] = src.variables[d][:]
+    time = out.createVariable('time', 'float64', ('time',))
+    time.setncatts({a: src.variables['time'].getncattr(a)
+                    for a in src.variables['time'].ncattrs()
+                    if a != 'bounds'})
+    source = src.variables[var]
+    chunks = [365] + [min(opts['chunks'][d], len(src.dimensions[d]))
+                      for d in ['lat', 'lon']]
+    level = opts['compression_level']
+    new = out.createVariable(var, 'float32', ('time', 'lat', 'lon'),
+                             zlib=level > 0, complevel=max(level, 1),
+                             chunksizes=chunks, fill_value=1e20)
+    new.setncatts({a: source.getncattr(a) for a in source.ncattrs()
+                   if a not in ['_FillValue', 'missing_value']})
+    return out
+
+
+def create_daily_slice(args):
+    """Call `create_daily_files()` with a tuple of arguments."""
+    return create_daily_files(*args)
+
+
+def create_daily_slices(output_files, prec_std_file, out_dir, opts):
+    """Generate daily weather for all slices in parallel processes.
+
+    Args:
+        output_files: Dictionary with the output variable as key and the
+            list of monthly slice files as value (see `Pipeline.gather()`).
+        prec_std_file: File with the day-to-day standard deviation of
+            precipitation for each month.
+        out_dir: The output directory. The daily files are written to its
+            subdirectory `DAILY_DIR` with the same names as the monthly
+            files.
+        opts: Dictionary with the options from options.yaml.
+
+    Returns:
+        List of the dictionaries from `create_daily_files()`.
+    """
+    daily_dir = os.path.join(out_dir, DAILY_DIR)
+    trefht_files = {os.path.basename(f).replace('TREFHT', 'PRECT'): f
+                    for f in output_files['TREFHT']}
+    tasks = list()
+    for prect_file in output_files['PRECT']:
+        trefht_file = trefht_files[os.path.basename(prect_file)]
+        tasks.append((prect_file, trefht_file, prec_std_file, {
+            v: os.path.join(daily_dir, os.path.basename(f))
+            for (v, f) in [('PRECT', prect_file), ('TREFHT', trefht_file)]
+        }, opts))
+    workers = opts['weather_generator'].get('workers') or None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(create_daily_slice, tasks))
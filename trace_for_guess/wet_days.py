@@ -5,25 +5,38 @@
 import os
 import warnings
 
-import numpy as np
-import scipy.stats
-import xarray as xr
 import yaml
 from termcolor import cprint
 
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.months import (NOLEAP_DAYS_PER_MONTH,
+                                    flux_to_mm_per_month, get_month_index)
+from trace_for_guess.netcdf_io import open_dataarray, open_dataset
 from trace_for_guess.netcdf_metadata import set_attributes
+from trace_for_guess.resources import reserve
 from trace_for_guess.skip import skip
 
 # Arbitrary number for missing values.
 NODATA = 999999999
 
 
-def flux_to_monthly_precip(data_array):
-    """Convert precipitation from kg/m²/s to mm/month."""
-    # TODO Take month lengths into account!
-    days_per_month = 30
-    seconds_per_month = days_per_month * 24 * 60 * 60
-    return data_array * seconds_per_month
+def get_gamma_parameters(xmean, xstd):
+    """Calculate shape and scale of the gamma distribution of precipitation.
+
+    Args:
+        xmean: Monthly mean precipitation [mm/day].
+        xstd: Standard deviation of daily precipitation [mm].
+
+    Returns:
+        Tuple with the shape and the scale [mm].
+
+    >>> [float(x) for x in get_gamma_parameters(2.0, 4.0)]
+    [0.25, 8.0]
+    """
+    import numpy as np
+    shape = np.power(xmean, 2) / np.power(xstd, 2)
+    scale = np.power(xstd, 2) / xmean
+    return (shape, scale)
 
 
 def get_gamma_cdf(x, xmean, xstd):
@@ -37,8 +50,8 @@ def get_gamma_cdf(x, xmean, xstd):
     Returns:
         Cumulative density of gamma distribution.
     """
-    shape = np.power(xmean, 2) / np.power(xstd, 2)
-    scale = np.power(xstd, 2) / xmean
+    import scipy.stats
+    (shape, scale) = get_gamma_parameters(xmean, xstd)
     # scipy raises this “RuntimeWarning: invalid value encountered in greater”
     # I don’t know why so I just suppress it.
     with warnings.catch_warnings():
@@ -61,6 +74,7 @@ def calc_wet_days(trace_prec, cru_std, days, threshold):
     Returns:
         Array with number of wet days in the month for the TraCE data.
     """
+    import numpy as np
     # Catch potential zero divide.
     almost_zero = 0.00000001
     cru_std = np.where(cru_std == 0, almost_zero, cru_std)
@@ -96,20 +110,38 @@ def get_wet_days_array(prect, prec_std):
         array.
     """
     precip_threshold = yaml.load(open('options.yaml'))['precip_threshold']
+    return get_wet_days_values(prect.values, prec_std.values,
+                               precip_threshold)
+
+
+def get_wet_days_values(prect_values, prec_std_values, precip_threshold):
+    """Calculate the number of wet days for a numpy array of precipitation.
+
+    Args:
+        prect_values: Array (time, lat, lon) with monthly precipitation
+            (mm/month). The time axis must start with January.
+        prec_std_values: Array (12, lat, lon) with monthly standard deviation
+            of daily modern precipitation.
+        precip_threshold: Minimum precipitation [mm/day] to count a day as
+            “wet”.
+
+    Returns:
+        Integer array with number of wet days for each month.
+    """
+    import numpy as np
     # Create a numpy array of the same shape, but with missing values.
-    wet_values = np.full_like(prect.values, NODATA, dtype='int32')
-    # Create an array that holds the month number (0 to 11) for each index in
-    # the original TraCE time dimension.
-    months_array = [m for m in range(12)] * (len(prect['time']) // 12)
-    # Do the same for the number of days within each month.
-    days_per_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    days_per_month_array = days_per_month * (len(prect['time']) // 12)
-    assert(len(days_per_month_array) == len(prect))
-    # Iterate over every month `t` (“time step”) in the transient time series.
-    for t, (month, days) in enumerate(zip(months_array, days_per_month_array)):
-        mean_daily_prec = prect[t] / float(days)  # [mm/day]
-        wet_values[t] = calc_wet_days(mean_daily_prec, prec_std[month], days,
-                                      precip_threshold)
+    wet_values = np.full_like(prect_values, NODATA, dtype='int32')
+    # The month number (0 to 11) for each index in the original TraCE time
+    # dimension. The time series must start with January.
+    months_array = get_month_index(len(prect_values))
+    # Calculate all time steps of the same calendar month at once. They all
+    # have the same number of days.
+    for month, days in enumerate(NOLEAP_DAYS_PER_MONTH):
+        steps = months_array == month
+        mean_daily_prec = prect_values[steps] / float(days)  # [mm/day]
+        wet_values[steps] = calc_wet_days(mean_daily_prec,
+                                          prec_std_values[month], days,
+                                          precip_threshold)
     return wet_values
 
 
@@ -131,6 +163,7 @@ def create_wet_days_file(prect_file, prec_std_file, out_file):
         FileNotFoundError: `prect_file` or `prec_std_file` not found.
         ValueError: The `prect_file` does not contain the 'PRECT' variable.
     """
+    import xarray as xr
     if not os.path.isfile(prect_file):
         raise FileNotFoundError(f"Input file does not exist: '{prect_file}'")
     if not os.path.isfile(prec_std_file):
@@ -145,26 +178,22 @@ def create_wet_days_file(prect_file, prec_std_file, out_file):
         cprint(f"Directory '{out_dir}' does not exist yet. I will create it.",
                'yellow')
         os.makedirs(out_dir)
-    try:
-        with xr.open_dataarray(prec_std_file, decode_times=False) as std, \
-                xr.open_dataset(prect_file, decode_times=False) as trace:
-            if 'PRECT' not in trace:
-                raise ValueError("File does not contain total precipitation"
-                                 f"variable 'PRECT': '{prect_file}'.")
-            da = xr.full_like(trace['PRECT'], NODATA, dtype='int32')
-            trace['PRECT'] = flux_to_monthly_precip(trace['PRECT'])
-            da.values = get_wet_days_array(trace['PRECT'], std)
-            set_attributes(da, "wet_days")
-            da.attrs['_FillValue'] = NODATA
-            da.attrs['missing_value'] = NODATA
-            trace['WET'] = da
-            del trace['PRECT']
-            trace.to_netcdf(out_file, mode='w', engine='netcdf4')
-    except Exception:
-        if os.path.isfile(out_file):
-            cprint(f"Removing file '{out_file}'.", 'red')
-            os.remove(out_file)
-        raise
+    with reserve('wet_days', [prect_file, prec_std_file]), \
+            atomic_output(out_file) as tmp_file, \
+            open_dataarray(prec_std_file) as std, \
+            open_dataset(prect_file) as trace:
+        if 'PRECT' not in trace:
+            raise ValueError("File does not contain total precipitation"
+                             f"variable 'PRECT': '{prect_file}'.")
+        da = xr.full_like(trace['PRECT'], NODATA, dtype='int32')
+        trace['PRECT'] = flux_to_mm_per_month(trace['PRECT'])
+        da.values = get_wet_days_array(trace['PRECT'], std)
+        set_attributes(da, "wet_days")
+        da.attrs['_FillValue'] = NODATA
+        da.attrs['missing_value'] = NODATA
+        trace['WET'] = da
+        del trace['PRECT']
+        trace.to_netcdf(tmp_file, mode='w', engine='netcdf4')
     assert os.path.isfile(out_file), 'No output created.'
     cprint(f"Successfully created '{out_file}'.", 'green')
     return out_file
@@ -0,0 +1,255 @@
+# SPDX-FileCopyrightText: 2021 Wolfgang Traylor <wolfgang.traylor@senckenberg.de>
+#
+# SPDX-License-Identifier: MIT
+
+# Optional Zarr output backend: All 100-years slices of one variable are
+# written into one Zarr directory store on the local file system. Each slice
+# occupies its own chunks along the time axis, so parallel workers can write
+# disjoint slices into the same store without a concatenation step. The
+# slices don’t all start at multiples of 100 years from the start of the store
+# (e.g. the last slice of an original TraCE file can be shorter), so the time
+# chunk is reduced until it divides the offset of every slice (see
+# `get_time_chunk()`).
+# The Python package `zarr` is only needed if the option `output_format` in
+# 'options.yaml' is set to 'zarr'.
+
+import math
+import os
+import sys
+from glob import glob
+
+import yaml
+from termcolor import cprint
+
+from trace_for_guess.compress import compress_and_chunk
+from trace_for_guess.filenames import get_years_of_new_trace_name
+from trace_for_guess.journal import atomic_output
+from trace_for_guess.netcdf_io import open_dataset
+from trace_for_guess.netcdf_metadata import set_metadata
+from trace_for_guess.skip import skip
+
+
+def import_zarr():
+    """Import the optional `zarr` package.
+
+    Raises:
+        RuntimeError: The package `zarr` is not installed.
+    """
+    try:
+        import zarr
+    except ImportError:
+        raise RuntimeError('The Python package `zarr` is required for the '
+                           "output format 'zarr'.")
+    return zarr
+
+
+def get_store_name(var):
+    """Compose the directory name of the Zarr store for one variable."""
+    return f'trace_{var}.zarr'
+
+
+def get_marker_file(store_path, slice_file):
+    """Get the path of the file marking a slice as written into a store.
+
+    The modification time of the marker file tells whether the slice in the
+    store is up-to-date (see `trace_for_guess.skip`).
+    """
+    return os.path.join(store_path, '.written', os.path.basename(slice_file))
+
+
+def get_time_chunk(chunk, offsets):
+    """Get the largest time chunk that each slice can write on its own.
+
+    Args:
+        chunk: The time chunk size from 'options.yaml'.
+        offsets: The first time step of each slice in the store.
+
+    Returns:
+        The greatest common divisor of `chunk` and all offsets, so that every
+        slice begins at a chunk boundary.
+
+    >>> get_time_chunk(1200, [0, 1200, 2400])
+    1200
+    >>> get_time_chunk(1200, [0, 1200, 6600, 7800])
+    600
+    >>> get_time_chunk(1200, [0, 1188])
+    12
+    """
+    for offset in offsets:
+        chunk = math.gcd(chunk, offset)
+    return chunk
+
+
+def init_store(store_path, var, slice_files):
+    """Create an empty Zarr store that can hold all given slices.
+
+    The coordinates `lat` and `lon` and all attributes are copied from the
+    first slice file and complemented with the attributes from
+    'options.yaml'. The data variable is pre-allocated for the whole time
+    range so that slices can be written in any order.
+
+    An existing store is kept unless one of the slice files is younger than
+    the store. In that case it is created anew.
+
+    Args:
+        store_path: Path to the Zarr directory store to be created.
+        var: Name of the data variable.
+        slice_files: List of all NetCDF slice files that will be written into
+            the store. Their names must match `derive_new_trace_name()`.
+
+    Returns:
+        The store path (equals `store_path`).
+
+    Raises:
+        FileNotFoundError: A file in `slice_files` does not exist.
+        ValueError: `slice_files` is empty.
+    """
+    import numcodecs
+    zarr = import_zarr()
+    if not slice_files:
+        raise ValueError('The argument "slice_files" is empty.')
+    for f in slice_files:
+        if not os.path.isfile(f):
+            raise FileNotFoundError(f"Input file not found: '{f}'")
+    metadata_file = os.path.join(store_path, '.zmetadata')
+    if skip(slice_files, metadata_file):
+        return store_path
+    opts = yaml.load(open('options.yaml'))
+    chunks = opts['zarr_chunks']
+    attributes = opts['nc_attributes']
+    compressor = numcodecs.Zlib(level=opts['compression_level'])
+    years = [get_years_of_new_trace_name(f) for f in slice_files]
+    first_year = min([y['first_year'] for y in years])
+    last_year = max([y['last_year'] for y in years])
+    time_chunk = get_time_chunk(
+        chunks['time'], [(y['first_year'] - first_year) * 12 for y in years])
+    if time_chunk != chunks['time']:
+        cprint(f"The time chunk of Zarr store '{store_path}' is reduced to "
+               f'{time_chunk} so that each slice has its own chunks.',
+               'yellow')
+    cprint(f"Creating Zarr store '{store_path}' for the years {first_year} to "
+           f"{last_year}.", 'yellow')
+    with open_dataset(slice_files[0]) as ds:
+        group = zarr.open_group(store_path, mode='w')
+        group.attrs.update(ds.attrs)
+        group.attrs['first_year'] = first_year
+        for name in ['lat', 'lon']:
+            arr = group.array(name, ds[name].values, compressor=None)
+            arr.attrs.update(ds[name].attrs)
+            arr.attrs.update(attributes.get(name, dict()))
+            arr.attrs['_ARRAY_DIMENSIONS'] = [name]
+        time_steps = (last_year - first_year + 1) * 12
+        time = group.full('time', shape=(time_steps,), chunks=time_chunk,
+                          dtype=ds['time'].dtype, fill_value=None,
+                          compressor=None)
+        time.attrs.update(ds['time'].attrs)
+        time.attrs['_ARRAY_DIMENSIONS'] = ['time']
+        da = ds[var]
+        shape = (time_steps, len(ds['lat']), len(ds['lon']))
+        arr = group.full(var, shape=shape,
+                         chunks=(time_chunk, chunks['lat'], chunks['lon']),
+                         dtype=da.dtype, fill_value=da.encoding.get(
+                             '_FillValue', None),
+                         compressor=compressor)
+        arr.attrs.update(da.attrs)
+        arr.attrs.update(attributes.get(var, dict()))
+        arr.attrs['_ARRAY_DIMENSIONS'] = ['time', 'lat', 'lon']
+    zarr.consolidate_metadata(store_path)
+    cprint(f"Successfully created '{store_path}'.", 'green')
+    return store_path
+
+
+def write_slice_to_store(slice_file, store_path, var):
+    """Write one 100-years slice into its time region of a Zarr store.
+
+    The store must have been created with `init_store()`. Different slices
+    cover disjoint chunks (see `get_time_chunk()`), so this function can be
+    called in parallel for different slices of the same store. A slice that
+    has already been written is skipped.
+
+    Args:
+        slice_file: NetCDF file of one slice. The name must match
+            `derive_new_trace_name()`.
+        store_path: Path to the Zarr directory store.
+        var: Name of the data variable.
+
+    Raises:
+        FileNotFoundError: `slice_file` or `store_path` does not exist.
+        ValueError: The slice does not fit into the time range of the store.
+    """
+    zarr = import_zarr()
+    if not os.path.isfile(slice_file):
+        raise FileNotFoundError(f"Input file not found: '{slice_file}'")
+    if not os.path.isdir(store_path):
+        raise FileNotFoundError(f"Zarr store not found: '{store_path}'")
+    marker_file = get_marker_file(store_path, slice_file)
+    if skip(slice_file, marker_file):
+        return
+    group = zarr.open_group(store_path, mode='r+')
+    first_year = get_years_of_new_trace_name(slice_file)['first_year']
+    start = (first_year - group.attrs['first_year']) * 12
+    cprint(f"Writing '{slice_file}' into '{store_path}'...", 'yellow')
+    with open_dataset(slice_file) as ds:
+        end = start + len(ds['time'])
+        if start < 0 or end > group[var].shape[0]:
+            raise ValueError(f"Slice '{slice_file}' lies outside of the time "
+                             f"range of Zarr store '{store_path}'.")
+        group['time'][start:end] = ds['time'].values
+        group[var][start:end] = ds[var].values
+    os.makedirs(os.path.dirname(marker_file), exist_ok=True)
+    open(marker_file, 'w').close()
+    cprint(f"Successfully wrote '{slice_file}' into '{store_path}'.", 'green')
+
+
+def export_store_to_netcdf(store_path, var, out_file):
+    """Convert a finished Zarr store into a NetCDF file for LPJ-GUESS.
+
+    The output file is compressed, chunked, and has its metadata set just
+    like the NetCDF output of the normal pipeline.
+
+    Args:
+        store_path: Path to the Zarr directory store.
+        var: Name of the data variable.
+        out_file: Path to the output NetCDF file (will *not* be overwritten).
+
+    Returns:
+        The output file (equals `out_file`).
+
+    Raises:
+        FileNotFoundError: `store_path` does not exist.
+        RuntimeError: No slice has been written into the store yet.
+    """
+    import xarray as xr
+    if not os.path.isdir(store_path):
+        raise FileNotFoundError(f"Zarr store not found: '{store_path}'")
+    import_zarr()
+    marker_files = glob(os.path.join(store_path, '.written', '*'))
+    if not marker_files:
+        raise RuntimeError('No slices have been written into Zarr store '
+                           f"'{store_path}'.")
+    if skip(marker_files, out_file):
+        return out_file
+    cprint(f"Exporting Zarr store '{store_path}' to '{out_file}'...",
+           'yellow')
+    # The uncompressed file starts with the name of the temporary output
+    # file, so it is also removed on error.
+    with atomic_output(out_file) as tmp_file:
+        uncompressed_file = tmp_file + '.uncompressed.tmp'
+        with xr.open_zarr(store_path, consolidated=True,
+                          decode_times=False) as ds:
+            ds[[var]].to_netcdf(uncompressed_file, mode='w',
+                                engine='netcdf4')
+        compress_and_chunk(uncompressed_file, tmp_file)
+        set_metadata(tmp_file)
+        os.remove(uncompressed_file)
+    cprint(f"Successfully created '{out_file}'.", 'green')
+    return out_file
+
+
+if __name__ == '__main__':
+    # Usage: python -m trace_for_guess.zarr_store STORE VARIABLE OUT_FILE
+    if len(sys.argv) != 4:
+        cprint('Usage: python -m trace_for_guess.zarr_store STORE VARIABLE '
+               'OUT_FILE', 'red')
+        sys.exit(1)
+    export_store_to_netcdf(sys.argv[1], sys.argv[2], sys.argv[3])